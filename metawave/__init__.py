@@ -1,5 +1,11 @@
 
-# Metawave sub-modules
-from . import commands
-from . import search
-from . import metawave
\ No newline at end of file
+# Metawave sub-modules, imported on first use so that
+# `import metawave` does not load the scientific stack
+import importlib
+
+_SUBMODULES = ['commands', 'search', 'server', 'metawave']
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -1,115 +1,834 @@
+import contextlib
 import csv
-import mmap
+import io
+import multiprocessing
 import os
 import re
 import sys
 import operator
 import itertools
-from collections import defaultdict
+import tempfile
 
 import numpy as np
-import pylab as plt
 from tqdm import tqdm
 
-from .utils.audio import (dio_F0, get_duration, naive_syllable_count, prep_wav,
-                         speech_rate)
+from .utils.audio_pack import DEFAULT_SHARD_BYTES, AudioPack, AudioPackWriter
+from .utils.cache import cache_key
 from .utils.datasets import config_paths
-from .utils.index import IndexHandler, ReverseIndexHandler
+from .utils.defaults import (CHECK_FEATURES, DEFAULT_F0_METHOD, DEFAULT_FRAME_PERIOD,
+                             DEFAULT_OUTLIER_METHOD, DEFAULT_PLOT_STYLE, DEFAULT_RESAMPLER, FRAME_LENGTH,
+                             HOP_LENGTH, SEGMENTED_FEATURES, TRIM_TOP_DB)
+from .utils.features import extract, feature_columns, select_features
+from .utils.index import (IndexHandler, count_lines, gen_index_line, gen_line_reg, index_lines,
+                          pair_files, shard_bounds, walk_files)
 from .utils.misc import gaussian
+from .utils.outliers import CHUNK_SIZE, group_moments, keep_threshold, outlier_scorer, select_outliers
+from .utils.pipeline import DEFAULT_READ_AHEAD, DEFAULT_READ_THREADS, BackgroundWriter, Prefetcher
+from .utils.profile import RunProfile, peak_rss_mb, print_report, recording, stage
+from .utils.stats import F0_RANGE, NUM_BINS, SPR_RANGE, MetaStats, StreamingHistogram
+from .utils.store import (MetaStore, MetaStoreWriter, is_store, meta_columns_to_store, meta_line, reader_order,
+                          store_to_tsv, tsv_to_store)
+from .utils.tokens import TokenPack
 
+# utils.audio (librosa, pyworld) and utils.plots (matplotlib) take
+# seconds to import, so they are imported by the functions that
+# use them, not by commands that never touch audio or plots.
+
+# the memory a StreamingReaderSet takes for each row of a
+# chunk, mostly the parsed lines of meta.tsv
+STREAM_ROW_BYTES = 1024
 
 def run(sr, paths, dataset, **kwargs):
     '''
         The command line runner for running a whole dataset
         meta run.
+
+        If kwargs['workers'] is larger than 1, the per utterance
+        analysis is spread over a pool of worker processes. The
+        rows of the meta file are written in index order regardless
+        of the number of workers.
+
+        If kwargs['resume'] is set, utterances already in the meta
+        file are skipped and new rows are appended to it. Utterances
+        that fail are written to the error log instead of stopping
+        the run. Both files are flushed to disk every
+        kwargs['flush_every'] rows. Utterances in the error log
+        are tried again on resume, and their earlier rows are
+        dropped from it so each failing utterance is listed once.
+
+        If kwargs['cache'] is a FeatureCache, features of utterances
+        whose files and analysis parameters have not changed since
+        they were cached are not computed again.
+
+        kwargs['f0_method'] and kwargs['frame_period'] select the
+        F0 estimator, see utils.audio.F0_METHODS, and
+        kwargs['res_type'] the resampler, see utils.audio.RESAMPLERS.
+        If sr is None every file is analysed at its own rate.
+
+        kwargs['features'] names the features computed on top of
+        spr and f0, see utils.features. Each adds its columns
+        to the meta, after spr and f0.
+
+        If kwargs['store'] is set, the meta is also written to a
+        columnar binary store at paths['store'].
+
+        Per reader statistics are kept while the run goes and
+        written to paths['stats'] on every flush, see
+        write_stats_summary.
+
+        The token and audio files are read by kwargs['read_threads']
+        threads ahead of the analysis, at most kwargs['read_ahead']
+        utterances ahead of the writer, so reading overlaps with
+        the analysis. The progress bar shows how many utterances
+        are being read, analysed and waiting to be written.
+
+        If kwargs['shard'] is (i, N), only the i-th of N equally
+        large byte ranges of the index is read, see
+        utils.index.shard_bounds. The paths should then be those
+        of utils.datasets.shard_paths so that the shards can be
+        joined with merge_shards.
+
+        If kwargs['profile'] is set, the wall and CPU time of
+        each stage of every utterance is recorded, see
+        utils.profile, and shown in the progress bar along with
+        the seconds of audio analysed per second and the peak
+        memory. The report is written to paths['profile'].
+
+        If kwargs['token_pack'] is the path of a token pack, see
+        utils.tokens, the tokens are read from it instead of
+        opening the token file of each utterance. If
+        kwargs['audio_pack'] is the path of an audio pack, see
+        utils.audio_pack, the audio is read from it instead of
+        decoding the audio file of each utterance.
+
+        If kwargs['segment_seconds'] is given, audio files longer
+        than it are analysed in segments of that many seconds,
+        see segmented_features, so a long recording does not
+        have to fit in memory. Only the SEGMENTED_FEATURES can
+        then be computed.
     '''
     i_handler = IndexHandler(dataset, kwargs['ind'])
     num_samples = kwargs['num_samples']
+    workers = kwargs.get('workers', 1)
+    resume = kwargs.get('resume', False)
+    flush_every = kwargs.get('flush_every', 100)
+    cache = kwargs.get('cache', None)
+    shard = kwargs.get('shard', None)
+    read_ahead = kwargs.get('read_ahead', DEFAULT_READ_AHEAD)
+    read_threads = kwargs.get('read_threads', DEFAULT_READ_THREADS)
+    profile = RunProfile() if kwargs.get('profile', False) else None
+    features = select_features(kwargs.get('features', None))
+    columns = feature_columns(features)
+    tokens = TokenPack(kwargs['token_pack']) if kwargs.get('token_pack') is not None else None
+    store = None
+    params = analysis_params(sr, kwargs.get('f0_method', DEFAULT_F0_METHOD),
+        kwargs.get('frame_period', DEFAULT_FRAME_PERIOD), kwargs.get('res_type', DEFAULT_RESAMPLER))
+    segment_seconds = kwargs.get('segment_seconds', None)
+    if segment_seconds is not None:
+        others = [name for name in features if name not in SEGMENTED_FEATURES]
+        if others:
+            print('%s can not be computed in segments, choose from %s' % (', '.join(others),
+                ', '.join(SEGMENTED_FEATURES)))
+            sys.exit()
+        if kwargs.get('audio_pack') is not None:
+            print('Long recordings are decoded in segments from their files, not from an audio pack')
+            sys.exit()
+        params['segment_seconds'] = segment_seconds
+    audio = None
+    if kwargs.get('audio_pack') is not None:
+        audio = AudioPack(kwargs['audio_pack'])
+        check_audio_pack(audio, params)
     if 'token_xtsn' in paths:
         # using a known dataset
         i_handler.set_token_extension(paths['token_xtsn'])
     else:
         i_handler.set_token_extension(kwargs['token_xtsn']) 
+
+    done = set()
+    failed = set()
+    num_error_bytes = 0
+    stats = MetaStats()
+    if resume and os.path.exists(paths['out_file']):
+        num_columns = meta_num_columns(paths['out_file'])
+        if num_columns not in [None, len(columns)]:
+            print('The meta file has %d value columns but the features give %d (%s),'
+                % (num_columns, len(columns), ', '.join(columns)) + ' resume with the same features')
+            sys.exit()
+        done = read_meta_ids(paths['out_file'])
+        stats = stats_from_meta(paths['out_file'])
+        print('Resuming, %d utterances are already in the meta file' % len(done))
+        if os.path.exists(paths['error_file']):
+            failed = read_meta_ids(paths['error_file'])
+            num_error_bytes = os.path.getsize(paths['error_file'])
+    mode = 'a' if resume else 'w+'
+    if kwargs.get('store', False):
+        if resume and os.path.exists(paths['out_file']):
+            # the store is rebuilt so it has exactly the rows of the meta file
+            tsv_to_store(paths['out_file'], paths['store'], columns)
+        store = MetaStoreWriter(paths['store'], columns, append=resume)
     try:
-        count = 0
-        with open(paths['index'], encoding='utf-8') as f:
-            outfile = open(paths['out_file'], 'w+')
+        start, stop = shard_bounds(paths['index'], *shard) if shard is not None else (0, None)
+        with open(paths['index'], 'rb') as f, \
+                open(paths['out_file'], mode) as outfile, \
+                open(paths['error_file'], mode) as errfile:
             # run through each line in the index file
+            total = max(count_lines(paths['index'], start, stop) - len(done), 0)
             if num_samples is not None:
-                total = num_samples
-            else:
-                total = num_lines(paths['index'])
-            for line in tqdm(f, total=total):
-                i_handler.set_current(line)
-                token = ''
-                try:
-                    with open(os.path.join(paths['text'], i_handler.get_token_fid()), 'r') as f:
-                        for line in f: token += line.lower()
-                except Exception as e:
-                    print('A text from the index could not be found')
-                    print('Error: %s' % e)
-                    sys.exit()
-                try: 
-                    audio = prep_wav(os.path.join(paths['wavs'], i_handler.get_audio_fid()), sr)
-                except Exception as e:
-                    print('An audio file from the index could not be found')
-                    print('Error: %s' % e)
-                    sys.exit()
-                spr = speech_rate(audio, token)
-                F0 = dio_F0(audio, sr, exclude_silence=True)
-                outfile.write(i_handler.get_token_fid()+'\t'+i_handler.get_reader()+'\t %0.4f \t %0.4f \n' % (spr, F0))
-                if num_samples is not None and count + 1 >= num_samples:
-                    print('Stopping because num_samples was set to ', num_samples)
-                    break
-                count += 1
+                total = min(total, num_samples)
+            jobs = index_jobs(index_lines(f, start, stop), i_handler, paths, params, features, tokens,
+                audio)
+            jobs = (job for job in jobs if job['token_fid'] not in done)
+            if num_samples is not None:
+                jobs = itertools.islice(jobs, num_samples)
+            if cache is not None:
+                jobs = cached_jobs(jobs, cache, columns)
+            if profile is not None:
+                jobs = profiled_jobs(jobs)
+            # files are read by a pool of threads ahead of the
+            # analysis and rows are written by a background thread
+            prefetcher = Prefetcher(jobs, prefetch_job, read_ahead, read_threads)
+            writer = MetaWriter(outfile, errfile, stats, paths['stats'], store, cache, flush_every, columns,
+                profile, failed)
+            background = BackgroundWriter(writer.write, read_ahead)
+            try:
+                with worker_pool(workers) as pool:
+                    # the pool must not ask for more jobs than can be read ahead
+                    chunks = min(chunk_size(total, workers), max(1, read_ahead // (2 * workers)))
+                    results = pool.imap(safe_analyze_utterance, prefetcher, chunksize=chunks)
+                    progress = tqdm(results, total=total)
+                    try:
+                        for i, result in enumerate(progress):
+                            background.put(result)
+                            prefetcher.release()
+                            if i % 20 == 0:
+                                reading, analysing = prefetcher.depths()
+                                postfix = profile.postfix() if profile is not None else {}
+                                progress.set_postfix(read=reading, analyse=analysing,
+                                    write=background.depth(), refresh=False, **postfix)
+                    finally:
+                        # the pool waits for its job feeder when it is
+                        # terminated, which must not wait for read slots
+                        prefetcher.stop()
+                background.close()
+            except KeyboardInterrupt:
+                background.close()
+                writer.flush()
+                drop_retried_errors(paths['error_file'], num_error_bytes, writer.retried)
+                if profile is not None:
+                    profile.save(paths['profile'])
+                print('Run interrupted after %d utterances, continue it with --resume' % writer.count)
+                sys.exit()
+        drop_retried_errors(paths['error_file'], num_error_bytes, writer.retried)
+        count = writer.count
+        num_errors = writer.num_errors
+        if num_samples is not None and count >= num_samples:
+            print('Stopping because num_samples was set to ', num_samples)
+        if num_errors > 0:
+            print('%d utterances could not be processed, see %s' % (num_errors, paths['error_file']))
+        stats.save(paths['stats'])
+        if cache is not None:
+            cache.commit()
+        if store is not None:
+            store.close()
+            print('The meta store is available at ', paths['store'])
+        if profile is not None:
+            print_report(profile.save(paths['profile']))
+            print('The profile of the run is available at ', paths['profile'])
         print('Meta has finished writing and is available at ', paths['out_file'])
     except Exception as e:
         print('Error while reading from index file.')
         print('Error: %s' % e)
         sys.exit()
 
-def gen_index(paths, name_reg):
+def rounded(value):
+    '''
+        The value as it is written to meta.tsv, so the meta
+        store and meta.tsv hold the same numbers.
+    '''
+    return float('%0.4f' % value)
+
+def read_meta_ids(meta_path):
+    '''
+        Returns the set of utterance ids in an existing meta
+        file. A trailing row that was only partially written,
+        e.g. because the run was killed, is truncated away so
+        new rows can be appended.
+    '''
+    with open(meta_path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    return set(line.split('\t', 1)[0] for line in data[:end].decode('utf-8').splitlines() if line)
+
+def drop_retried_errors(error_path, num_old_bytes, retried):
+    '''
+        Rewrites the error log of a resumed run without the rows
+        of the utterances in retried that the log had before the
+        run, its first num_old_bytes. An utterance that failed
+        again has its new row further down.
+    '''
+    if not retried:
+        return
+    with open(error_path, 'rb') as f:
+        data = f.read()
+    old = [line for line in data[:num_old_bytes].splitlines(keepends=True)
+        if line.split(b'\t', 1)[0].decode('utf-8') not in retried]
+    with open(error_path + '.tmp', 'wb') as f:
+        f.write(b''.join(old) + data[num_old_bytes:])
+    os.replace(error_path + '.tmp', error_path)
+
+def meta_num_columns(meta_path):
+    '''
+        The number of value columns of the first row of a
+        meta file, None if it has no rows
+    '''
+    with open(meta_path, 'r') as meta:
+        line = meta.readline()
+    return len(line.split('\t')) - 2 if line.endswith('\n') else None
+
+def stats_from_meta(meta_path):
+    '''
+        Accumulates the run statistics of an existing meta file
+    '''
+    stats = MetaStats()
+    utt_ids, reader_ids, codes, spr, f0 = load_meta(meta_path)
+    for i in range(codes.shape[0]):
+        stats.update(reader_ids[codes[i]], spr[i], f0[i])
+    return stats
+
+def sync_files(*files):
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+
+def index_jobs(index_file, i_handler, paths, params, features, tokens=None, audio=None):
+    '''
+        Generates a single analysis job for each line in
+        the index file. A job is a dictionary with the ids and
+        paths of the <text, audio> pair, the analysis parameters
+        and the features to compute. If tokens is a TokenPack
+        the job also has the token, and if audio is an AudioPack
+        the position of its clip in the pack.
+    '''
+    for line in index_file:
+        i_handler.set_current(line)
+        job = {
+            'token_fid': i_handler.get_token_fid(),
+            'reader': i_handler.get_reader(),
+            'token_path': os.path.join(paths['text'], i_handler.get_token_fid()),
+            'audio_path': os.path.join(paths['wavs'], i_handler.get_audio_fid()),
+            'params': params,
+            'features': features,
+            'key': None,
+            'cached': None}
+        if tokens is not None:
+            token = tokens.get(job['token_fid'])
+            if token is None:
+                job['read_error'] = 'A text from the index could not be found: %s is not in the token pack %s' \
+                    % (job['token_fid'], tokens.path)
+            else:
+                job['token'] = token.lower()
+        if audio is not None and job.get('read_error') is None:
+            at = audio.find(i_handler.get_audio_fid())
+            if at < 0:
+                job['read_error'] = 'An audio file from the index could not be found: %s is not in the audio pack %s' \
+                    % (i_handler.get_audio_fid(), audio.path)
+            else:
+                job['audio_pack'] = audio.path
+                job['audio_at'] = at
+        yield job
+
+def cached_jobs(jobs, cache, columns):
+    '''
+        Looks up each job in the feature cache. Jobs that are
+        found carry their cached features to the worker, which
+        then returns them without any analysis.
+    '''
+    for job in jobs:
+        try:
+            job['key'] = cache_key(job['audio_path'], job['token_path'], job['params'], job.get('token'))
+        except OSError:
+            # the worker reports the missing file
+            yield job
+            continue
+        job['cached'] = cache_lookup(cache, job['key'], columns)
+        yield job
+
+def cache_lookup(cache, key, columns):
+    '''
+        Returns the cached features for key if the entry has
+        every one of the columns
+    '''
+    feats = cache.get(key)
+    if feats is None or any(name not in feats for name in columns):
+        return None
+    return feats
+
+def profiled_jobs(jobs):
+    '''
+        Marks each job to have the times of its stages recorded
+    '''
+    for job in jobs:
+        job['stages'] = {}
+        yield job
+
+def analysis_params(sr, f0_method=DEFAULT_F0_METHOD, frame_period=DEFAULT_FRAME_PERIOD,
+        res_type=DEFAULT_RESAMPLER):
+    '''
+        All parameters that change the outcome of the analysis
+        of an utterance. These are a part of the feature cache key.
+        An sr of None means that files are analysed at their own
+        sample rate.
+    '''
+    return {'sr': sr, 'exclude_silence': True, 'f0_method': f0_method,
+        'frame_period': frame_period, 'res_type': res_type}
+
+def analyze_utterance(job):
+    '''
+        Computes the features of the job for a single
+        <text, audio> pair, see utils.features. This is the
+        unit of work that is handed to the worker processes
+        and has to stay a module level function so it can be
+        pickled.
+    '''
+    if job['cached'] is not None:
+        return job['cached']
+    if job.get('read_error') is not None:
+        raise IOError(job['read_error'])
+    try:
+        token = job['token'] if job.get('token') is not None else read_token(job['token_path'])
+    except Exception as e:
+        raise IOError('A text from the index could not be found: %s' % e)
+    params = job['params']
+    if long_recording(job):
+        feats = segmented_features(job['audio_path'], token, params, params['segment_seconds'])
+        if 'stages' in job:
+            job['audio_seconds'] = feats['duration']
+        return feats
+    from .utils.audio import load_audio
+    inputs = {'token': token}
+    try:
+        if job.get('audio_at') is not None:
+            inputs['audio'], inputs['sr'], inputs['trimmed'] = packed_audio(job)
+        else:
+            source = io.BytesIO(job.pop('audio')) if job.get('audio') is not None else job['audio_path']
+            inputs['audio'], inputs['sr'] = load_audio(source, params['sr'], params['res_type'])
+    except Exception as e:
+        raise IOError('An audio file from the index could not be found: %s' % e)
+    if 'stages' in job:
+        job['audio_seconds'] = inputs['audio'].shape[0] / inputs['sr']
+    return extract(job['features'], inputs, params)
+
+def long_recording(job):
+    '''
+        Whether the audio file of the job is longer than the
+        segment_seconds of its analysis parameters and is
+        analysed in segments. Files soundfile can not read are
+        never analysed in segments.
+    '''
+    if 'long' not in job:
+        job['long'] = False
+        if job['params'].get('segment_seconds') is not None and job.get('audio_at') is None:
+            from .utils.audio import file_seconds
+            seconds = file_seconds(job['audio_path'])
+            job['long'] = seconds is not None and seconds > job['params']['segment_seconds']
+    return job['long']
+
+def packed_audio(job):
+    '''
+        The audio of a job read from its audio pack. The clip
+        is converted to float64 for the World estimators and
+        the trimmed clip is a view of the converted one.
+        Returns (audio, sr, trimmed).
+    '''
+    from .utils.audio_pack import open_audio_pack
+    clip, sr, (start, end) = open_audio_pack(job['audio_pack']).clip(job['audio_at'])
+    with stage('read'):
+        audio = clip.astype(np.float64)
+    return audio, sr, audio[start:end]
+
+def check_audio_pack(pack, params):
+    '''
+        Exits if the audio pack was not packed with the sample
+        rate and resampler of the analysis parameters or with
+        other trim parameters than the analysis uses
+    '''
+    if pack.sr != params['sr'] or (pack.sr is not None and pack.res_type != params['res_type']):
+        print('The audio pack %s was packed at %s with %s, not at %s with %s, pack it again'
+            % (pack.path, pack.sr or 'the rate of each file', pack.res_type,
+            params['sr'] or 'the rate of each file', params['res_type']))
+        sys.exit()
+    if pack.trim_params != (TRIM_TOP_DB, FRAME_LENGTH, HOP_LENGTH):
+        print('The audio pack %s was trimmed with other parameters than the analysis uses, pack it again'
+            % pack.path)
+        sys.exit()
+
+def load_pack_clip(job):
+    '''
+        Decodes, resamples and finds the trim bounds of a
+        single audio file for pack_audio. The bounds are found
+        on the float32 audio as it is packed, so they are the
+        ones a run would find on it. Returns (audio_id, audio,
+        sr, trim_bounds, error) where error is None on success.
+    '''
+    from .utils.audio import frame_energy, load_audio
+    path, audio_id, params = job
+    try:
+        audio, sr = load_audio(path, params['sr'], params['res_type'])
+    except Exception as e:
+        return audio_id, None, None, None, str(e).replace('\n', ' ')
+    audio = audio.astype(np.float32)
+    return audio_id, audio, sr, frame_energy(audio, sr).trim_bounds(), None
+
+def pack_audio(wav_dir, index_path, out_path, sr, wav_ind=1, res_type=DEFAULT_RESAMPLER, workers=1,
+        shard_bytes=DEFAULT_SHARD_BYTES):
+    '''
+        Writes the audio of every audio file in the index to an
+        audio pack at out_path, see utils.audio_pack, resampled
+        to sr with res_type unless sr is None. wav_ind is the
+        index of the audio file in a line of the index. The
+        files are decoded by a pool of workers processes.
+
+        Files that can not be decoded are listed in
+        pack_errors.tsv in out_path. Returns the number of
+        files packed.
+    '''
+    i_handler = IndexHandler(None, {'wav_ind': wav_ind, 'txt_ind': wav_ind})
+    params = analysis_params(sr, res_type=res_type)
+    audio_ids = []
+    seen = set()
+    with open(index_path, 'rb') as f:
+        for line in index_lines(f):
+            if not line.strip():
+                continue
+            i_handler.set_current(line)
+            audio_id = i_handler.get_audio_fid()
+            if audio_id not in seen:
+                seen.add(audio_id)
+                audio_ids.append(audio_id)
+    jobs = [(os.path.join(wav_dir, audio_id), audio_id, params) for audio_id in audio_ids]
+    writer = AudioPackWriter(out_path, sr, res_type, (TRIM_TOP_DB, FRAME_LENGTH, HOP_LENGTH), shard_bytes)
+    num_errors = 0
+    with open(os.path.join(out_path, 'pack_errors.tsv'), 'w') as errfile, worker_pool(workers) as pool:
+        for audio_id, audio, clip_sr, bounds, error in tqdm(pool.imap(load_pack_clip, jobs,
+                chunksize=chunk_size(len(jobs), workers)), total=len(jobs)):
+            if error is not None:
+                errfile.write('%s\t%s\n' % (audio_id, error))
+                num_errors += 1
+            else:
+                writer.add(audio_id, audio, clip_sr, bounds)
+    writer.close()
+    if num_errors > 0:
+        print('%d audio files could not be packed, see %s' % (num_errors, os.path.join(out_path, 'pack_errors.tsv')))
+    return writer.count
+
+def prefetch_job(job):
+    '''
+        Reads the token and the audio bytes of a job ahead of
+        its analysis. This runs in the reader threads of a run.
+        A file that can not be read is noted on the job and
+        reported when the job is analysed.
+    '''
+    if job['cached'] is not None or job.get('read_error') is not None:
+        return job
+    try:
+        with recording(job.get('stages')), stage('read'):
+            if job.get('token') is None:
+                job['token'] = read_token(job['token_path'])
+            # a long recording is decoded in segments by the worker
+            if job.get('audio_at') is None and not long_recording(job):
+                with open(job['audio_path'], 'rb') as f:
+                    job['audio'] = f.read()
+    except Exception as e:
+        kind = 'An audio file' if 'token' in job else 'A text'
+        job['read_error'] = '%s from the index could not be found: %s' % (kind, e)
+    return job
+
+def prep_audio(path, params):
+    '''
+        Loads and trims an audio file as set in the analysis
+        parameters. Returns the tuple (audio, sr, energy) where
+        energy is the FrameEnergy of the untrimmed audio.
+    '''
+    from .utils.audio import frame_energy, load_audio
+    audio, sr = load_audio(path, params['sr'], params['res_type'])
+    with stage('energy_trim'):
+        energy = frame_energy(audio, sr)
+        return energy.trim(audio), sr, energy
+
+def safe_analyze_utterance(job):
+    '''
+        Same as analyze_utterance but errors are returned instead
+        of raised, so a single bad utterance does not stop a run.
+        Returns (job, features, error) where error is None on
+        success.
+    '''
+    with recording(job.get('stages')):
+        try:
+            feats = analyze_utterance(job)
+            error = None
+        except Exception as e:
+            feats = None
+            error = str(e).replace('\n', ' ')
+    if job.get('stages'):
+        job['worker_rss_mb'] = peak_rss_mb()
+    # the audio is not sent back from the worker
+    job.pop('audio', None)
+    return job, feats, error
+
+def read_token(path):
+    '''
+        Reads a text token and returns it lower cased
+    '''
+    with open(path, 'r') as f:
+        return f.read().lower()
+
+class MetaWriter:
+    '''
+        The last stage of a run. Writes each analysed utterance
+        to the meta file, the run statistics, the meta store and
+        the feature cache, or to the error log if it failed, and
+        flushes them all to disk every flush_every utterances.
+        The meta has the given value columns, see
+        utils.features.feature_columns. The stages of each
+        utterance are added to profile, a
+        utils.profile.RunProfile, if it is given. The ids of
+        failed, the utterances already in the error log, that
+        are written again are kept in retried.
+    '''
+    def __init__(self, outfile, errfile, stats, stats_path, store, cache, flush_every, columns,
+            profile=None, failed=()):
+        self._outfile = outfile
+        self._errfile = errfile
+        self._stats = stats
+        self._stats_path = stats_path
+        self._store = store
+        self._cache = cache
+        self._flush_every = flush_every
+        self._columns = columns
+        self._profile = profile
+        self._failed = failed
+        self.retried = set()
+        self.count = 0
+        self.num_errors = 0
+
+    def write(self, result):
+        job = result[0]
+        if self._profile is None:
+            self._write(result)
+            return
+        # utterances from the cache are counted but not timed
+        stages = job.get('stages') if job['cached'] is None else None
+        with recording(stages), stage('write'):
+            self._write(result)
+        self._profile.add(job['token_fid'], stages, job.get('audio_seconds', 0.0), job.get('worker_rss_mb'))
+
+    def _write(self, result):
+        job, feats, error = result
+        if job['token_fid'] in self._failed:
+            self.retried.add(job['token_fid'])
+        if error is None:
+            self._outfile.write(meta_line(job['token_fid'], job['reader'], *[feats[col] for col in self._columns]))
+            self._stats.update(job['reader'], rounded(feats['spr']), rounded(feats['f0']))
+            if self._store is not None:
+                self._store.write(job['token_fid'], job['reader'],
+                    {col: rounded(feats[col]) for col in self._columns})
+            if self._cache is not None and job['cached'] is None:
+                self._cache.put(job['key'], feats)
+        else:
+            self._errfile.write('%s\t%s\t%s\n' % (job['token_fid'], job['reader'], error))
+            self.num_errors += 1
+        self.count += 1
+        if self.count % self._flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        sync_files(self._outfile, self._errfile)
+        self._stats.save(self._stats_path)
+        if self._store is not None:
+            self._store.flush()
+        if self._cache is not None:
+            self._cache.commit()
+
+class SerialPool:
+    '''
+        Stand-in for multiprocessing.Pool when only a single
+        worker is requested, so the analysis runs in the main
+        process without any pickling overhead.
+    '''
+    def imap(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+def worker_pool(workers):
+    if workers is None or workers <= 1:
+        return SerialPool()
+    return multiprocessing.Pool(workers)
+
+def chunk_size(total, workers):
+    '''
+        Number of jobs sent to a worker at a time. Small enough
+        for the progress bar to stay responsive but large enough
+        to keep the inter-process overhead low.
+    '''
+    if workers is None or workers <= 1:
+        return 1
+    return max(1, min(64, total // (workers * 16)))
+
+def gen_index(paths, name_reg, workers=1):
+    '''
+        Writes a line index of every <text, audio> pair in the
+        text and wav directory trees. Text tokens without audio
+        and audio without a text token are written to
+        paths['missing_file'] instead of the index.
+    '''
     # iterate all text tokens to get filenames
     try:
-        outfile = open(paths['out_file'], 'w')
+        outfile = open(paths['out_file'], 'w', buffering=2**20)
+        missing_file = open(paths['missing_file'], 'w', buffering=2**20)
     except Exception as e:
         print('Could not complete path to out_file. Path likely wrong')
         print('Error: %s' % e)
-        sys.exit()    
-    handler = ReverseIndexHandler(name_reg)
-    for fn in os.listdir(paths['text']):
-        outfile.write('%s \n' % handler.get_line(fn))
+        sys.exit()
+    reg = gen_line_reg(name_reg)
+    text_files = walk_files(paths['text'], workers)
+    wav_files = walk_files(paths['wavs'], workers)
+    counts = {'paired': 0, 'no audio': 0, 'no text': 0, 'name mismatch': 0, 'ambiguous': 0}
+    with outfile, missing_file:
+        for fn, wav_fn, rm, problem in pair_files(text_files, wav_files, reg):
+            if problem is None:
+                outfile.write('%s \n' % gen_index_line(rm, fn, wav_fn))
+                counts['paired'] += 1
+                continue
+            missing_file.write('%s\t%s\n' % (fn if fn is not None else wav_fn, problem))
+            if fn is None:
+                counts['no text'] += 1
+            elif rm is None:
+                counts['name mismatch'] += 1
+            elif problem == 'no audio':
+                counts['no audio'] += 1
+            else:
+                counts['ambiguous'] += 1
+    print('Text tokens:                  %d' % len(text_files))
+    print('Audio files:                  %d' % len(wav_files))
+    print('Pairs:                        %d' % counts['paired'])
+    print('Tokens without audio:         %d' % counts['no audio'])
+    print('Tokens with ambiguous audio:  %d' % counts['ambiguous'])
+    print('Tokens not matching names:    %d' % counts['name mismatch'])
+    print('Audio without tokens:         %d' % counts['no text'])
     print('Index file is ready at: ', paths['out_file'])
+    if sum(counts.values()) > counts['paired']:
+        print('Unpaired files are listed at: ', paths['missing_file'])
 
-def check(wav_path, text_path, sr):
+def check(wav_path, text_path, sr, cache=None, f0_method=DEFAULT_F0_METHOD,
+        frame_period=DEFAULT_FRAME_PERIOD, res_type=DEFAULT_RESAMPLER, compare_f0=False, profile=False,
+        features=None, token_pack=None, segment_seconds=None):
     '''
         Do a simple (Command line style) check on a single <wav,text>
-        pair.
+        pair. The named features are shown along with the
+        CHECK_FEATURES, see utils.features.
+
+        If segment_seconds is given, the audio is a long
+        recording that is analysed one segment at a time, see
+        utils.audio.segmented_F0, and only its duration, speech
+        rate and F0 are shown.
+
+        If compare_f0 is set, every F0 method is also timed on
+        the pair. If profile is set, the time of each stage of
+        the analysis is shown, see utils.profile. If token_pack
+        is the path of a token pack, text_path is the id of the
+        token in it.
     '''
-    token = ''
-    with open(text_path, 'r') as f:
-        for line in f: token += line.lower()
-    audio = prep_wav(wav_path, sr)
-    spr = speech_rate(audio, token)
-    F0 = dio_F0(audio, sr, exclude_silence=True)
+    run_profile = RunProfile() if profile else None
+    stages = {} if profile else None
+    audio_seconds = 0.0
+    features = select_features(features, CHECK_FEATURES)
+    columns = feature_columns(features)
+    with recording(stages):
+        with stage('read'):
+            if token_pack is None:
+                token = read_token(text_path)
+            else:
+                token = TokenPack(token_pack).get(text_path)
+                if token is None:
+                    print('%s is not in the token pack %s' % (text_path, token_pack))
+                    sys.exit()
+                token = token.lower()
+        params = analysis_params(sr, f0_method, frame_period, res_type)
+        feats = None
+        if segment_seconds is not None:
+            try:
+                feats = segmented_features(wav_path, token, params, segment_seconds)
+            except ValueError as e:
+                print(e)
+                sys.exit()
+            audio_seconds = feats['duration']
+        elif cache is not None:
+            key = cache_key(wav_path, text_path, params, token if token_pack is not None else None)
+            feats = cache_lookup(cache, key, columns)
+        if feats is None:
+            from .utils.audio import load_audio
+            inputs = {'token': token}
+            inputs['audio'], inputs['sr'] = load_audio(wav_path, params['sr'], params['res_type'])
+            audio_seconds = inputs['audio'].shape[0] / inputs['sr']
+            feats = extract(features, inputs, params)
+            if cache is not None:
+                cache.put(key, feats)
+                cache.commit()
 
     print('------------------------------------')
     print('Text: ', token)
-    print('Speek duration: %0.4f' % get_duration(audio))
-    print('Number of syllables: ', naive_syllable_count(token))
-    print('Speech rate: %0.4f' % spr)
-    print('F0:          %0.4f' % F0)
+    print('Speek duration: %0.4f' % feats['duration'])
+    print('Number of syllables: ', feats['syllables'])
+    print('Speech rate: %0.4f' % feats['spr'])
+    if segment_seconds is None:
+        print('Speech ratio: %0.4f' % feats['speech_ratio'])
+        print('Speech rate without pauses: %0.4f' % feats['pause_spr'])
+    print('F0:          %0.4f' % feats['f0'])
+    if segment_seconds is not None:
+        print('F0 std:      %0.4f' % feats['f0_std'])
+    else:
+        for col in columns[len(feature_columns(CHECK_FEATURES)):]:
+            print('%s: %0.4f' % (col, feats[col]))
     print('------------------------------------')
+    if profile:
+        if audio_seconds == 0.0:
+            print('The features were found in the cache, only reading the token was timed')
+        run_profile.add(text_path, stages, audio_seconds)
+        print_report(run_profile.report())
+        print('------------------------------------')
+    if compare_f0:
+        print('Method          F0 (Hz)   Time (s)   x Realtime')
+        from .utils.audio import time_F0_methods
+        audio, sr, _ = prep_audio(wav_path, params)
+        for r in time_F0_methods(audio, sr, frame_period):
+            print('%-14s %8.3f %10.4f %12.1f' % (r['method'], r['f0'], r['seconds'], r['realtime']))
+        print('------------------------------------')
 
-def num_lines(file_path):
-    fp = open(file_path, "r+")
-    buf = mmap.mmap(fp.fileno(), 0)
-    count = 0
-    while buf.readline():
-        count += 1
-    return count
+def segmented_features(wav_path, token, params, segment_seconds):
+    '''
+        The duration, syllables, speech rate and F0 of a long
+        recording, analysed in segments of segment_seconds. The
+        duration is that of the trimmed recording, as for a
+        recording that is analysed whole.
+    '''
+    from .utils.audio import naive_syllable_count, segmented_F0
+    stats, duration = segmented_F0(wav_path, params['sr'], params['res_type'], params['f0_method'], params['frame_period'],
+        params['exclude_silence'], segment_seconds)
+    if stats.n == 0:
+        raise ValueError('No voiced frames were found')
+    syllables = naive_syllable_count(token)
+    return {'duration': duration, 'syllables': syllables, 'spr': syllables / duration,
+        'f0': stats.mean, 'f0_std': float(stats.stddev())}
 
-def write_summary(meta_path, summary_dir, outlier_threshold):
+def write_summary(meta_path, summary_dir, outlier_threshold, workers=1, plot_style=DEFAULT_PLOT_STYLE,
+        outlier_method=DEFAULT_OUTLIER_METHOD, memory_cap=None):
     # OS related operations
     os.makedirs(summary_dir, exist_ok=True)
     plot_dir = os.path.join(summary_dir, 'plots')
@@ -117,43 +836,269 @@ def write_summary(meta_path, summary_dir, outlier_threshold):
     os.makedirs(plot_dir, exist_ok=True)
     os.makedirs(reader_dir, exist_ok=True)
 
-    reader_set = ReaderSet(meta_path)
-    reader_set.save_hist_for_all_readers(reader_dir)
-    reader_set.set_outliers(keep_size=outlier_threshold)
-    reader_set.save_spr_vs_fo_scatter(path=plot_dir, also_clean=True)
-    reader_set.write_index(summary_dir)
-    reader_set.write_summary(summary_dir)
+    with open_reader_set(meta_path, summary_dir, memory_cap) as reader_set:
+        reader_set.save_hist_for_all_readers(reader_dir, workers)
+        reader_set.set_outliers(keep_size=outlier_threshold, method=outlier_method)
+        reader_set.save_spr_vs_fo_scatter(path=plot_dir, also_clean=True, style=plot_style)
+        reader_set.write_index(summary_dir)
+        reader_set.write_summary(summary_dir)
 
-def outliers(meta_path, out_path, outlier_threshold):
-    reader_set = ReaderSet(meta_path)  
-    reader_set.set_outliers(keep_size=outlier_threshold)
-    reader_set.write_index(out_path)
+@contextlib.contextmanager
+def open_reader_set(meta_path, work_dir, memory_cap=None):
+    '''
+        A ReaderSet of the meta or, with a memory_cap in MB, a
+        StreamingReaderSet that keeps its temporary files in a
+        directory under work_dir until the block ends
+    '''
+    if memory_cap is None:
+        yield ReaderSet(meta_path)
+        return
+    with tempfile.TemporaryDirectory(prefix='metawave-', dir=work_dir) as tmp_dir:
+        yield StreamingReaderSet(meta_path, tmp_dir, stream_chunk_rows(memory_cap))
+
+def stream_chunk_rows(memory_cap):
+    '''
+        The rows of a chunk of a StreamingReaderSet that keep
+        its memory around memory_cap MB, a multiple of the
+        CHUNK_SIZE the outlier statistics are summed over
+    '''
+    return max(int(memory_cap * 2**20) // STREAM_ROW_BYTES // CHUNK_SIZE, 1) * CHUNK_SIZE
+
+def write_stats_summary(stats_path, summary_dir, workers=1):
+    '''
+        Writes the summary and the per reader histograms from
+        the statistics file of a run, which is instant compared
+        to reading the whole meta file and can be done while the
+        run is still going. The outlier ranking is not a part of
+        this summary.
+    '''
+    reader_dir = os.path.join(summary_dir, 'plots', 'readers')
+    os.makedirs(reader_dir, exist_ok=True)
+
+    from .utils.plots import histogram_path, render_all, save_binned_histogram
+    stats = MetaStats.load(stats_path)
+    render_all([(save_binned_histogram, (histogram_path(reader_dir, r.get_id()), r.get_id(),
+        r.spr_hist, r.f0_hist)) for r in stats.readers.values()], workers)
+    with open(os.path.join(summary_dir, 'summary.log'), 'w') as out_file:
+        write_reader_summary(out_file, stats.get_num_samples(), list(stats.readers.values()))
+        out_file.write('Outliers are not computed from run statistics, see the outliers command \n')
+
+def write_reader_summary(out_file, num_samples, readers):
+    '''
+        Writes the per reader part of summary.log. readers
+        can be Reader or ReaderStats objects.
+    '''
+    out_file.write('===========================================\n')
+    out_file.write('Summary - Meta information \n')
+    out_file.write('===========================================\n')
+    out_file.write('Number of samples: %d \n' % num_samples)
+    out_file.write('Number of readers: %d \n' % len(readers))
+    out_file.write('Number of samples per reader:\n')
+    for reader in readers:
+        out_file.write('%s : %d\n' %(reader.get_id(), reader.get_num_samples()))
+    out_file.write('===========================================\n')
+    for reader in readers:
+        out_file.write('Reader: %s \n' % reader.get_id())
+        out_file.write('Speech rate: %0.3f +- %0.3f \n' % (reader.get_spr_mean(), reader.get_spr_stddev()))
+        out_file.write('Fundm. freq: %0.3f +- %0.3f \n' % (reader.get_f0_mean(), reader.get_f0_stddev()))
+    out_file.write('===========================================\n')
+
+def write_outlier_summary(out_file, num_outliers, outlier_method, readers):
+    '''
+        Writes the outlier part of summary.log
+    '''
+    out_file.write('Number of outliers: %d \n' % num_outliers)
+    out_file.write('Outlier scoring: %s \n' % outlier_method)
+    out_file.write('Per speaker: \n')
+    for reader in readers:
+        out_file.write('%s : %d \n' %(reader.get_id(), reader.get_num_outliers()))
+
+def outliers(meta_path, out_path, outlier_threshold, outlier_method=DEFAULT_OUTLIER_METHOD, memory_cap=None):
+    with open_reader_set(meta_path, out_path, memory_cap) as reader_set:
+        reader_set.set_outliers(keep_size=outlier_threshold, method=outlier_method)
+        reader_set.write_index(out_path)
+
+def load_meta(meta_path):
+    '''
+        Loads a meta.tsv file or a meta store directory into
+        parallel arrays. Returns the tuple
+        (utt_ids, reader_ids, reader_codes, spr, f0)
+        where reader_ids holds the reader of each code in the
+        order the readers first appear in the meta.
+    '''
+    if is_store(meta_path):
+        store = MetaStore(meta_path)
+        n = len(store)
+        return (store.utt_ids, store.reader_ids, np.asarray(store.reader_codes[:n]),
+            store.values['spr'][:n], store.values['f0'][:n])
+    utt_ids = []
+    readers = {}
+    codes = []
+    sprs = []
+    f0s = []
+    with open(meta_path, 'r') as meta:
+        for line in meta:
+            # the columns of features other than spr and f0 are not used
+            [file_id, reader, spr, f0] = line.split('\t')[:4]
+            utt_ids.append(file_id)
+            codes.append(readers.setdefault(reader, len(readers)))
+            sprs.append(spr)
+            f0s.append(f0)
+    return (utt_ids, list(readers), np.array(codes, dtype=np.int32),
+        np.array(sprs, dtype=np.float64), np.array(f0s, dtype=np.float64))
+
+def convert_meta(meta_path, out_path, features=None):
+    '''
+        Converts a meta.tsv file to a meta store directory
+        or the other way around. features are those the meta
+        was written with on top of spr and f0, they name the
+        columns of the store.
+    '''
+    if is_store(meta_path):
+        count = store_to_tsv(meta_path, out_path)
+    else:
+        try:
+            count = tsv_to_store(meta_path, out_path, feature_columns(select_features(features)))
+        except ValueError as e:
+            print(e)
+            sys.exit()
+    print('%d rows were written to %s' % (count, out_path))
+
+def find_shards(path):
+    '''
+        The shard files of path, <root>-i-of-N<ext> for the
+        path <root><ext>, in shard order. Exits if shards are
+        missing or shards of different runs are mixed.
+    '''
+    root, ext = os.path.splitext(path)
+    shard_re = re.compile(re.escape(os.path.basename(root)) + r'-(\d+)-of-(\d+)' + re.escape(ext) + '$')
+    shards = {}
+    for fn in os.listdir(os.path.dirname(path) or '.'):
+        match = shard_re.match(fn)
+        if match is not None:
+            shards[(int(match.group(2)), int(match.group(1)))] = os.path.join(os.path.dirname(path), fn)
+    counts = set(n for n, _ in shards)
+    if len(counts) > 1:
+        print('Shards of runs with %s shards were found next to %s, keep only one of them'
+            % (' and '.join(str(n) for n in sorted(counts)), path))
+        sys.exit()
+    if len(counts) == 0:
+        return []
+    n = counts.pop()
+    missing = [i for i in range(n) if (n, i) not in shards]
+    if missing:
+        print('Shards %s of %d are missing for %s' % (', '.join(str(i) for i in missing), n, path))
+        sys.exit()
+    return [shards[(n, i)] for i in range(n)]
+
+def concat_lines(in_paths, out_path, chunk_size=2**20):
+    '''
+        Concatenates text files, dropping a last line that
+        was only partially written. Returns the number of
+        files that had such a line.
+    '''
+    num_partial = 0
+    with open(out_path, 'wb') as out:
+        for path in in_paths:
+            with open(path, 'rb') as f:
+                size = os.path.getsize(path)
+                end = last_line_end(f, size, chunk_size)
+                if end < size:
+                    num_partial += 1
+                f.seek(0)
+                remaining = end
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+    return num_partial
+
+def last_line_end(f, size, chunk_size=2**20):
+    '''
+        The offset just after the last newline of the open
+        binary file f, found by reading it backwards
+    '''
+    pos = size
+    while pos > 0:
+        start = max(0, pos - chunk_size)
+        f.seek(start)
+        nl = f.read(pos - start).rfind(b'\n')
+        if nl >= 0:
+            return start + nl + 1
+        pos = start
+    return 0
+
+def merge_shards(paths):
+    '''
+        Joins the meta files, error logs and statistics of a
+        sharded run, e.g. meta-0-of-4.tsv ... meta-3-of-4.tsv,
+        into the files of an unsharded run. Shards hold
+        consecutive lines of the index, so concatenating them
+        in shard order gives the rows in index order, as a
+        single run would have written them.
+    '''
+    meta_shards = find_shards(paths['out_file'])
+    if len(meta_shards) == 0:
+        print('No shards of %s were found' % paths['out_file'])
+        sys.exit()
+    num_partial = concat_lines(meta_shards, paths['out_file'])
+    if num_partial > 0:
+        print('%d shards ended in a partially written row, which was left out' % num_partial)
+    concat_lines(find_shards(paths['error_file']), paths['error_file'])
+
+    # the statistics of a shard that was killed can lag behind its
+    # meta file, then they are computed from the merged meta instead
+    num_rows = count_lines(paths['out_file'])
+    stats_shards = find_shards(paths['stats'])
+    stats = MetaStats()
+    if len(stats_shards) == len(meta_shards):
+        for stats_path in stats_shards:
+            stats.merge(MetaStats.load(stats_path))
+    if stats.get_num_samples() != num_rows:
+        stats = stats_from_meta(paths['out_file'])
+    stats.save(paths['stats'])
+
+    store_shards = find_shards(paths['store'])
+    if len(store_shards) > 0:
+        tsv_to_store(paths['out_file'], paths['store'], MetaStore(store_shards[0]).columns)
+        print('The meta store is available at ', paths['store'])
+    print('%d rows of %d shards were merged into %s' % (num_rows, len(meta_shards), paths['out_file']))
 
 class ReaderSet:
+    '''
+        The meta information of a whole dataset, held as
+        parallel arrays with one entry per utterance. The
+        utterances are ordered reader by reader, in the order
+        the readers first appear in the meta, so each reader
+        is a contiguous slice of the arrays.
+    '''
     def __init__(self, meta_path):
-        self._num_samples = 0
-        self._num_readers = 0
-        self._mean_f0 = 0.0
-        self._mean_spr = 0.0
-        self._readers = []
+        utt_ids, reader_ids, codes, spr, f0 = load_meta(meta_path)
+        # the statistics are taken in the order of the meta, as
+        # a StreamingReaderSet does, so both give the same values
+        X = np.column_stack([spr, f0])
+        self._chunks = lambda: iter([(codes, X)])
+        self._num_readers = len(reader_ids)
+        self._moments = group_moments(self._chunks, self._num_readers, 2)
+        order = np.argsort(codes, kind='stable')
+        self._utt_ids = utt_ids
+        self._order = order
+        self._codes = codes[order]
+        self._spr = np.asarray(spr)[order]
+        self._f0 = np.asarray(f0)[order]
+        self._num_samples = self._codes.shape[0]
+        self._outlier_method = None
+        self._err = np.zeros(self._num_samples)
+        self._is_outlier = np.zeros(self._num_samples, dtype=bool)
         self._num_outliers = 0
-        with open(meta_path, 'r') as meta:
-            f0_ttl = 0.0
-            spr_ttl = 0.0
-            readers = defaultdict(dict)
-            for line in meta:
-                self._num_samples += 1
-                [file_id, reader, spr, f0] = line.split('\t')
-                spr = float(spr)
-                f0 = float(f0)
-                readers[reader][file_id] = {'spr': spr, 'f0': f0}
-                spr_ttl += spr
-                f0_ttl += f0
-            self._num_readers = len(readers.keys())
-            self._mean_f0 = f0_ttl / self._num_samples
-            self._mean_spr = spr_ttl / self._num_samples
-            for reader_id, utts in readers.items():
-                self._readers.append(Reader(reader_id, utts))
+
+        counts, means, cov, _ = self._moments
+        std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        self._reader_spr_mean, self._reader_f0_mean = means[:, 0], means[:, 1]
+        self._reader_spr_std, self._reader_f0_std = std[:, 0], std[:, 1]
+        ends = np.cumsum(counts)
+        self._readers = [Reader(self, code, reader_ids[code], ends[code] - counts[code], ends[code])
+            for code in range(self._num_readers)]
 
     def get_num_samples(self):
         return self._num_samples
@@ -164,123 +1109,69 @@ class ReaderSet:
     def get_num_outliers(self):
         return self._num_outliers
 
+    def get_utt_id(self, i):
+        '''
+            The id of the i-th utterance in reader order
+        '''
+        return self._utt_ids[self._order[i]]
+
     def get_dataform(self, clean=False):
         data = {}
         for reader in self._readers:
             data[reader._id] = reader.get_dataform(clean=clean)
         return data
-    
-    def get_as_list(self):
-        '''
-            Returns the data in the form
-            [{'reader_id', 'utt_id', 'spr', 'f0' (maybe 'err')}, ...]
-            for all utts for all readers
-        '''
-        data = [reader.get_as_list() for reader in self._readers]
-        return list(itertools.chain.from_iterable(data))
-
-    def save_spr_vs_fo_scatter(self, path, also_clean=True):
-        all_data = self.get_dataform()
-        fig = plt.figure()
-        ax = plt.subplot(111)
-        for reader, vals in all_data.items():
-            sprs = []
-            f0s = []
-            for utt_id, utt_info in vals.items():
-                sprs.append(utt_info['spr'])
-                f0s.append(utt_info['f0'])
-            plt.scatter(sprs, f0s, s=0.4, label=reader)
-        plt.xlabel('Speech rate (syll/sec)')
-        plt.ylabel('F0 (Hz)')
-        lgnd = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        sctr_xlim = plt.xlim()
-        sctr_ylim = plt.ylim()
-        plt.savefig(os.path.join(path, 'reader_compare'), bbox_extra_artists=(lgnd,), bbox_inches='tight')
-        plt.cla()
-
-        if also_clean:
-            # Also plot a scatter plot for none outliers results
-            clean_data = self.get_dataform(clean=True)
-            fig = plt.figure()
-            ax = plt.subplot(111)
-            for reader, vals in clean_data.items():
-                sprs = []
-                f0s = []
-                for utt_id, utt_info in vals.items():
-                    sprs.append(utt_info['spr'])
-                    f0s.append(utt_info['f0'])
-                plt.scatter(sprs, f0s, s=0.4, label=reader)
-            plt.xlabel('Speech rate (syll/sec)')
-            plt.ylabel('F0 (Hz)')
-            lgnd = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-            plt.xlim(sctr_xlim)
-            plt.ylim(sctr_ylim)
-            plt.savefig(os.path.join(path, 'reader_compare_clean'), bbox_extra_artists=(lgnd,), bbox_inches='tight')
-            plt.cla()
-
-    def set_outliers(self, keep_size=0.9):
+
+    def save_spr_vs_fo_scatter(self, path, also_clean=True, style=DEFAULT_PLOT_STYLE):
+        from .utils.plots import save_reader_compare
+        readers = [(r.get_id(), r.get_all_spr(), r.get_all_f0()) for r in self._readers]
+        is_outlier = [self._is_outlier[r._slice] for r in self._readers] if also_clean else None
+        save_reader_compare(path, readers, is_outlier, style)
+
+    def set_outliers(self, keep_size=0.9, method=DEFAULT_OUTLIER_METHOD):
         '''
-            Finds the mean of F0 and speech rate of the
-            whole dataset and returns the keep_size part
-            of the dataset with the lowest error in terms
-            of those two variables
+            Scores the speech rate and F0 of every utterance
+            with the given method, see utils.outliers, and
+            keeps the keep_size part of the dataset with the
+            lowest error
         '''
-        self._num_outliers = (1 - keep_size) * self.get_num_samples()
-        for reader in self._readers:
-            reader.set_err(self._mean_spr, self._mean_f0)
-    
-        datalist = self.get_as_list()
-        datalist.sort()
-        for i in range(int(keep_size * self.get_num_samples()), self.get_num_samples()):
-            datalist[i].make_outlier()
+        self._outlier_method = method
+        if self._num_samples > 0:
+            score = outlier_scorer(method, self._chunks, self._num_readers, self._moments)
+            [(codes, X)] = self._chunks()
+            self._err = score(codes, X)[self._order]
+        self._is_outlier = select_outliers(self._err, int(keep_size * self.get_num_samples()))
+        self._num_outliers = int(np.count_nonzero(self._is_outlier))
 
     def write_index(self, path):
-        outlier_index = open(os.path.join(path, 'outlier_index.txt'), 'w')
-        clean_index = open(os.path.join(path, 'clean_index.txt'), 'w')
-        for reader in self._readers:
-            for utt in reader._utts:
-                if utt.is_outlier():
-                    outlier_index.write('%s\tWeighted error: %0.3f\n' %(utt.get_id(), utt.get_err()))
+        with open(os.path.join(path, 'outlier_index.txt'), 'w') as outlier_index, \
+                open(os.path.join(path, 'clean_index.txt'), 'w') as clean_index:
+            for i in range(self._num_samples):
+                if self._is_outlier[i]:
+                    outlier_index.write('%s\tWeighted error: %0.3f\n' %(self.get_utt_id(i), self._err[i]))
                 else:
-                    clean_index.write('%s\n' %(utt.get_id()))
+                    clean_index.write('%s\n' %(self.get_utt_id(i)))
     
     def write_summary(self, path):
         with open(os.path.join(path,'summary.log'), 'w') as out_file:
-            out_file.write('===========================================\n')
-            out_file.write('Summary - Meta information \n')
-            out_file.write('===========================================\n')
-            out_file.write('Number of samples: %d \n' %self.get_num_samples())
-            out_file.write('Number of readers: %d \n' % self.get_num_readers())
-            out_file.write('Number of samples per reader:\n')
-            for reader in self._readers:
-                out_file.write('%s : %d\n' %(reader.get_id(), reader.get_num_samples()))
-            out_file.write('===========================================\n')
-            for reader in self._readers:
-                out_file.write('Reader: %s \n' % reader.get_id())
-                out_file.write('Speech rate: %0.3f +- %0.3f \n' % (reader.get_spr_mean(), reader.get_spr_stddev()))
-                out_file.write('Fundm. freq: %0.3f +- %0.3f \n' % (reader.get_f0_mean(), reader.get_f0_stddev()))
-            out_file.write('===========================================\n')
-            out_file.write('Number of outliers: %d \n' % self.get_num_outliers())
-            out_file.write('Per speaker: \n')
-            for reader in self._readers:
-                out_file.write('%s : %d \n' %(reader.get_id(), reader.get_num_outliers()))
-
-    def save_hist_for_all_readers(self, output_dir):
-        for reader in self._readers:
-            reader.save_histogram(output_dir)
+            write_reader_summary(out_file, self.get_num_samples(), self._readers)
+            write_outlier_summary(out_file, self.get_num_outliers(), self._outlier_method, self._readers)
+
+    def save_hist_for_all_readers(self, output_dir, workers=1):
+        from .utils.plots import histogram_path, render_all, save_histogram
+        render_all([(save_histogram, (histogram_path(output_dir, r.get_id()), r.get_id(),
+            r.get_all_spr(), r.get_all_f0())) for r in self._readers], workers)
 
 class Reader:
     '''
-        utts is a dictionary with the format
-        { utterance_id:{
-                'f0': float,
-                'spr': float
-        }}
+        A view of the utterances of a single reader, the
+        slice [start, stop) of the arrays of a ReaderSet.
     '''
-    def __init__(self, reader_id, utts):
+    def __init__(self, reader_set, code, reader_id, start, stop):
+        self._set = reader_set
+        self._code = code
         self._id = reader_id
-        self._utts = [Utt(utt_id, self._id, val['f0'], val['spr']) for utt_id, val in utts.items()]
-        self._num_samples = len(utts.keys())
+        self._slice = slice(start, stop)
+        self._num_samples = stop - start
 
     def get_id(self):
         return self._id
@@ -289,93 +1180,242 @@ class Reader:
         return self._num_samples
 
     def get_num_outliers(self):
-        return sum([1 if utt.is_outlier() else 0 for utt in self._utts])
+        return int(np.count_nonzero(self._set._is_outlier[self._slice]))
 
     def get_dataform(self, clean=False):
         data = {}
-        for utt in self._utts:
-            if not clean or not utt.is_outlier():
-                data.update(utt.get_dataform())
+        for i in range(self._slice.start, self._slice.stop):
+            if not clean or not self._set._is_outlier[i]:
+                data[self._set.get_utt_id(i)] = {
+                    'spr': self._set._spr[i],
+                    'f0': self._set._f0[i],
+                    'err': self._set._err[i]}
         return data
 
-    def get_as_list(self):
-        return self._utts
-    
-    def set_err(self, mean_spr, mean_f0):
-        for utt in self._utts:
-            utt.set_err(mean_spr, mean_f0)
-    
-    def get_all_f0(self):
-        return [utt.get_f0() for utt in self._utts]
+    def get_all_f0(self, clean=False):
+        return self._values(self._set._f0, clean)
 
-    def get_all_spr(self):
-        return [utt.get_spr() for utt in self._utts]
+    def get_all_spr(self, clean=False):
+        return self._values(self._set._spr, clean)
 
     def get_f0_mean(self):
-        return sum(self.get_all_f0())/self._num_samples
+        return self._set._reader_f0_mean[self._code]
     
     def get_spr_mean(self):
-        return (sum(self.get_all_spr()))/self._num_samples
+        return self._set._reader_spr_mean[self._code]
     
     def get_f0_stddev(self):
-        return np.std(self.get_all_f0())
+        return self._set._reader_f0_std[self._code]
 
     def get_spr_stddev(self):
-        return np.std(self.get_all_spr())
+        return self._set._reader_spr_std[self._code]
 
     def save_histogram(self, output_dir):
-        fig = plt.figure()
-        ax1 = fig.add_subplot(121)
-        ax1.hist(self.get_all_spr(), bins=50, facecolor='green', alpha=0.5, edgecolor='gray')
-        ax1.grid(True)
-        ax1.set_title('Speech rate (syll/sec)')
-        ax2 = fig.add_subplot(122)
-        ax2.hist(self.get_all_f0(), bins=50, facecolor='green', alpha=0.5, edgecolor='gray')
-        ax2.set_title('F0 (Hz)')
-        ax2.grid(True)
-        fig.suptitle('Info for %s' %self._id)
-        plt.savefig(os.path.join(output_dir, '%s-info' % self._id.replace('.','')))
-
-
-class Utt:
-    def __init__(self, utt_id, reader_id, f0, spr):
-        self._id = utt_id
-        self._reader_id = reader_id
-        self._f0 = f0
-        self._spr = spr
-        self._err = 0
-        self._is_outlier = False
-    
-    def set_err(self, mean_spr, mean_f0):
-        self._err = (np.abs(mean_spr - self._spr)/mean_spr)**2 + \
-            (np.abs(mean_f0 - self._f0)/mean_f0)**2
-    
-    def get_err(self):
-        return self._err
-    
-    def get_f0(self):
-        return self._f0
-    
-    def get_spr(self):
-        return self._spr
-    
-    def get_dataform(self):
-        return {
-            self._id:{
-                'spr':self._spr, 
-                'f0':self._f0, 
-                'err':self._err
-            }}
-    
-    def is_outlier(self):
-        return self._is_outlier
+        from .utils.plots import histogram_path, save_histogram
+        save_histogram(histogram_path(output_dir, self._id), self._id, self.get_all_spr(), self.get_all_f0())
+
+    def _values(self, values, clean):
+        values = values[self._slice]
+        if clean:
+            values = values[~self._set._is_outlier[self._slice]]
+        return values
+
+
+class StreamingReaderSet:
+    '''
+        The outliers and summary of a ReaderSet for a meta that
+        does not fit in memory. A meta.tsv is first copied to a
+        meta store in work_dir, chunk_rows lines at a time, and
+        every pass then reads chunk_rows rows of the memory
+        mapped store. Only the statistics of each reader are
+        held in memory, the reader order of the utterances and
+        their outlier marks are kept in files in work_dir.
+
+        The outlier index and summary.log are the same as those
+        of a ReaderSet. The plots are drawn from binned counts,
+        as those of write_stats_summary.
+    '''
+    def __init__(self, meta_path, work_dir, chunk_rows=CHUNK_SIZE):
+        if not is_store(meta_path):
+            store_path = os.path.join(work_dir, 'meta_store')
+            meta_columns_to_store(meta_path, store_path, chunk_rows)
+            meta_path = store_path
+        self._store = MetaStore(meta_path)
+        self._work_dir = work_dir
+        self._chunk_rows = chunk_rows
+        self._num_samples = len(self._store)
+        self._num_readers = len(self._store.reader_ids)
+        self._codes = self._store.reader_codes[:self._num_samples]
+        self._spr = self._store.values['spr'][:self._num_samples]
+        self._f0 = self._store.values['f0'][:self._num_samples]
+        self._order = None
+        self._outlier_method = None
+        self._score = lambda codes, X: np.zeros(codes.shape[0])
+        self._is_outlier = np.zeros(self._num_samples, dtype=bool)
+        self._num_outliers = 0
+        self._reader_outliers = np.zeros(self._num_readers, dtype=np.int64)
+
+        self._moments = group_moments(self._chunks, self._num_readers, 2)
+        counts, means, cov, _ = self._moments
+        std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        self._readers = [StreamingReader(self, code, reader_id, int(counts[code]), means[code], std[code])
+            for code, reader_id in enumerate(self._store.reader_ids)]
+
+    def get_num_samples(self):
+        return self._num_samples
+
+    def get_num_readers(self):
+        return self._num_readers
+
+    def get_num_outliers(self):
+        return self._num_outliers
+
+    def set_outliers(self, keep_size=0.9, method=DEFAULT_OUTLIER_METHOD):
+        '''
+            Same as ReaderSet.set_outliers, in a pass over the
+            scores for the cut and one in reader order to mark
+            the outliers
+        '''
+        self._outlier_method = method
+        self._score = outlier_scorer(method, self._chunks, self._num_readers, self._moments)
+        scores = lambda: (self._score(codes, X) for codes, X in self._chunks())
+        cut = keep_threshold(scores, int(keep_size * self.get_num_samples()))
+        if self._num_samples > 0:
+            self._is_outlier = np.memmap(os.path.join(self._work_dir, 'is_outlier.b1'), dtype=bool,
+                mode='w+', shape=(self._num_samples,))
+        self._reader_outliers[:] = 0
+        for rows, codes, X in self._reader_chunks():
+            is_outlier = cut.mark(self._score(codes, X))
+            self._is_outlier[rows] = is_outlier
+            self._reader_outliers += np.bincount(codes[is_outlier], minlength=self._num_readers)
+        self._num_outliers = int(self._reader_outliers.sum())
+
+    def write_index(self, path):
+        utt_ids = self._store.utt_ids
+        with open(os.path.join(path, 'outlier_index.txt'), 'w') as outlier_index, \
+                open(os.path.join(path, 'clean_index.txt'), 'w') as clean_index:
+            for rows, codes, X in self._reader_chunks():
+                err = self._score(codes, X)
+                for utt_id, is_outlier, e in zip(utt_ids.take(rows), self._is_outlier[rows].tolist(), err.tolist()):
+                    if is_outlier:
+                        outlier_index.write('%s\tWeighted error: %0.3f\n' %(utt_id, e))
+                    else:
+                        clean_index.write('%s\n' %(utt_id))
+
+    def write_summary(self, path):
+        with open(os.path.join(path,'summary.log'), 'w') as out_file:
+            write_reader_summary(out_file, self.get_num_samples(), self._readers)
+            write_outlier_summary(out_file, self.get_num_outliers(), self._outlier_method, self._readers)
 
-    def make_outlier(self):
-        self._is_outlier = True
+    def save_hist_for_all_readers(self, output_dir, workers=1):
+        from .utils.plots import histogram_path, render_all, save_binned_histogram
+        hists = [StreamingHistogram(*SPR_RANGE), StreamingHistogram(*F0_RANGE)]
+        counts = [np.zeros(self._num_readers * NUM_BINS, dtype=np.int64) for _ in hists]
+        for codes, X in self._chunks():
+            for j, hist in enumerate(hists):
+                counts[j] += np.bincount(codes * NUM_BINS + hist.bins(X[:, j]), minlength=counts[j].shape[0])
+        counts = [c.reshape(self._num_readers, NUM_BINS) for c in counts]
+        render_all([(save_binned_histogram, (histogram_path(output_dir, r.get_id()), r.get_id(),
+            StreamingHistogram(*SPR_RANGE, NUM_BINS, counts[0][r._code]),
+            StreamingHistogram(*F0_RANGE, NUM_BINS, counts[1][r._code]))) for r in self._readers], workers)
+
+    def save_spr_vs_fo_scatter(self, path, also_clean=True, style=DEFAULT_PLOT_STYLE):
+        '''
+            Same as ReaderSet.save_spr_vs_fo_scatter, always
+            drawn as densities since the utterances are never
+            all in memory
+        '''
+        from .utils.plots import DENSITY_BINS, save_binned_reader_compare
+        low, high = np.full(2, np.inf), np.full(2, -np.inf)
+        for _, X in self._chunks():
+            if X.shape[0] > 0:
+                low, high = np.minimum(low, X.min(axis=0)), np.maximum(high, X.max(axis=0))
+        extent = (low[0], high[0], low[1], high[1]) if self._num_samples > 0 else (0, 1, 0, 1)
+        density = np.zeros((DENSITY_BINS, DENSITY_BINS))
+        clean_density = np.zeros((DENSITY_BINS, DENSITY_BINS))
+        clean_sums = np.zeros((self._num_readers, 2))
+        for start, (codes, X) in zip(range(0, self._num_samples, self._chunk_rows), self._chunks()):
+            clean = ~self._is_outlier[start:start + codes.shape[0]]
+            density += np.histogram2d(X[:, 0], X[:, 1], DENSITY_BINS, [extent[:2], extent[2:]])[0]
+            clean_density += np.histogram2d(X[clean, 0], X[clean, 1], DENSITY_BINS, [extent[:2], extent[2:]])[0]
+            for j in range(2):
+                clean_sums[:, j] += np.bincount(codes[clean], X[clean, j], self._num_readers)
+        counts, means, _, _ = self._moments
+        num_clean = counts - self._reader_outliers
+        clean_means = np.where(num_clean[:, None] > 0, clean_sums / np.maximum(num_clean, 1)[:, None], np.nan)
+        save_binned_reader_compare(path, extent, [r.get_id() for r in self._readers],
+            density, means, clean_density if also_clean else None, clean_means)
+
+    def _chunks(self):
+        '''
+            The reader codes and the [spr, f0] rows of each
+            chunk of the meta, in order
+        '''
+        for start in range(0, self._num_samples, self._chunk_rows):
+            stop = start + self._chunk_rows
+            yield np.asarray(self._codes[start:stop]), np.column_stack([self._spr[start:stop], self._f0[start:stop]])
+
+    def _reader_chunks(self):
+        '''
+            The rows, reader codes and [spr, f0] rows of each
+            chunk of the meta in reader order, the order of a
+            ReaderSet
+        '''
+        order = self._reader_order()
+        for start in range(0, self._num_samples, self._chunk_rows):
+            if order is None:
+                rows = np.arange(start, min(start + self._chunk_rows, self._num_samples))
+            else:
+                rows = np.asarray(order[start:start + self._chunk_rows])
+            yield rows, np.asarray(self._codes[rows]), np.column_stack([self._spr[rows], self._f0[rows]])
+
+    def _reader_order(self):
+        '''
+            The rows in reader order, or None if the meta is
+            already in reader order, as a run over an index
+            sorted by reader writes it
+        '''
+        if self._order is None:
+            self._order = False
+            last = -1
+            for codes, _ in self._chunks():
+                if codes[0] < last or np.any(codes[1:] < codes[:-1]):
+                    self._order = reader_order(self._codes, self._moments[0],
+                        os.path.join(self._work_dir, 'reader_order.i8'), self._chunk_rows)
+                    break
+                last = codes[-1]
+        return self._order if self._order is not False else None
+
+class StreamingReader:
+    '''
+        The statistics of a single reader of a
+        StreamingReaderSet
+    '''
+    def __init__(self, reader_set, code, reader_id, num_samples, means, std):
+        self._set = reader_set
+        self._code = code
+        self._id = reader_id
+        self._num_samples = num_samples
+        self._spr_mean, self._f0_mean = means
+        self._spr_std, self._f0_std = std
 
     def get_id(self):
         return self._id
 
-    def __lt__(self, other):
-        return self.get_err() < other.get_err()
-    
\ No newline at end of file
+    def get_num_samples(self):
+        return self._num_samples
+
+    def get_num_outliers(self):
+        return int(self._set._reader_outliers[self._code])
+
+    def get_f0_mean(self):
+        return self._f0_mean
+
+    def get_spr_mean(self):
+        return self._spr_mean
+
+    def get_f0_stddev(self):
+        return self._f0_std
+
+    def get_spr_stddev(self):
+        return self._spr_std
@@ -1,11 +1,22 @@
 import argparse
 import os
-from .commands import check, gen_index, outliers, run, write_summary
-from .search import SearchHandler
+from .search import (SearchHandler, build_index, default_index_path, read_terms,
+                     write_batch_results)
+from .utils.cache import DEFAULT_MAX_ENTRIES, FeatureCache
+from .utils.defaults import (CHECK_FEATURES, DEFAULT_F0_METHOD, DEFAULT_FRAME_PERIOD, DEFAULT_HOST,
+                             DEFAULT_OUTLIER_METHOD, DEFAULT_PLOT_STYLE, DEFAULT_PORT, DEFAULT_RESAMPLER,
+                             DEFAULT_SHARD_MB, F0_METHOD_NAMES, FEATURE_NAMES, MAX_SCATTER_POINTS, META_FEATURES,
+                             OUTLIER_METHOD_NAMES, PLOT_STYLES, RESAMPLERS, SEGMENTED_FEATURES)
 
 
-from .utils.datasets import config_custom_paths, config_paths
-from .utils.index import paths_for_index
+from .utils.datasets import config_custom_paths, config_output_paths, config_paths, shard_paths
+from .utils.index import parse_shard, paths_for_index
+from .utils.pipeline import DEFAULT_READ_AHEAD, DEFAULT_READ_THREADS
+
+# The commands module pulls in numpy, so it is only imported
+# by the subcommands that use it. The audio and plotting stack
+# is imported later still, by the commands that need it.
+# See tests/importtime.py.
 
 def main():
 
@@ -16,7 +27,64 @@ def main():
     # Running a search in tokens
     parser_search = subparsers.add_parser('search', help='Search for utterance ID for a given term')
     parser_search.add_argument('--text_dir', help='Directory of the text tokens of a dataset')
-    parser_search.add_argument('term', help='Search term')
+    parser_search.add_argument('term', nargs='?', default=None, help='Search term')
+    parser_search.add_argument('--build_index', action='store_true',
+        help='Build or refresh the search index of the text directory')
+    parser_search.add_argument('--index_path', default=None,
+        help='Path of the search index (default=<text_dir>.search_index)')
+    parser_search.add_argument('--terms_file', default=None,
+        help='File with one search term per line, all searched for in a single pass')
+    parser_search.add_argument('--out_path', default=None,
+        help='Output path of the JSON lines results of --terms_file (default=print them)')
+    parser_search.add_argument('--workers', default=1,
+        help='Number of worker processes used for --terms_file (default=1)')
+    parser_search.add_argument('--token_pack', default=None,
+        help='Search the tokens of this token pack instead of the files of --text_dir, see pack_tokens')
+
+    # Packing text tokens
+    parser_pack = subparsers.add_parser('pack_tokens', help='Pack the text tokens of a directory into'+\
+        ' a single file that run, check and search read without opening each token')
+    parser_pack.add_argument('--text_dir', required=True, help='Directory of the text tokens of a dataset')
+    parser_pack.add_argument('--out_path', default=None,
+        help='Path of the token pack (default=<text_dir>.tokens)')
+    parser_pack.add_argument('--workers', default=8,
+        help='Number of threads reading the token files (default=8)')
+
+    # Packing decoded audio
+    parser_apack = subparsers.add_parser('pack_audio', help='Decode, resample and trim the audio of an'+\
+        ' index into a few large shard files that run and custom_run read without decoding')
+    parser_apack.add_argument('--wav_dir', required=True,
+        help='The absolute path to the wav directory of the dataset')
+    parser_apack.add_argument('--index_path', required=True,
+        help='The absolute path to the index file of the dataset')
+    parser_apack.add_argument('--wav_ind', default='1',
+        help='Index of the audio file in a line of the index (default=1)')
+    parser_apack.add_argument('--out_path', default=None,
+        help='Directory of the audio pack (default=<wav_dir>.audio)')
+    parser_apack.add_argument('--sample_rate', default=22000,
+        help='Sample rate the audio is packed at, that of the runs reading it (default=22000)')
+    parser_apack.add_argument('--native_sr', action='store_true',
+        help='Pack each file at its own sample rate instead of resampling it')
+    parser_apack.add_argument('--resampler', default=DEFAULT_RESAMPLER, choices=RESAMPLERS,
+        help='Resampler used when a file is not at the sample rate (default=%s)' % DEFAULT_RESAMPLER)
+    parser_apack.add_argument('--workers', default=1,
+        help='Number of worker processes decoding the audio (default=1)')
+    parser_apack.add_argument('--shard_size', default=DEFAULT_SHARD_MB,
+        help='Largest size of a shard file in MB (default=%d)' % DEFAULT_SHARD_MB)
+
+    # Serving searches from memory
+    parser_serve = subparsers.add_parser('serve', help='Keep the text tokens in memory and answer'+\
+        ' searches over HTTP')
+    parser_serve.add_argument('--text_dir', required=True, help='Directory of the text tokens of a dataset')
+    parser_serve.add_argument('--index_path', default=None,
+        help='Path of a search index to start from (default=<text_dir>.search_index)')
+    parser_serve.add_argument('--host', default=DEFAULT_HOST,
+        help='Host to listen on (default=%s)' % DEFAULT_HOST)
+    parser_serve.add_argument('--port', default=DEFAULT_PORT,
+        help='Port to listen on (default=%d)' % DEFAULT_PORT)
+    parser_serve.add_argument('--socket_path', default=None,
+        help='Listen on this unix socket instead of a port')
+    parser_serve.add_argument('--quiet', action='store_true', help='Do not log requests')
 
     # Running whole meta run
     parser_run = subparsers.add_parser('run', help='Initial run for a supported dataset')
@@ -29,6 +97,47 @@ def main():
         help='The absolute path for the output root directory. If not specified, it is saved to'+ 
         ' the base directory.')
     parser_run.add_argument('--num_samples', default=None, help='If not indicated, all samples are used')
+    parser_run.add_argument('--workers', default=1,
+        help='Number of worker processes used for the analysis (default=1)')
+    parser_run.add_argument('--resume', action='store_true',
+        help='Skip utterances already in the meta file and append new ones to it')
+    parser_run.add_argument('--flush_every', default=100,
+        help='Number of utterances between flushes of the meta file to disk (default=100)')
+    parser_run.add_argument('--cache_dir', default=None,
+        help='Directory of a feature cache. Unchanged utterances are not analysed again')
+    parser_run.add_argument('--cache_size', default=DEFAULT_MAX_ENTRIES,
+        help='Maximum number of utterances kept in the feature cache (default=%d)' % DEFAULT_MAX_ENTRIES)
+    parser_run.add_argument('--f0_method', default=DEFAULT_F0_METHOD, choices=F0_METHOD_NAMES,
+        help='Estimator used for F0 (default=%s)' % DEFAULT_F0_METHOD)
+    parser_run.add_argument('--frame_period', default=DEFAULT_FRAME_PERIOD,
+        help='Frame period of the F0 estimation in ms (default=%0.1f)' % DEFAULT_FRAME_PERIOD)
+    parser_run.add_argument('--resampler', default=DEFAULT_RESAMPLER, choices=RESAMPLERS,
+        help='Resampler used when a file is not at the sample rate (default=%s)' % DEFAULT_RESAMPLER)
+    parser_run.add_argument('--native_sr', action='store_true',
+        help='Analyse each file at its own sample rate instead of resampling it')
+    parser_run.add_argument('--store', action='store_true',
+        help='Also write the meta as a columnar binary store, meta.store, next to meta.tsv')
+    parser_run.add_argument('--read_ahead', default=DEFAULT_READ_AHEAD,
+        help='Maximum number of utterances read ahead of the analysis (default=%d)' % DEFAULT_READ_AHEAD)
+    parser_run.add_argument('--read_threads', default=DEFAULT_READ_THREADS,
+        help='Number of threads reading files ahead of the analysis (default=%d)' % DEFAULT_READ_THREADS)
+    parser_run.add_argument('--features', nargs='+', default=None, choices=FEATURE_NAMES, metavar='FEATURE',
+        help='Features computed on top of %s, each adds its columns to the meta after them.'
+        % ' and '.join(META_FEATURES) + ' Choose from %s' % ', '.join(FEATURE_NAMES))
+    parser_run.add_argument('--profile', action='store_true',
+        help='Time each stage of the analysis, show the throughput and memory in the progress bar'+
+        ' and write a report to meta_profile.json')
+    parser_run.add_argument('--token_pack', default=None,
+        help='Read the text tokens from this token pack instead of their files, see pack_tokens')
+    parser_run.add_argument('--audio_pack', default=None,
+        help='Read the audio from this audio pack instead of decoding its files, see pack_audio')
+    parser_run.add_argument('--segment_seconds', default=None,
+        help='Analyse audio files longer than this many seconds in segments of that length, so the'+
+        ' memory used does not grow with the length of a recording. Only %s can then be computed'
+        % ', '.join(SEGMENTED_FEATURES))
+    parser_run.add_argument('--shard', default=None,
+        help='Only analyse shard i/N of the index, numbered from 0, and write meta-i-of-N.tsv.'+
+        ' Join the shards with merge')
 
     # Running a meta run on a custom dataset
     parser_crun = subparsers.add_parser('custom_run', help='Initial run for a custom dataset')
@@ -51,15 +160,73 @@ def main():
     parser_crun.add_argument('--txt_ind', default='0', required=True,
         help='Index of reader in line index')
     parser_crun.add_argument('--num_samples', default=None, help='If not indicated, all samples are used')
+    parser_crun.add_argument('--workers', default=1,
+        help='Number of worker processes used for the analysis (default=1)')
+    parser_crun.add_argument('--resume', action='store_true',
+        help='Skip utterances already in the meta file and append new ones to it')
+    parser_crun.add_argument('--flush_every', default=100,
+        help='Number of utterances between flushes of the meta file to disk (default=100)')
+    parser_crun.add_argument('--cache_dir', default=None,
+        help='Directory of a feature cache. Unchanged utterances are not analysed again')
+    parser_crun.add_argument('--cache_size', default=DEFAULT_MAX_ENTRIES,
+        help='Maximum number of utterances kept in the feature cache (default=%d)' % DEFAULT_MAX_ENTRIES)
+    parser_crun.add_argument('--f0_method', default=DEFAULT_F0_METHOD, choices=F0_METHOD_NAMES,
+        help='Estimator used for F0 (default=%s)' % DEFAULT_F0_METHOD)
+    parser_crun.add_argument('--frame_period', default=DEFAULT_FRAME_PERIOD,
+        help='Frame period of the F0 estimation in ms (default=%0.1f)' % DEFAULT_FRAME_PERIOD)
+    parser_crun.add_argument('--resampler', default=DEFAULT_RESAMPLER, choices=RESAMPLERS,
+        help='Resampler used when a file is not at the sample rate (default=%s)' % DEFAULT_RESAMPLER)
+    parser_crun.add_argument('--native_sr', action='store_true',
+        help='Analyse each file at its own sample rate instead of resampling it')
+    parser_crun.add_argument('--store', action='store_true',
+        help='Also write the meta as a columnar binary store, meta.store, next to meta.tsv')
+    parser_crun.add_argument('--read_ahead', default=DEFAULT_READ_AHEAD,
+        help='Maximum number of utterances read ahead of the analysis (default=%d)' % DEFAULT_READ_AHEAD)
+    parser_crun.add_argument('--read_threads', default=DEFAULT_READ_THREADS,
+        help='Number of threads reading files ahead of the analysis (default=%d)' % DEFAULT_READ_THREADS)
+    parser_crun.add_argument('--features', nargs='+', default=None, choices=FEATURE_NAMES, metavar='FEATURE',
+        help='Features computed on top of %s, each adds its columns to the meta after them.'
+        % ' and '.join(META_FEATURES) + ' Choose from %s' % ', '.join(FEATURE_NAMES))
+    parser_crun.add_argument('--profile', action='store_true',
+        help='Time each stage of the analysis, show the throughput and memory in the progress bar'+
+        ' and write a report to meta_profile.json')
+    parser_crun.add_argument('--token_pack', default=None,
+        help='Read the text tokens from this token pack instead of their files, see pack_tokens')
+    parser_crun.add_argument('--audio_pack', default=None,
+        help='Read the audio from this audio pack instead of decoding its files, see pack_audio')
+    parser_crun.add_argument('--segment_seconds', default=None,
+        help='Analyse audio files longer than this many seconds in segments of that length, so the'+
+        ' memory used does not grow with the length of a recording. Only %s can then be computed'
+        % ', '.join(SEGMENTED_FEATURES))
+    parser_crun.add_argument('--shard', default=None,
+        help='Only analyse shard i/N of the index, numbered from 0, and write meta-i-of-N.tsv.'+
+        ' Join the shards with merge')
 
     # Running summary
     parser_summary = subparsers.add_parser('summary', help='Generate a summary for a dataset.')
-    parser_summary.add_argument('--meta_path', required=True,
-        help='Absolute path to the meta file')
+    parser_summary.add_argument('--meta_path', default=None,
+        help='Absolute path to the meta file or meta store')
+    parser_summary.add_argument('--stats_path', default=None,
+        help='Absolute path to the meta_stats.json of a run. Gives a summary without outliers'+
+        ' that does not read the meta file, also while the run is going')
     parser_summary.add_argument('--out_path', required=True,
         help='Absolute path to the path for the output directory')
     parser_summary.add_argument('--outlier_threshold', default=0.9,
         help='The ratio of samples to keep after removing outliers (default=0.9)')
+    parser_summary.add_argument('--outlier_method', default=DEFAULT_OUTLIER_METHOD, choices=OUTLIER_METHOD_NAMES,
+        help='How utterances are scored: global compares with the mean of the dataset,'+
+        ' reader_z and mad with the mean and std or the median and MAD of their reader, mahalanobis'+
+        ' with the mean and covariance of their reader (default=%s)' % DEFAULT_OUTLIER_METHOD)
+    parser_summary.add_argument('--workers', default=1,
+        help='Number of worker processes rendering the reader plots (default=1)')
+    parser_summary.add_argument('--plot_style', default=DEFAULT_PLOT_STYLE, choices=PLOT_STYLES,
+        help='Style of the reader comparison plot. auto draws a scatter plot for up to %d'
+        % MAX_SCATTER_POINTS + ' utterances and a hexbin density plot above that (default=%s)'
+        % DEFAULT_PLOT_STYLE)
+    parser_summary.add_argument('--memory_cap', default=None,
+        help='Read the meta in chunks that keep the memory use around this many MB, for meta files'+
+        ' that do not fit in memory. Gives the same outliers and summary.log, the plots are drawn'+
+        ' from binned counts, temporary files go in a directory under the output directory')
 
     # Running a check
     parser_check = subparsers.add_parser('check', help='Get a short summary for a single <wav, text> pair')
@@ -69,6 +236,31 @@ def main():
         help='Absolute path to the respective token file')
     parser_check.add_argument('--sample_rate', default=22000,
         help='Sample rate of .wav (default=22000)')
+    parser_check.add_argument('--cache_dir', default=None,
+        help='Directory of a feature cache. Unchanged utterances are not analysed again')
+    parser_check.add_argument('--cache_size', default=DEFAULT_MAX_ENTRIES,
+        help='Maximum number of utterances kept in the feature cache (default=%d)' % DEFAULT_MAX_ENTRIES)
+    parser_check.add_argument('--compare_f0', action='store_true',
+        help='Also time every F0 method on the pair')
+    parser_check.add_argument('--features', nargs='+', default=None, choices=FEATURE_NAMES, metavar='FEATURE',
+        help='Features to show on top of %s.' % ', '.join(CHECK_FEATURES) +
+        ' Choose from %s' % ', '.join(FEATURE_NAMES))
+    parser_check.add_argument('--profile', action='store_true',
+        help='Also show the time of each stage of the analysis')
+    parser_check.add_argument('--token_pack', default=None,
+        help='Read the token from this token pack, --text_path is then its path relative to the'+
+        ' packed text directory')
+    parser_check.add_argument('--f0_method', default=DEFAULT_F0_METHOD, choices=F0_METHOD_NAMES,
+        help='Estimator used for F0 (default=%s)' % DEFAULT_F0_METHOD)
+    parser_check.add_argument('--frame_period', default=DEFAULT_FRAME_PERIOD,
+        help='Frame period of the F0 estimation in ms (default=%0.1f)' % DEFAULT_FRAME_PERIOD)
+    parser_check.add_argument('--resampler', default=DEFAULT_RESAMPLER, choices=RESAMPLERS,
+        help='Resampler used when a file is not at the sample rate (default=%s)' % DEFAULT_RESAMPLER)
+    parser_check.add_argument('--native_sr', action='store_true',
+        help='Analyse each file at its own sample rate instead of resampling it')
+    parser_check.add_argument('--segment_seconds', default=None,
+        help='Analyse a long recording in segments of this many seconds, so the memory used does not'+
+        ' grow with its length. Only the duration, speech rate and F0 are shown')
 
     # Running a gen_index
     parser_index = subparsers.add_parser('gen_index', help='Create an index for an index-less dataset')
@@ -80,38 +272,121 @@ def main():
         help='Absolute path to the output directory for the index.')
     parser_index.add_argument('--name_reg', required=False, default='',
         help='Re for file names, ex: .*_r_i or i-r. Note: no file extension. See readme.')
+    parser_index.add_argument('--workers', default=8,
+        help='Number of threads walking the subdirectories of each directory (default=8)')
+
+    # Merging the shards of a run
+    parser_merge = subparsers.add_parser('merge', help='Join the meta files of a sharded run into'+\
+        ' a single meta.tsv')
+    parser_merge.add_argument('--out_dir', required=True,
+        help='The output directory of the shards, the merged files are written there as well')
+
+    # Converting meta files
+    parser_convert = subparsers.add_parser('convert', help='Convert a meta.tsv file to a binary meta store'+\
+        ' or a meta store to a meta.tsv file')
+    parser_convert.add_argument('--meta_path', required=True,
+        help='The absolute path to the meta.tsv file or the meta store directory')
+    parser_convert.add_argument('--out_path', required=True,
+        help='The absolute path of the converted meta')
+    parser_convert.add_argument('--features', nargs='+', default=None, choices=FEATURE_NAMES, metavar='FEATURE',
+        help='The features the meta.tsv was written with, they name the columns of the store.' +
+        ' Choose from %s' % ', '.join(FEATURE_NAMES))
+
+    # Managing the feature cache
+    parser_cache = subparsers.add_parser('cache', help='Show statistics for or clear a feature cache')
+    parser_cache.add_argument('action', choices=['stats', 'clear'])
+    parser_cache.add_argument('--cache_dir', required=True,
+        help='Directory of the feature cache')
 
     # Running outliers
     parser_outliers = subparsers.add_parser('outliers', help='Generate a file index of outliers as well as'+\
         ' other outlier information')
     parser_outliers.add_argument('--meta_path', required=True,
-        help='The absolute path to the meta file of the dataset')
+        help='The absolute path to the meta file or meta store of the dataset')
     parser_outliers.add_argument('--out_path', required=True,
         help='The absolute path to the base directory of the output files')
     parser_outliers.add_argument('--outlier_threshold', default=0.9,
         help='The ratio of samples to keep after removing outliers (default=0.9)')
+    parser_outliers.add_argument('--outlier_method', default=DEFAULT_OUTLIER_METHOD, choices=OUTLIER_METHOD_NAMES,
+        help='How utterances are scored: global compares with the mean of the dataset,'+
+        ' reader_z and mad with the mean and std or the median and MAD of their reader, mahalanobis'+
+        ' with the mean and covariance of their reader (default=%s)' % DEFAULT_OUTLIER_METHOD)
+    parser_outliers.add_argument('--memory_cap', default=None,
+        help='Read the meta in chunks that keep the memory use around this many MB, for meta files'+
+        ' that do not fit in memory. Gives the same outliers, temporary files go in a directory'+
+        ' under the output directory')
 
 
     args = parser.parse_args()
+    if args.command == 'search' and args.term is None and args.terms_file is None \
+            and not args.build_index:
+        parser_search.error('a search term, --terms_file or --build_index is required')
+    if args.command == 'search' and args.text_dir is None and (args.token_pack is None or args.build_index):
+        parser_search.error('--text_dir is required unless searching a --token_pack')
+    if args.command == 'summary' and args.meta_path is None and args.stats_path is None:
+        parser_summary.error('either --meta_path or --stats_path is required')
 
     if args.command == 'search':
-        sh = SearchHandler(args.text_dir)
-        results = sh.search(args.term)
-        print(results)
+        index_path = args.index_path
+        if index_path is None and args.text_dir is not None:
+            index_path = default_index_path(args.text_dir)
+        if args.build_index:
+            build_index(args.text_dir, index_path)
+        if args.term is not None:
+            sh = SearchHandler(args.text_dir, index_path, args.token_pack)
+            results = sh.search(args.term)
+            print(results)
+        if args.terms_file is not None:
+            sh = SearchHandler(args.text_dir, index_path, args.token_pack)
+            results = sh.batch_search(read_terms(args.terms_file), int(args.workers))
+            if args.out_path is not None:
+                write_batch_results(results, args.out_path)
+                print('Results for %d terms are available at %s' % (len(results), args.out_path))
+            else:
+                for term, ids in results.items():
+                    print('%s\t%s' % (term, ' '.join(ids)))
+
+    elif args.command == 'pack_tokens':
+        from .utils.tokens import pack_tokens
+        out_path = args.out_path or os.path.normpath(args.text_dir) + '.tokens'
+        count = pack_tokens(args.text_dir, out_path, int(args.workers))
+        print('%d tokens were packed into %s' % (count, out_path))
+
+    elif args.command == 'pack_audio':
+        from .commands import pack_audio
+        out_path = args.out_path or os.path.normpath(args.wav_dir) + '.audio'
+        count = pack_audio(args.wav_dir, args.index_path, out_path, sample_rate(args), int(args.wav_ind),
+            args.resampler, int(args.workers), int(float(args.shard_size) * 2**20))
+        print('%d audio files were packed into %s' % (count, out_path))
+
+    elif args.command == 'serve':
+        from .server import serve
+        index_path = args.index_path or default_index_path(args.text_dir)
+        serve(args.text_dir, index_path, args.host, int(args.port), args.socket_path, args.quiet)
 
     elif args.command == 'run':
+        from .commands import run, write_summary
         # configure paths based on chosen dataset
         paths = config_paths(args.dataset, args.base_dir, args.out_dir)
-        print('A new meta file will be written at ', paths['out_file'])
-        choice = None
-        while choice not in ['y', 'n', '']:
-            choice = input('This will overwrite any previous files at that lociation. Continue [(y), n] ? ')
+        shard = parse_shard_arg(parser_run, args)
+        if shard is not None:
+            paths = shard_paths(paths, *shard)
+        choice = confirm_meta_file(paths['out_file'], args.resume)
         if choice == '' or choice == 'y':
             print('Starting the info run')
             num_samples = args.num_samples
             if num_samples is not None:
                 num_samples = int(num_samples)
-            run(int(args.sample_rate), paths, args.dataset, ind=None, num_samples=num_samples)
+            run(sample_rate(args), paths, args.dataset, ind=None, num_samples=num_samples,
+                workers=int(args.workers), resume=args.resume, flush_every=int(args.flush_every),
+                cache=open_cache(args), f0_method=args.f0_method, frame_period=float(args.frame_period),
+                res_type=args.resampler, store=args.store, shard=shard,
+                read_ahead=int(args.read_ahead), read_threads=int(args.read_threads), profile=args.profile,
+                features=args.features, token_pack=args.token_pack, audio_pack=args.audio_pack,
+                segment_seconds=segment_seconds(args))
+            if shard is not None:
+                print('Join the shards with `metawave merge` once all of them are done')
+                return
             choice = None
             while choice not in ['y', 'n', '']:
                 choice = input('Do you want to write a summary as well [(y), n] ? ')
@@ -127,23 +402,33 @@ def main():
             print('Quitting')
 
     elif args.command == 'custom_run':
+        from .commands import run, write_summary
         paths = config_custom_paths(args.wav_dir, args.text_dir, args.index_path, args.out_dir)
+        shard = parse_shard_arg(parser_crun, args)
+        if shard is not None:
+            paths = shard_paths(paths, *shard)
         # handle indexes
         ind = {}
         ind['wav_ind'] = int(args.wav_ind)
         ind['txt_ind'] = int(args.txt_ind)
         if args.reader_ind is not None:
             ind['reader_ind'] = int(args.reader_ind)
-        print('A new meta file will be written at ', paths['out_file'])
-        choice = None
-        while choice not in ['y', 'n', '']:
-            choice = input('This will overwrite any previous files at that lociation. Continue [(y), n] ? ')
+        choice = confirm_meta_file(paths['out_file'], args.resume)
         if choice == '' or choice == 'y':
             print('Starting the info run')
             num_samples = args.num_samples
             if num_samples is not None:
                 num_samples = int(num_samples)
-            run(int(args.sample_rate), paths, None, ind=ind, token_xtsn=args.token_xtsn, num_samples=num_samples)
+            run(sample_rate(args), paths, None, ind=ind, token_xtsn=args.token_xtsn, num_samples=num_samples,
+                workers=int(args.workers), resume=args.resume, flush_every=int(args.flush_every),
+                cache=open_cache(args), f0_method=args.f0_method, frame_period=float(args.frame_period),
+                res_type=args.resampler, store=args.store, shard=shard,
+                read_ahead=int(args.read_ahead), read_threads=int(args.read_threads), profile=args.profile,
+                features=args.features, token_pack=args.token_pack, audio_pack=args.audio_pack,
+                segment_seconds=segment_seconds(args))
+            if shard is not None:
+                print('Join the shards with `metawave merge` once all of them are done')
+                return
             choice = None
             while choice not in ['y', 'n', '']:
                 choice = input('Do you want to write a summary as well [(y), n] ? ')
@@ -159,6 +444,7 @@ def main():
             print('Quitting')
     
     elif args.command == 'summary':
+        from .commands import write_stats_summary, write_summary
         summary_dir = os.path.join(args.out_path, 'meta_summary')
         print('A new summary directory will be added to: ', summary_dir)
         choice = None
@@ -166,14 +452,23 @@ def main():
             choice = input('This will overwrite any previous metafiles in that directory. Continue [(y), n] ? ')
         if choice == '' or choice == 'y':
             print('Starting the summary run')
-            write_summary(args.meta_path, summary_dir, float(args.outlier_threshold))
+            if args.stats_path is not None:
+                write_stats_summary(args.stats_path, summary_dir, int(args.workers))
+            else:
+                write_summary(args.meta_path, summary_dir, float(args.outlier_threshold),
+                    int(args.workers), args.plot_style, args.outlier_method, memory_cap(args))
         else:
             print('Quitting')
 
     elif args.command == 'check':
-        check(args.wav_path, args.text_path, int(args.sample_rate))
+        from .commands import check
+        check(args.wav_path, args.text_path, sample_rate(args), cache=open_cache(args),
+            f0_method=args.f0_method, frame_period=float(args.frame_period), res_type=args.resampler,
+            compare_f0=args.compare_f0, profile=args.profile, features=args.features,
+            token_pack=args.token_pack, segment_seconds=segment_seconds(args))
 
     elif args.command == 'gen_index':
+        from .commands import gen_index
         paths = paths_for_index(args.wav_dir, args.text_dir, args.out_dir)
         print('A new line index will be added at: ', paths['out_file'])
         choice = None
@@ -181,17 +476,77 @@ def main():
             choice = input('This will overwrite any previous indexfile at that location. Continue [(y), n] ? ')
         if choice == '' or choice == 'y':
             print('Starting index generation')
-            gen_index(paths, args.name_reg)
+            gen_index(paths, args.name_reg, int(args.workers))
         else:
             print('Quitting')
     
+    elif args.command == 'merge':
+        from .commands import merge_shards
+        merge_shards(config_output_paths(args.out_dir))
+
+    elif args.command == 'convert':
+        from .commands import convert_meta
+        convert_meta(args.meta_path, args.out_path, args.features)
+
+    elif args.command == 'cache':
+        cache = FeatureCache(args.cache_dir)
+        if args.action == 'stats':
+            stats = cache.stats()
+            print('Cache:       ', stats['path'])
+            print('Entries:      %d' % stats['entries'])
+            print('Size on disk: %0.1f MB' % (stats['size_bytes'] / 2**20))
+        else:
+            cache.clear()
+            print('The feature cache at %s has been cleared' % args.cache_dir)
+        cache.close()
+
     elif args.command == 'outliers':
+        from .commands import outliers
         print('Outlier files will be generated at ', args.out_path)
         choice = None
         while choice not in ['y', 'n', '']:
             choice = input('Continue [(y), n] ? ')
         if choice == '' or choice == 'y':
             print('Starting outlier generation')
-            outliers(args.meta_path, args.out_path, int(args.outlier_threshold))
+            outliers(args.meta_path, args.out_path, float(args.outlier_threshold), args.outlier_method,
+                memory_cap(args))
         else:
             print('Quitting')
+
+def confirm_meta_file(out_file, resume):
+    if resume:
+        print('Continuing the meta file at ', out_file)
+        return 'y'
+    print('A new meta file will be written at ', out_file)
+    choice = None
+    while choice not in ['y', 'n', '']:
+        choice = input('This will overwrite any previous files at that lociation. Continue [(y), n] ? ')
+    return choice
+
+def parse_shard_arg(parser, args):
+    if args.shard is None:
+        return None
+    try:
+        return parse_shard(args.shard)
+    except ValueError as e:
+        parser.error(str(e))
+
+def open_cache(args):
+    if args.cache_dir is None:
+        return None
+    return FeatureCache(args.cache_dir, int(args.cache_size))
+
+def sample_rate(args):
+    if args.native_sr:
+        return None
+    return int(args.sample_rate)
+
+def segment_seconds(args):
+    if args.segment_seconds is None:
+        return None
+    return float(args.segment_seconds)
+
+def memory_cap(args):
+    if args.memory_cap is None:
+        return None
+    return float(args.memory_cap)
@@ -1,16 +1,421 @@
+import json
+import multiprocessing
 import os
+import pickle
+from array import array
+from collections import deque
+
+# utils.tokens imports numpy, which would slow down the start
+# of every command, so it is imported where a token pack is read
+
+INDEX_VERSION = 1
+NGRAM = 3
+
+def read_search_text(path):
+    '''
+        The text of a token file as it is searched, with
+        each line stripped and the lines joined.
+    '''
+    with open(path, 'r') as f:
+        return ''.join(line.strip() for line in f)
+
+def search_text(text):
+    '''
+        Same as read_search_text for a token read from a
+        token pack
+    '''
+    return ''.join(line.strip() for line in text.split('\n'))
+
+def ngrams(text, n=NGRAM):
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+def default_index_path(token_dir):
+    '''
+        The search index is kept next to the token directory,
+        not inside it, so it is not mistaken for a token.
+    '''
+    return os.path.normpath(token_dir) + '.search_index'
 
 
 class SearchHandler:
-    def __init__(self, token_dir):
+    '''
+        Searches the text tokens in token_dir for a term. If a
+        search index exists at index_path, candidates are looked
+        up in the index and only they are checked for the term,
+        otherwise every token is read, from the token pack at
+        token_pack if one is given, see utils.tokens, or else
+        from its file. The index is used as it was saved, with
+        a warning if files were added to or removed from
+        token_dir since, see build_index for refreshing it.
+    '''
+    def __init__(self, token_dir, index_path=None, token_pack=None):
         self._token_dir = token_dir
+        self._index = None
+        self._token_pack = token_pack
+        if index_path is not None and os.path.exists(index_path):
+            self._index = SearchIndex.load(index_path)
+            if token_dir is not None and self._index.is_stale(token_dir):
+                print('Warning: files were added to or removed from %s since the search index was refreshed,'
+                    % token_dir + ' refresh it with --build_index')
 
     def search(self, term):
+        if self._index is not None:
+            return self._index.search(term)
         results = []
+        if self._token_pack is not None:
+            from .utils.tokens import TokenPack
+            for name, text in TokenPack(self._token_pack).items():
+                tok = search_text(text)
+                if term in tok:
+                    results.append({'id': name, 'tok': tok})
+            return results
 
         for filename in os.listdir(self._token_dir):
-                with open(os.path.join(self._token_dir,filename), 'r') as f:
-                    tok = ''.join(line.strip() for line in f)
-                    if term in tok:
-                        results.append({'id':filename, 'tok': tok})
+                tok = read_search_text(os.path.join(self._token_dir, filename))
+                if term in tok:
+                    results.append({'id':filename, 'tok': tok})
         return results
+
+    def batch_search(self, terms, workers=1):
+        '''
+            Searches for many terms in a single pass over the
+            tokens. Returns a dictionary of each term to the sorted
+            ids of the tokens that contain it. The token files are
+            split between worker processes, unless a search index
+            is loaded, in which case its stored texts are used.
+        '''
+        matcher = TermMatcher(terms)
+        if self._index is not None:
+            return self._index.batch_search(matcher)
+        if self._token_pack is not None:
+            return collect_matches(matcher, scan_pack(self._token_pack, matcher, workers))
+        return collect_matches(matcher, scan_files(self._token_dir, matcher, workers))
+
+
+class SearchIndex:
+    '''
+        An inverted index from character trigrams to the token
+        files that contain them. The text of each token is
+        stored as well, so candidates are verified without
+        opening any files.
+
+        Changed and removed files leave their old entry behind
+        as a tombstone which queries skip. The index is compacted
+        when tombstones make up a quarter of it.
+    '''
+    def __init__(self, token_dir):
+        self.token_dir = token_dir
+        self.names = []
+        self.texts = []
+        self.stamps = []
+        self.postings = {}
+        self.doc_ids = {}
+        self.num_removed = 0
+        # modification time of token_dir when it was last read
+        self.dir_mtime_ns = None
+
+    def refresh(self):
+        '''
+            Brings the index up to date with the token directory.
+            Only files whose size or modification time changed are
+            read. Returns the counts (added, updated, removed).
+        '''
+        return self.apply(self.changes())
+
+    def changes(self):
+        '''
+            Reads the token files that were added or changed since
+            the last refresh, without changing the index. Returns
+            (new, removed, dir_mtime_ns) for apply, where new holds
+            (name, text, stamp, doc_id) for each file read, doc_id
+            being its old entry if it had one, removed the entries
+            of the files that are gone and dir_mtime_ns the
+            modification time of token_dir before it was read.
+        '''
+        new = []
+        seen = set()
+        dir_mtime_ns = os.stat(self.token_dir).st_mtime_ns
+        with os.scandir(self.token_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                seen.add(entry.name)
+                st = entry.stat()
+                stamp = (st.st_size, st.st_mtime_ns)
+                doc_id = self.doc_ids.get(entry.name)
+                if doc_id is not None and self.stamps[doc_id] == stamp:
+                    continue
+                new.append((entry.name, read_search_text(entry.path), stamp, doc_id))
+        removed = [doc_id for name, doc_id in self.doc_ids.items() if name not in seen]
+        return new, removed, dir_mtime_ns
+
+    def apply(self, changes):
+        '''
+            Applies the changes read by changes. Returns the
+            counts (added, updated, removed).
+        '''
+        new, removed, self.dir_mtime_ns = changes
+        updated = 0
+        for name, text, stamp, doc_id in new:
+            if doc_id is not None:
+                self._remove(doc_id)
+                updated += 1
+            self._add(name, text, stamp)
+        for doc_id in removed:
+            self._remove(doc_id)
+        if self.num_removed > len(self.names) // 4:
+            self._compact()
+        return len(new) - updated, updated, len(removed)
+
+    def is_stale(self, token_dir):
+        '''
+            Whether files were added to or removed from token_dir
+            since the index was refreshed. Only the directory is
+            looked at, so a file edited in place is not noticed.
+        '''
+        return os.stat(token_dir).st_mtime_ns != self.dir_mtime_ns
+
+    def search(self, term):
+        '''
+            Returns [{'id', 'tok'}, ...] for every token that has
+            the term as a substring.
+        '''
+        grams = ngrams(term)
+        if len(grams) == 0:
+            # too short for the index, check every stored text
+            candidates = range(len(self.names))
+        else:
+            lists = sorted((self.postings.get(g, ()) for g in grams), key=len)
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(postings)
+            candidates = sorted(candidates)
+        results = []
+        for doc_id in candidates:
+            if self.names[doc_id] is not None and term in self.texts[doc_id]:
+                results.append({'id': self.names[doc_id], 'tok': self.texts[doc_id]})
+        return results
+
+    def batch_search(self, matcher):
+        '''
+            Matches a TermMatcher against every stored text.
+            Returns {term: [id, ...]} with the ids sorted.
+        '''
+        return collect_matches(matcher, ((name, matcher.matches(self.texts[self.doc_ids[name]]))
+            for name in sorted(self.doc_ids)))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'version': INDEX_VERSION,
+                'token_dir': self.token_dir,
+                'names': self.names,
+                'texts': self.texts,
+                'stamps': self.stamps,
+                'dir_mtime_ns': self.dir_mtime_ns,
+                'postings': {g: p.tobytes() for g, p in self.postings.items()}},
+                f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data['version'] != INDEX_VERSION:
+            raise ValueError('Search index version %d is not supported, rebuild it' % data['version'])
+        index = cls(data['token_dir'])
+        index.names = data['names']
+        index.texts = data['texts']
+        index.stamps = data['stamps']
+        index.dir_mtime_ns = data.get('dir_mtime_ns')
+        for g, raw in data['postings'].items():
+            postings = array('I')
+            postings.frombytes(raw)
+            index.postings[g] = postings
+        index.doc_ids = {name: i for i, name in enumerate(index.names) if name is not None}
+        index.num_removed = len(index.names) - len(index.doc_ids)
+        return index
+
+    def _add(self, name, text, stamp):
+        doc_id = len(self.names)
+        self.names.append(name)
+        self.texts.append(text)
+        self.stamps.append(stamp)
+        self.doc_ids[name] = doc_id
+        for g in ngrams(text):
+            if g not in self.postings:
+                self.postings[g] = array('I')
+            self.postings[g].append(doc_id)
+
+    def _remove(self, doc_id):
+        del self.doc_ids[self.names[doc_id]]
+        self.names[doc_id] = None
+        self.texts[doc_id] = None
+        self.num_removed += 1
+
+    def _compact(self):
+        live = [(n, t, s) for n, t, s in zip(self.names, self.texts, self.stamps) if n is not None]
+        self.names = []
+        self.texts = []
+        self.stamps = []
+        self.postings = {}
+        self.doc_ids = {}
+        self.num_removed = 0
+        for name, text, stamp in live:
+            self._add(name, text, stamp)
+
+
+class TermMatcher:
+    '''
+        An Aho-Corasick automaton over a set of terms. It finds
+        every term that occurs in a text in a single pass over
+        the text, however many terms there are. Empty and
+        repeated terms are dropped.
+    '''
+    def __init__(self, terms):
+        self.terms = list(dict.fromkeys(t for t in terms if t))
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for i, term in enumerate(self.terms):
+            node = 0
+            for ch in term:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(i)
+        # breadth first, so the failure link of a node is always
+        # set before those of its children
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = fail if fail != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def matches(self, text):
+        '''
+            Returns the set of indices into self.terms of the
+            terms found in text
+        '''
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        node = 0
+        found = set()
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+_matcher = None
+
+def _init_scan(matcher):
+    global _matcher
+    _matcher = matcher
+
+def _scan_chunk(job):
+    token_dir, names = job
+    return [(name, _matcher.matches(read_search_text(os.path.join(token_dir, name)))) for name in names]
+
+def scan_files(token_dir, matcher, workers=1, chunk=256):
+    '''
+        Yields (filename, matched term indices) for every file
+        in token_dir. Chunks of files are matched in a pool of
+        worker processes if workers is larger than 1.
+    '''
+    names = sorted(os.listdir(token_dir))
+    jobs = [(token_dir, names[i:i + chunk]) for i in range(0, len(names), chunk)]
+    if workers <= 1:
+        _init_scan(matcher)
+        for results in map(_scan_chunk, jobs):
+            yield from results
+        return
+    with multiprocessing.Pool(workers, initializer=_init_scan, initargs=(matcher,)) as pool:
+        for results in pool.imap(_scan_chunk, jobs):
+            yield from results
+
+_pack = None
+
+def _scan_pack_range(job):
+    global _pack
+    pack_path, start, stop = job
+    if _pack is None or _pack.path != pack_path:
+        from .utils.tokens import TokenPack
+        _pack = TokenPack(pack_path)
+    return [(name, _matcher.matches(search_text(text))) for name, text in _pack.items(start, stop)]
+
+def scan_pack(pack_path, matcher, workers=1, chunk=4096):
+    '''
+        Same as scan_files for the tokens of a token pack, in
+        the order of their ids. Each worker process maps the
+        pack itself, so only the ranges of tokens are sent.
+    '''
+    from .utils.tokens import TokenPack
+    num_tokens = len(TokenPack(pack_path))
+    jobs = [(pack_path, i, i + chunk) for i in range(0, num_tokens, chunk)]
+    if workers <= 1:
+        _init_scan(matcher)
+        for results in map(_scan_pack_range, jobs):
+            yield from results
+        return
+    with multiprocessing.Pool(workers, initializer=_init_scan, initargs=(matcher,)) as pool:
+        for results in pool.imap(_scan_pack_range, jobs):
+            yield from results
+
+def collect_matches(matcher, matched):
+    '''
+        Groups (id, matched term indices) pairs by term
+    '''
+    results = {term: [] for term in matcher.terms}
+    for name, found in matched:
+        for i in found:
+            results[matcher.terms[i]].append(name)
+    return results
+
+def read_terms(terms_path):
+    with open(terms_path, 'r') as f:
+        return [line.strip() for line in f]
+
+def write_batch_results(results, out_path):
+    '''
+        Writes the results of a batch search as JSON lines
+        of {"term": term, "ids": [...]}
+    '''
+    with open(out_path, 'w', encoding='utf-8') as f:
+        for term, ids in results.items():
+            f.write(json.dumps({'term': term, 'ids': ids}, ensure_ascii=False) + '\n')
+
+def build_index(token_dir, index_path):
+    '''
+        Builds the search index for token_dir or refreshes it
+        if it already exists at index_path.
+    '''
+    if os.path.exists(index_path):
+        index = SearchIndex.load(index_path)
+        index.token_dir = token_dir
+    else:
+        index = SearchIndex(token_dir)
+    added, updated, removed = index.refresh()
+    index.save(index_path)
+    print('Search index with %d tokens is ready at %s (%d added, %d updated, %d removed)'
+        % (len(index), index_path, added, updated, removed))
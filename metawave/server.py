@@ -0,0 +1,164 @@
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .search import SearchIndex, TermMatcher
+from .utils.defaults import DEFAULT_HOST, DEFAULT_PORT
+
+class SearchService:
+    '''
+        Keeps the search index of a token directory in memory
+        and answers queries against it. An existing index at
+        index_path is loaded and brought up to date, otherwise
+        the index is built in memory. The index on disk is
+        never written to.
+
+        A refresh reads the changed token files without holding
+        the lock, so queries are only held up while the changes
+        are applied to the index.
+    '''
+    def __init__(self, token_dir, index_path=None):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        if index_path is not None and os.path.exists(index_path):
+            self._index = SearchIndex.load(index_path)
+            self._index.token_dir = token_dir
+        else:
+            self._index = SearchIndex(token_dir)
+        self._index.refresh()
+
+    def search(self, term):
+        with self._lock:
+            return self._index.search(term)
+
+    def batch_search(self, terms):
+        matcher = TermMatcher(terms)
+        with self._lock:
+            return self._index.batch_search(matcher)
+
+    def refresh(self):
+        with self._refresh_lock:
+            # queries only read the index, so it can be read
+            # from while the changed files are
+            changes = self._index.changes()
+            with self._lock:
+                added, updated, removed = self._index.apply(changes)
+        return {'added': added, 'updated': updated, 'removed': removed}
+
+    def health(self):
+        with self._lock:
+            return {'status': 'ok', 'tokens': len(self._index)}
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    '''
+        JSON endpoints of the search server
+        * GET /search?term=<term>: {'term', 'results': [{'id', 'tok'}, ...]}
+        * POST /batch with {'terms': [...]}: {'results': {term: [id, ...]}}
+        * POST /refresh: re-reads changed token files
+        * GET /health: {'status', 'tokens'}
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == '/search':
+            term = parse_qs(url.query).get('term')
+            if not term or not term[0]:
+                self._send(400, {'error': 'the term parameter is required'})
+                return
+            self._send(200, {'term': term[0], 'results': service.search(term[0])})
+        elif url.path == '/health':
+            self._send(200, service.health())
+        else:
+            self._send(404, {'error': 'unknown path %s' % url.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        if url.path == '/batch':
+            try:
+                terms = json.loads(body.decode('utf-8'))['terms']
+            except (ValueError, KeyError, TypeError):
+                self._send(400, {'error': 'the body must be JSON of the form {"terms": [...]}'})
+                return
+            self._send(200, {'results': service.batch_search(terms)})
+        elif url.path == '/refresh':
+            self._send(200, service.refresh())
+        else:
+            self._send(404, {'error': 'unknown path %s' % url.path})
+
+    def address_string(self):
+        # clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ClientErrorsMixin:
+    '''
+        Clients that go away in the middle of a request
+        are not worth a traceback
+    '''
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class SearchHTTPServer(ClientErrorsMixin, ThreadingHTTPServer):
+    pass
+
+class UnixHTTPServer(ClientErrorsMixin, socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, quiet=False):
+    '''
+        Creates a threaded HTTP server for the service, on a
+        unix socket if socket_path is given, otherwise on
+        host:port. A socket left at socket_path by an earlier
+        server is replaced, any other file there is not.
+    '''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                print('%s exists and is not a socket, choose another --socket_path' % socket_path)
+                sys.exit(1)
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, SearchRequestHandler)
+    else:
+        server = SearchHTTPServer((host, port), SearchRequestHandler)
+    server.service = service
+    server.quiet = quiet
+    return server
+
+def serve(token_dir, index_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, quiet=False):
+    service = SearchService(token_dir, index_path)
+    server = make_server(service, host, port, socket_path, quiet)
+    where = socket_path if socket_path is not None else 'http://%s:%d' % server.server_address[:2]
+    print('Serving search over %d tokens at %s' % (service.health()['tokens'], where))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
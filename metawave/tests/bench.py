@@ -0,0 +1,288 @@
+'''
+    Benchmarks of every subcommand on a synthetic corpus.
+
+    The corpus is generated deterministically from a seed:
+    each reader has its own pitch and speaking rate, each
+    utterance is a harmonic tone with a slow pitch glide, some
+    silence around it and sometimes a pause, and a token of
+    Icelandic words. Since the F0 of every utterance is known,
+    the accuracy of the F0 estimators is reported next to their
+    speed.
+
+    python -m metawave.tests.bench --out_dir /tmp/bench --readers 4 --utterances 50
+        [--workers 2] [--json results.json] [--compare old_results.json]
+
+    The results are written as JSON, so the results of two
+    versions can be compared with --compare.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import time
+
+import numpy as np
+
+WORDS = ['það', 'er', 'hestur', 'kona', 'maður', 'barn', 'íslenska', 'veður', 'fjall', 'á', 'og',
+    'sólin', 'skín', 'í', 'dag', 'bókin', 'liggur', 'borðinu', 'við', 'förum', 'heim', 'eftir',
+    'vinnu', 'hún', 'talaði', 'lengi', 'um', 'ferðina', 'norður', 'þjóðin', 'kaus', 'nýjan',
+    'forseta', 'rigningin', 'kemur', 'frá', 'hafinu', 'ljósið', 'slokknaði', 'skyndilega']
+
+SR = 22050
+NUM_HARMONICS = 8
+
+def reader_voice(rng, reader):
+    '''
+        The base F0 (Hz) and speech rate (words/sec) of a reader
+    '''
+    return {'id': 'reader_%02d' % reader, 'f0': rng.uniform(90, 260), 'rate': rng.uniform(1.8, 3.2)}
+
+def harmonic_tone(rng, f0_start, f0_end, duration, sr=SR):
+    '''
+        A tone with NUM_HARMONICS harmonics whose F0 glides
+        linearly from f0_start to f0_end, with short fades. Its
+        mean F0 over time is (f0_start + f0_end) / 2.
+    '''
+    n = int(duration * sr)
+    f0 = np.linspace(f0_start, f0_end, n)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    tone = sum(np.sin(k * phase + rng.uniform(0, 2 * np.pi)) / k for k in range(1, NUM_HARMONICS + 1))
+    fade = min(int(0.02 * sr), n // 2)
+    env = np.ones(n)
+    env[:fade] = np.linspace(0, 1, fade)
+    env[n - fade:] = np.linspace(1, 0, fade)
+    return 0.3 * tone * env / np.abs(tone).max()
+
+def utterance(rng, voice, sr=SR):
+    '''
+        Returns (audio, token, true mean F0) of one utterance
+    '''
+    num_words = rng.randint(3, 12)
+    token = ' '.join(WORDS[i] for i in rng.randint(0, len(WORDS), num_words))
+    duration = num_words / voice['rate']
+    f0 = voice['f0'] * rng.uniform(0.9, 1.1)
+    glide = rng.uniform(-0.05, 0.05)
+    silence = lambda seconds: rng.normal(0, 1e-4, int(seconds * sr))
+    if rng.rand() < 0.5:
+        # a pause in the middle, the F0 continues after it
+        first = rng.uniform(0.3, 0.7) * duration
+        mid = f0 * (1 + glide * first / duration)
+        parts = [harmonic_tone(rng, f0, mid, first, sr), silence(0.3),
+            harmonic_tone(rng, mid, f0 * (1 + glide), duration - first, sr)]
+        true_f0 = (len(parts[0]) * (f0 + mid) / 2 + len(parts[2]) * (mid + f0 * (1 + glide)) / 2) \
+            / (len(parts[0]) + len(parts[2]))
+    else:
+        parts = [harmonic_tone(rng, f0, f0 * (1 + glide), duration, sr)]
+        true_f0 = f0 * (1 + glide / 2)
+    audio = np.concatenate([silence(rng.uniform(0.1, 0.5))] + parts + [silence(rng.uniform(0.1, 0.5))])
+    return audio, token, true_f0
+
+def make_corpus(root, num_readers, num_utterances, seed=0, sr=SR):
+    '''
+        Writes wavs/, tokens/ and line_index.tsv (token, wav,
+        reader) of a synthetic corpus to root, and truth.tsv
+        with the true mean F0 of each utterance. Returns
+        {utterance id: true F0}.
+    '''
+    import soundfile as sf
+    rng = np.random.RandomState(seed)
+    for sub in ['wavs', 'tokens']:
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+    truth = {}
+    voices = [reader_voice(rng, r) for r in range(num_readers)]
+    with open(os.path.join(root, 'line_index.tsv'), 'w') as index:
+        for u in range(num_utterances):
+            for voice in voices:
+                utt_id = '%s_%05d' % (voice['id'], u)
+                audio, token, true_f0 = utterance(rng, voice, sr)
+                sf.write(os.path.join(root, 'wavs', utt_id + '.wav'), audio, sr, subtype='PCM_16')
+                with open(os.path.join(root, 'tokens', utt_id + '.token'), 'w') as f:
+                    f.write(token + '\n')
+                index.write('%s.token\t%s.wav\t%s\n' % (utt_id, utt_id, voice['id']))
+                truth[utt_id + '.token'] = true_f0
+    with open(os.path.join(root, 'truth.tsv'), 'w') as f:
+        for utt_id, f0 in truth.items():
+            f.write('%s\t%0.4f\n' % (utt_id, f0))
+    return truth
+
+def f0_accuracy(estimates, truth):
+    '''
+        Mean absolute error (Hz), mean relative error and the
+        gross error rate (more than 20% off) of F0 estimates
+    '''
+    ids = [utt_id for utt_id in estimates if utt_id in truth]
+    est = np.array([estimates[i] for i in ids])
+    ref = np.array([truth[i] for i in ids])
+    rel = np.abs(est - ref) / ref
+    return {'num_utterances': len(ids), 'mae_hz': float(np.mean(np.abs(est - ref))),
+        'mean_rel_error': float(np.mean(rel)), 'gross_error_rate': float(np.mean(rel > 0.2))}
+
+@contextlib.contextmanager
+def quiet():
+    '''
+        Hides what the commands print, progress bars included
+    '''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        yield
+
+def timed(results, name, func, *args, items=None, **kwargs):
+    with quiet():
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    results[name] = {'seconds': seconds}
+    if items:
+        results[name]['items_per_second'] = items / seconds
+    return value
+
+def bench_stages(corpus_dir, truth, num_files, sr=SR):
+    '''
+        Times the stages of the analysis of an utterance on the
+        first num_files files: decoding, framewise energy and
+        trimming, and F0 with each estimator, whose accuracy is
+        reported as well.
+    '''
+    from metawave.utils.audio import F0_METHODS, dio_F0, frame_energy, load_audio
+    ids = sorted(truth)[:num_files]
+    paths = [os.path.join(corpus_dir, 'wavs', i.replace('.token', '.wav')) for i in ids]
+    stages = {}
+    start = time.perf_counter()
+    clips = [load_audio(p, sr)[0] for p in paths]
+    stages['decode'] = {'seconds': time.perf_counter() - start}
+    audio_seconds = sum(len(c) for c in clips) / sr
+    start = time.perf_counter()
+    trimmed = []
+    for clip in clips:
+        energy = frame_energy(clip, sr)
+        trimmed.append(energy.trim(clip))
+    stages['energy_trim'] = {'seconds': time.perf_counter() - start}
+    for method in F0_METHODS:
+        estimates = {}
+        start = time.perf_counter()
+        for utt_id, clip in zip(ids, trimmed):
+            try:
+                estimates[utt_id] = dio_F0(clip, sr, method=method)
+            except ValueError:
+                # no voiced frames
+                estimates[utt_id] = 0.0
+        stages['f0_' + method] = {'seconds': time.perf_counter() - start,
+            'accuracy': f0_accuracy(estimates, truth)}
+    for stage in stages.values():
+        stage['realtime'] = audio_seconds / stage['seconds']
+    return stages
+
+def bench_commands(corpus_dir, out_dir, truth, workers):
+    '''
+        Times each command end to end on the corpus
+    '''
+    from metawave.commands import convert_meta, gen_index, outliers, run, write_summary
+    from metawave.search import SearchHandler, SearchIndex
+    from metawave.utils.datasets import config_custom_paths
+    from metawave.utils.index import paths_for_index
+    results = {}
+    num_utts = len(truth)
+    paths = config_custom_paths(os.path.join(corpus_dir, 'wavs'), os.path.join(corpus_dir, 'tokens'),
+        os.path.join(corpus_dir, 'line_index.tsv'), out_dir)
+    ind = {'txt_ind': 0, 'wav_ind': 1, 'reader_ind': 2}
+    timed(results, 'run', run, SR, paths, None, ind=ind, token_xtsn='.token', num_samples=None,
+        workers=workers, items=num_utts)
+    estimates = {}
+    with open(paths['out_file']) as meta:
+        for line in meta:
+            utt_id, _, _, f0 = line.split('\t')[:4]
+            estimates[utt_id] = float(f0)
+    results['run']['accuracy'] = f0_accuracy(estimates, truth)
+    timed(results, 'summary', write_summary, paths['out_file'], os.path.join(out_dir, 'summary'), 0.9,
+        workers=workers, items=num_utts)
+    timed(results, 'outliers', outliers, paths['out_file'], out_dir, 0.9, items=num_utts)
+    timed(results, 'convert', convert_meta, paths['out_file'], os.path.join(out_dir, 'meta.store'),
+        items=num_utts)
+    index_paths = paths_for_index(paths['wavs'], paths['text'], out_dir)
+    timed(results, 'gen_index', gen_index, index_paths, None, items=num_utts)
+    terms = WORDS[:20]
+    scan = SearchHandler(paths['text'])
+    timed(results, 'search', lambda: [scan.search(t) for t in terms], items=len(terms))
+    timed(results, 'search_batch', scan.batch_search, terms, items=len(terms))
+    index = SearchIndex(paths['text'])
+    timed(results, 'search_index_build', index.refresh, items=num_utts)
+    timed(results, 'search_indexed', lambda: [index.search(t) for t in terms], items=len(terms))
+    return results
+
+def versions():
+    import librosa
+    import pyworld
+    info = {'python': platform.python_version(), 'platform': platform.platform(),
+        'numpy': np.__version__, 'librosa': librosa.__version__,
+        'pyworld': getattr(pyworld, '__version__', 'unknown')}
+    with contextlib.suppress(Exception):
+        import subprocess
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        info['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+            capture_output=True, text=True).stdout.strip()
+    return info
+
+def compare(results, old):
+    '''
+        Prints the speed up of every timing in results over
+        the same timing in old
+    '''
+    print('%-22s %10s %10s %9s' % ('Benchmark', 'Old (s)', 'New (s)', 'Speedup'))
+    for group in ['commands', 'stages']:
+        for name, res in results[group].items():
+            if name in old.get(group, {}):
+                before = old[group][name]['seconds']
+                print('%-22s %10.3f %10.3f %8.2fx' % (name, before, res['seconds'], before / res['seconds']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of metawave on a synthetic corpus')
+    parser.add_argument('--out_dir', required=True, help='Directory of the corpus and the outputs')
+    parser.add_argument('--readers', default=4, help='Number of readers (default=4)')
+    parser.add_argument('--utterances', default=50, help='Number of utterances per reader (default=50)')
+    parser.add_argument('--seed', default=0, help='Seed of the corpus (default=0)')
+    parser.add_argument('--workers', default=1, help='Workers of run and summary (default=1)')
+    parser.add_argument('--stage_files', default=50,
+        help='Number of files the analysis stages are timed on (default=50)')
+    parser.add_argument('--json', default=None, help='Results file (default=<out_dir>/bench.json)')
+    parser.add_argument('--compare', default=None, help='Results of an earlier benchmark to compare with')
+    args = parser.parse_args()
+
+    corpus_dir = os.path.join(args.out_dir, 'corpus')
+    out_dir = os.path.join(args.out_dir, 'out')
+    shutil.rmtree(args.out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    config = {'readers': int(args.readers), 'utterances': int(args.utterances), 'seed': int(args.seed),
+        'workers': int(args.workers), 'sr': SR}
+    print('Generating a corpus of %d utterances' % (config['readers'] * config['utterances']))
+    truth = make_corpus(corpus_dir, config['readers'], config['utterances'], config['seed'])
+    print('Timing the commands')
+    commands = bench_commands(corpus_dir, out_dir, truth, config['workers'])
+    print('Timing the analysis stages')
+    stages = bench_stages(corpus_dir, truth, int(args.stage_files))
+    results = {'versions': versions(), 'config': config, 'commands': commands, 'stages': stages}
+
+    print('%-22s %10s %12s' % ('Command', 'Seconds', 'Items/sec'))
+    for name, res in commands.items():
+        print('%-22s %10.3f %12.1f' % (name, res['seconds'], res.get('items_per_second', 0)))
+    print('%-22s %10s %12s %10s %10s' % ('Stage', 'Seconds', 'x Realtime', 'MAE (Hz)', 'Gross err'))
+    for name, res in stages.items():
+        acc = res.get('accuracy')
+        print('%-22s %10.3f %12.1f %10s %10s' % (name, res['seconds'], res['realtime'],
+            '%0.2f' % acc['mae_hz'] if acc else '-', '%0.3f' % acc['gross_error_rate'] if acc else '-'))
+    acc = commands['run']['accuracy']
+    print('F0 of run: MAE %0.2f Hz, mean relative error %0.4f, gross errors %0.3f'
+        % (acc['mae_hz'], acc['mean_rel_error'], acc['gross_error_rate']))
+
+    json_path = args.json or os.path.join(args.out_dir, 'bench.json')
+    with open(json_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results are available at ', json_path)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+'''
+    Startup benchmark of the command line. Each subcommand is
+    run in a fresh interpreter with `python -X importtime` on
+    a small generated dataset, and the time spent importing
+    modules is compared to the budget of the subcommand.
+    Subcommands that never touch audio or plots must not
+    import the scientific stack at all.
+
+    python -m metawave.tests.importtime [--repeat 5] [--json out.json]
+
+    Exits with 1 if a budget is exceeded or a heavy module
+    is imported where it should not be.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ['librosa', 'pyworld', 'matplotlib', 'numba', 'scipy']
+
+RUN_MAIN = 'import sys; sys.argv[0] = "metawave"; from metawave.metawave import main; main()'
+
+def subcommands(data_dir):
+    '''
+        (name, arguments, stdin, budget in ms, forbidden modules)
+        of each benchmarked subcommand
+    '''
+    text_dir = os.path.join(data_dir, 'text')
+    wav_dir = os.path.join(data_dir, 'wavs')
+    meta_path = os.path.join(data_dir, 'meta.tsv')
+    return [
+        ('help', ['-h'], None, 150, HEAVY_MODULES),
+        ('search', ['search', '--text_dir', text_dir, 'hestur'], None, 150, HEAVY_MODULES),
+        ('gen_index', ['gen_index', '--wav_dir', wav_dir, '--text_dir', text_dir,
+            '--out_dir', data_dir], 'y\n', 400, HEAVY_MODULES),
+        ('convert', ['convert', '--meta_path', meta_path,
+            '--out_path', os.path.join(data_dir, 'meta.store')], None, 400, HEAVY_MODULES),
+        ('cache', ['cache', 'stats', '--cache_dir', os.path.join(data_dir, 'cache')], None, 150,
+            HEAVY_MODULES),
+    ]
+
+def make_dataset(data_dir):
+    '''
+        A few empty token and audio files and a meta file,
+        enough for the light subcommands to do their work
+    '''
+    for sub in ['text', 'wavs']:
+        os.makedirs(os.path.join(data_dir, sub), exist_ok=True)
+    for i in range(10):
+        with open(os.path.join(data_dir, 'text', 'utt-%03d.txt' % i), 'w') as f:
+            f.write('hestur og kona\n')
+        open(os.path.join(data_dir, 'wavs', 'utt-%03d.wav' % i), 'w').close()
+    with open(os.path.join(data_dir, 'meta.tsv'), 'w') as f:
+        for i in range(10):
+            f.write('utt-%03d\treader\t 5.0000 \t 150.0000 \n' % i)
+
+def profile_command(args, stdin=None):
+    '''
+        Runs the command line with args in a new interpreter.
+        Returns the total import time in ms and the set of
+        imported modules.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', RUN_MAIN] + args,
+        input=stdin, capture_output=True, text=True, env=env)
+    total_us = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        total_us += int(self_us)
+        modules.add(name.strip())
+    return total_us / 1000, modules
+
+def heavy_imports(modules, forbidden):
+    return sorted(m for m in modules if m.split('.')[0] in forbidden)
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark of the command line')
+    parser.add_argument('--repeat', default=5, help='Runs of each subcommand (default=5)')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    ok = True
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_dataset(data_dir)
+        print('%-10s %10s %10s   %s' % ('Command', 'Import ms', 'Budget ms', 'Heavy modules'))
+        for name, cmd_args, stdin, budget, forbidden in subcommands(data_dir):
+            times = []
+            for _ in range(int(args.repeat)):
+                ms, modules = profile_command(cmd_args, stdin)
+                times.append(ms)
+            heavy = heavy_imports(modules, forbidden)
+            median = statistics.median(times)
+            passed = median <= budget and len(heavy) == 0
+            ok = ok and passed
+            print('%-10s %10.1f %10d   %s%s' % (name, median, budget, ', '.join(heavy) or '-',
+                '' if passed else '   FAILED'))
+            results.append({'command': name, 'import_ms': median, 'budget_ms': budget,
+                'heavy_modules': heavy, 'passed': passed})
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,39 @@
 import unittest
+import os
 import re
+import tempfile
+import threading
+import time
+import json
+import io
+from unittest import mock
+from urllib.request import urlopen
 
-from metawave.utils.audio import naive_syllable_count
-from metawave.utils.index import gen_line_reg, gen_index_line
+import numpy as np
+
+from metawave.commands import (ReaderSet, StreamingReaderSet, analyze_utterance, analysis_params, index_jobs,
+                               merge_shards, pack_audio, prefetch_job, read_meta_ids, read_token, run,
+                               select_outliers)
+from metawave.search import SearchHandler, SearchIndex, TermMatcher, build_index
+from metawave.server import SearchService, make_server
+from metawave.utils.audio import (F0_METHODS, batch_frame_energy, dio_F0, frame_energy, load_audio, mean_F0,
+                                  naive_syllable_count, resample, segmented_F0)
+from metawave.tests.bench import f0_accuracy, make_corpus, reader_voice, utterance
+from metawave.utils.audio_pack import AudioPack
+from metawave.tests.importtime import heavy_imports, make_dataset, profile_command, subcommands
+from metawave.utils import features
+from metawave.utils.defaults import F0_METHOD_NAMES, FEATURE_NAMES, PLOT_STYLES
+from metawave.utils.pipeline import BackgroundWriter, Prefetcher
+from metawave.utils.outliers import CHUNK_SIZE, QuantileSketch, group_medians, keep_threshold, outlier_scores
+from metawave.utils.plots import save_reader_compare
+from metawave.utils.profile import RunProfile, recording, stage
+from metawave.utils.cache import FeatureCache, cache_key
+from metawave.utils.datasets import config_custom_paths, config_output_paths
+from metawave.utils.index import (IndexHandler, count_lines, gen_line_reg, gen_index_line, index_lines, pair_files,
+                                  shard_bounds, walk_files)
+from metawave.utils.stats import MetaStats, RunningStats
+from metawave.utils.store import MetaStore, MetaStoreWriter, store_to_tsv, tsv_to_store
+from metawave.utils.tokens import TokenPack, pack_tokens
 
 class TestSyllableCount(unittest.TestCase):
 
@@ -15,6 +46,269 @@ class TestSyllableCount(unittest.TestCase):
         self.assertEqual(naive_syllable_count('Auður'), 2,
             msg='Naive syllable count failed for a double syllable') 
 
+class TestF0(unittest.TestCase):
+
+    def harmonic_tone(self, f0, sr=16000, seconds=1.0):
+        t = np.arange(int(sr * seconds)) / sr
+        return sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 4))
+
+    def test_mean_F0_excludes_silence(self):
+        F0 = np.array([0.0, 100.0, 0.0, 200.0])
+        self.assertEqual(mean_F0(F0), 150.0)
+        self.assertEqual(mean_F0(F0, exclude_silence=False), 75.0)
+
+    def test_methods_on_tone(self):
+        for method in F0_METHODS:
+            for f0 in [100.0, 220.0]:
+                estimate = dio_F0(self.harmonic_tone(f0), 16000, method=method)
+                self.assertAlmostEqual(estimate, f0, delta=0.02 * f0,
+                    msg='F0 method %s is off for a %0.0f Hz tone' % (method, f0))
+
+    def test_poly_resample(self):
+        tone = self.harmonic_tone(150.0, sr=44100)
+        resampled = resample(tone, 44100, 22000, 'poly')
+        self.assertEqual(len(resampled), 22000)
+        self.assertAlmostEqual(dio_F0(resampled, 22000), 150.0, delta=1.0)
+
+    def test_segmented_F0_agrees_with_whole_file(self):
+        import soundfile as sf
+        rng = np.random.RandomState(0)
+        voice = reader_voice(rng, 0)
+        parts = []
+        for _ in range(8):
+            parts += [utterance(rng, voice)[0], np.zeros(5000)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'session.wav')
+            sf.write(path, np.concatenate(parts), 22050, subtype='PCM_16')
+            audio, sr = load_audio(path, 16000)
+            whole = dio_F0(frame_energy(audio, sr).trim(audio), sr)
+            stats, duration = segmented_F0(path, 16000, segment_seconds=3.0)
+        # the stated tolerance of segmented_F0 for dio and stonemask
+        self.assertAlmostEqual(stats.mean, whole, delta=0.001 * whole)
+        # the trimmed duration is off by at most a frame of the energy
+        self.assertAlmostEqual(duration, frame_energy(audio, sr).duration(), delta=2 * 512 / sr)
+
+class TestFeatures(unittest.TestCase):
+
+    def test_feature_names(self):
+        self.assertEqual(FEATURE_NAMES, list(features.FEATURES))
+        self.assertEqual(features.select_features(['aperiodicity', 'energy', 'f0']),
+            ['spr', 'f0', 'energy', 'aperiodicity'])
+        self.assertEqual(features.feature_columns(['spr', 'energy']), ['spr', 'energy_db_mean', 'energy_db_std'])
+        with self.assertRaises(ValueError):
+            features.select_features(['loudness'])
+
+    def test_intermediates_are_shared(self):
+        sr = 16000
+        t = np.arange(sr) / sr
+        audio = np.concatenate([np.zeros(2000), 0.5 * np.sin(2 * np.pi * 150.0 * t), np.zeros(2000)])
+        params = {'exclude_silence': True, 'f0_method': 'dio', 'frame_period': 5.0}
+        calls = []
+        def counted(step):
+            def func(*args):
+                calls.append(step.name)
+                return step.func(*args)
+            return features.Step(step.name, step.needs, func)
+        counting = {name: counted(step) for name, step in features.INTERMEDIATES.items()}
+        with mock.patch.dict(features.INTERMEDIATES, counting):
+            feats = features.extract(FEATURE_NAMES, {'audio': audio, 'sr': sr, 'token': 'hestur'}, params)
+        self.assertEqual(sorted(calls), sorted(features.INTERMEDIATES))
+        self.assertAlmostEqual(feats['f0'], 150.0, delta=3.0)
+        self.assertLess(feats['f0_std'], 3.0)
+        self.assertAlmostEqual(feats['duration'], 1.0, delta=0.2)
+        self.assertTrue(0.0 < feats['aperiodicity'] < 1.0)
+        self.assertTrue(0.0 < feats['spectral_centroid'] < sr / 2)
+
+    def test_unused_values_are_freed(self):
+        inputs = {'audio': np.zeros(1000), 'sr': 16000, 'token': 'kona'}
+        self.assertEqual(features.extract(['syllables'], inputs, {}), {'syllables': 2})
+        self.assertEqual(inputs, {})
+
+class TestFrameEnergy(unittest.TestCase):
+
+    def clip(self, seed):
+        rs = np.random.RandomState(seed)
+        speech = rs.randn(rs.randint(5000, 20000))
+        pause = 1e-3 * rs.randn(4000)
+        silence = 1e-5 * rs.randn(rs.randint(3000, 9000))
+        return np.concatenate([silence, speech, pause, speech, silence])
+
+    def test_trim_matches_librosa(self):
+        import librosa
+        for seed in range(5):
+            audio = self.clip(seed)
+            _, bounds = librosa.effects.trim(audio)
+            self.assertEqual(frame_energy(audio).trim_bounds(), tuple(bounds))
+
+    def test_batch_matches_single(self):
+        clips = [self.clip(seed) for seed in range(3)]
+        for single, batched in zip([frame_energy(c) for c in clips], batch_frame_energy(clips)):
+            self.assertTrue(np.allclose(single.power, batched.power))
+            self.assertEqual(single.trim_bounds(), batched.trim_bounds())
+
+    def test_pauses(self):
+        energy = frame_energy(self.clip(0))
+        self.assertLess(energy.speech_ratio(), 1.0)
+        self.assertLess(energy.speech_duration(), energy.duration())
+
+class TestSearchIndex(unittest.TestCase):
+
+    def test_index_matches_scan(self):
+        tokens = {'a.token': 'Hér er hestur\n', 'b.token': 'Kona og\nhestur\n', 'c.token': 'Barn\n'}
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in tokens.items():
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(text)
+            index = SearchIndex(tmp)
+            self.assertEqual(index.refresh(), (3, 0, 0))
+            scan = SearchHandler(tmp)
+            for term in ['hestur', 'oghestur', 'B', 'ar', 'xyz']:
+                by_id = lambda r: r['id']
+                self.assertEqual(sorted(index.search(term), key=by_id), sorted(scan.search(term), key=by_id),
+                    msg='Index and scan differ for %s' % term)
+            os.remove(os.path.join(tmp, 'c.token'))
+            self.assertEqual(index.refresh(), (0, 0, 1))
+            self.assertEqual(index.search('Barn'), [])
+
+    def test_stale_index_is_used_until_refreshed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            token_dir = os.path.join(tmp, 'tokens')
+            os.makedirs(token_dir)
+            with open(os.path.join(token_dir, 'a.token'), 'w') as f:
+                f.write('Hér er hestur\n')
+            index_path = os.path.join(tmp, 'tokens.search_index')
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                build_index(token_dir, index_path)
+            saved = os.path.getmtime(index_path)
+            with open(os.path.join(token_dir, 'b.token'), 'w') as f:
+                f.write('Kona og hestur\n')
+            st = os.stat(token_dir)
+            os.utime(token_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                search = SearchHandler(token_dir, index_path)
+            self.assertIn('--build_index', out.getvalue())
+            self.assertEqual(search.search('hestur'), [{'id': 'a.token', 'tok': 'Hér er hestur'}])
+            self.assertEqual(os.path.getmtime(index_path), saved)
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                build_index(token_dir, index_path)
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                search = SearchHandler(token_dir, index_path)
+            self.assertEqual(out.getvalue(), '')
+            self.assertEqual(len(search.search('hestur')), 2)
+
+    def test_batch_search(self):
+        terms = ['he', 'she', 'his', 'hers', 'ers', 's', 'xyz', 'he']
+        matcher = TermMatcher(terms)
+        self.assertEqual(len(matcher.terms), 7)
+        for text in ['ushers', 'hishe', 'xyxyz', '']:
+            found = set(matcher.terms[i] for i in matcher.matches(text))
+            self.assertEqual(found, set(t for t in terms if t in text), msg='Wrong matches in %s' % text)
+        tokens = {'a.token': 'Hér er hestur\n', 'b.token': 'Kona og\nhestur\n', 'c.token': 'Barn\n'}
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in tokens.items():
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(text)
+            results = SearchHandler(tmp).batch_search(['hestur', 'oghestur', 'ar', 'xyz'])
+            self.assertEqual(results, {'hestur': ['a.token', 'b.token'], 'oghestur': ['b.token'],
+                'ar': ['c.token'], 'xyz': []})
+
+class TestTokenPack(unittest.TestCase):
+
+    def test_pack_matches_files(self):
+        tokens = {'a.token': 'Hér er hestur\n', 'b.token': 'Kona og\r\nhestur\n', 'c.token': '',
+            os.path.join('sub', 'd.token'): 'Barn\n'}
+        with tempfile.TemporaryDirectory() as tmp:
+            token_dir = os.path.join(tmp, 'tokens')
+            os.makedirs(os.path.join(token_dir, 'sub'))
+            for name, text in tokens.items():
+                with open(os.path.join(token_dir, name), 'w', newline='') as f:
+                    f.write(text)
+            pack_path = os.path.join(tmp, 'tokens.tokens')
+            self.assertEqual(pack_tokens(token_dir, pack_path, workers=2), 4)
+            pack = TokenPack(pack_path)
+            for name in tokens:
+                self.assertEqual(pack.get(name).lower(), read_token(os.path.join(token_dir, name)))
+            self.assertIn('sub/../sub/d.token', pack)
+            self.assertIsNone(pack.get('e.token'))
+            search = SearchHandler(None, None, pack_path)
+            self.assertEqual(search.search('oghestur'), [{'id': 'b.token', 'tok': 'Kona oghestur'}])
+            self.assertEqual(search.search('Barn'), [{'id': 'sub/d.token', 'tok': 'Barn'}])
+            self.assertEqual(search.batch_search(['hestur', 'ar']),
+                {'hestur': ['a.token', 'b.token'], 'ar': ['sub/d.token']})
+
+            # a run reads its tokens from the pack, not from the files
+            i_handler = IndexHandler(None, {'txt_ind': 0, 'wav_ind': 1, 'reader_ind': 2})
+            i_handler.set_token_extension('.token')
+            jobs = list(index_jobs(['a\ta.wav\tr1', 'e\te.wav\tr1'], i_handler,
+                {'text': token_dir, 'wavs': tmp}, {}, [], pack))
+            with mock.patch('metawave.commands.read_token', side_effect=AssertionError):
+                jobs = [prefetch_job(job) for job in jobs]
+            self.assertEqual(jobs[0]['token'], 'hér er hestur\n')
+            self.assertIn('not in the token pack', jobs[1]['read_error'])
+
+class TestAudioPack(unittest.TestCase):
+
+    def test_packed_audio_gives_the_same_features(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_corpus(tmp, 2, 3)
+            index_path = os.path.join(tmp, 'line_index.tsv')
+            pack_path = os.path.join(tmp, 'wavs.audio')
+            # a shard for every clip
+            self.assertEqual(pack_audio(os.path.join(tmp, 'wavs'), index_path, pack_path, 16000, shard_bytes=1), 6)
+            pack = AudioPack(pack_path)
+            self.assertEqual((len(pack), pack.sr), (6, 16000))
+            audio, sr, (start, end) = pack.clip(pack.find('reader_01_00002.wav'))
+            self.assertEqual(audio.dtype, np.float32)
+            self.assertTrue(0 <= start < end <= audio.shape[0])
+
+            i_handler = IndexHandler(None, {'txt_ind': 0, 'wav_ind': 1, 'reader_ind': 2})
+            paths = {'text': os.path.join(tmp, 'tokens'), 'wavs': os.path.join(tmp, 'wavs')}
+            params = analysis_params(16000)
+            names = ['duration', 'spr', 'f0', 'energy']
+            with open(index_path) as f:
+                lines = f.readlines()
+            decoded = [analyze_utterance(job) for job in index_jobs(lines, i_handler, paths, params, names)]
+            jobs = list(index_jobs(lines + ['x.token\tx.wav\treader_00'], i_handler, paths, params, names, audio=pack))
+            self.assertIn('not in the audio pack', jobs[-1]['read_error'])
+            with mock.patch('metawave.utils.audio.load_audio', side_effect=AssertionError):
+                packed = [analyze_utterance(prefetch_job(job)) for job in jobs[:-1]]
+            for a, b in zip(decoded, packed):
+                for name, value in a.items():
+                    self.assertAlmostEqual(value, b[name], places=4)
+
+class TestSearchServer(unittest.TestCase):
+
+    def test_search_over_http(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'a.token'), 'w') as f:
+                f.write('Hér er hestur\n')
+            server = make_server(SearchService(tmp), port=0, quiet=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            try:
+                self.assertEqual(json.load(urlopen(url + '/health'))['tokens'], 1)
+                results = json.load(urlopen(url + '/search?term=hestur'))['results']
+                self.assertEqual(results, [{'id': 'a.token', 'tok': 'Hér er hestur'}])
+                with open(os.path.join(tmp, 'b.token'), 'w') as f:
+                    f.write('Kona og hestur\n')
+                urlopen(url + '/refresh', data=b'')
+                batch = json.load(urlopen(url + '/batch', data=json.dumps({'terms': ['hestur']}).encode()))
+                self.assertEqual(batch['results'], {'hestur': ['a.token', 'b.token']})
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_socket_path_that_is_not_a_socket_is_kept(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'notes.txt')
+            with open(path, 'w') as f:
+                f.write('keep me\n')
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                with self.assertRaises(SystemExit):
+                    make_server(SearchService(tmp), socket_path=path, quiet=True)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'keep me\n')
+
 class TestRegEx(unittest.TestCase):
 
     def test_simple_names(self):
@@ -66,5 +360,486 @@ class TestRegEx(unittest.TestCase):
         expected = 'dataset_999.token\tdataset_999.wav'
         self.assertEqual(actual, expected)
 
+class TestGenIndex(unittest.TestCase):
+
+    def test_nested_pairs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = ['text/a/001-r1.txt', 'text/a/002-r1.txt', 'text/b/003-r2.txt', 'text/004-r2.txt',
+                'wav/a/001-r1.wav', 'wav/other/003-r2.wav', 'wav/x/005-r2.wav']
+            for fn in files:
+                os.makedirs(os.path.dirname(os.path.join(tmp, fn)), exist_ok=True)
+                open(os.path.join(tmp, fn), 'w').close()
+            text_files = walk_files(os.path.join(tmp, 'text'), workers=2)
+            wav_files = walk_files(os.path.join(tmp, 'wav'), workers=2)
+            self.assertEqual(text_files, [os.path.join(*p.split('/')) for p in
+                ['004-r2.txt', 'a/001-r1.txt', 'a/002-r1.txt', 'b/003-r2.txt']])
+            pairs = [(fn, wav, problem) for fn, wav, rm, problem in
+                pair_files(text_files, wav_files, gen_line_reg('i-r'))]
+            join = lambda p: os.path.join(*p.split('/'))
+            self.assertEqual(pairs, [
+                ('004-r2.txt', None, 'no audio'),
+                (join('a/001-r1.txt'), join('a/001-r1.wav'), None),
+                (join('a/002-r1.txt'), None, 'no audio'),
+                (join('b/003-r2.txt'), join('other/003-r2.wav'), None),
+                (None, join('x/005-r2.wav'), 'no text')])
+
+    def test_pair_by_name_does_not_reuse_audio(self):
+        join = lambda p: os.path.join(*p.split('/'))
+        reg = gen_line_reg(None)
+        for texts in [['r1/001.txt', 'r2/001.txt'], ['r2/001.txt', 'r1/001.txt']]:
+            pairs = {fn: (wav, problem) for fn, wav, rm, problem in
+                pair_files([join(t) for t in texts], [join('r1/001.wav')], reg)}
+            self.assertEqual(pairs[join('r1/001.txt')], (join('r1/001.wav'), None))
+            self.assertIsNone(pairs[join('r2/001.txt')][0])
+            self.assertIn('ambiguous', pairs[join('r2/001.txt')][1])
+        pairs = [(fn, wav) for fn, wav, rm, problem in
+            pair_files([join('a/001.txt'), join('b/001.txt')], [join('w/001.wav')], reg)]
+        self.assertEqual(pairs, [(join('a/001.txt'), join('w/001.wav')), (join('b/001.txt'), None)])
+
+class TestPipeline(unittest.TestCase):
+
+    def test_prefetch_order_and_cap(self):
+        started = []
+        prefetcher = Prefetcher(range(50), lambda i: started.append(i) or i * 2, read_ahead=5, threads=3)
+        written = []
+        writer = BackgroundWriter(written.append, max_queue=2)
+        for i, value in enumerate(prefetcher):
+            # nothing is read more than read_ahead jobs ahead of the writer
+            self.assertLessEqual(len(started), i + 5)
+            writer.put(value)
+            prefetcher.release()
+        writer.close()
+        self.assertEqual(written, [i * 2 for i in range(50)])
+
+    def test_stop_cancels_waiting_reads(self):
+        started = []
+        gate = threading.Event()
+        prefetcher = Prefetcher(range(10), lambda i: started.append(i) or gate.wait(5) and i,
+            read_ahead=5, threads=1)
+        first = []
+        reader = threading.Thread(target=lambda: first.append(next(iter(prefetcher))))
+        reader.start()
+        while not started:
+            time.sleep(0.01)
+        prefetcher.stop()
+        gate.set()
+        reader.join()
+        self.assertEqual(first, [0])
+        self.assertEqual(started, [0])
+
+    def test_workers_write_the_same_meta(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_corpus(tmp, 3, 3)
+            outputs = []
+            for workers in [1, 3]:
+                out_dir = os.path.join(tmp, 'out-%d' % workers)
+                os.makedirs(out_dir)
+                run_corpus(tmp, out_dir, workers=workers, store=True)
+                names = ['meta.tsv', 'meta_errors.tsv', 'meta_stats.json']
+                names += [os.path.join('meta.store', name) for name in os.listdir(os.path.join(out_dir, 'meta.store'))]
+                files = {}
+                for name in names:
+                    with open(os.path.join(out_dir, name), 'rb') as f:
+                        files[name] = f.read()
+                outputs.append(files)
+            self.assertEqual(len(outputs[0]['meta.tsv'].splitlines()), 9)
+            self.assertEqual(sorted(outputs[1]), sorted(outputs[0]))
+            for name, data in outputs[0].items():
+                self.assertEqual(outputs[1][name], data, msg='%s differs between 1 and 3 workers' % name)
+
+    def test_run_analyses_long_recordings_in_segments(self):
+        import soundfile as sf
+        rng = np.random.RandomState(1)
+        voice = reader_voice(rng, 0)
+        parts, tokens = [], []
+        for _ in range(6):
+            audio, token, _ = utterance(rng, voice)
+            parts += [audio, np.zeros(5000)]
+            tokens.append(token)
+        with tempfile.TemporaryDirectory() as tmp:
+            make_corpus(tmp, 1, 2)
+            sf.write(os.path.join(tmp, 'wavs', 'session.wav'), np.concatenate(parts), 22050, subtype='PCM_16')
+            with open(os.path.join(tmp, 'tokens', 'session.token'), 'w') as f:
+                f.write(' '.join(tokens) + '\n')
+            with open(os.path.join(tmp, 'line_index.tsv'), 'a') as f:
+                f.write('session.token\tsession.wav\treader_00\n')
+            meta = []
+            for segment_seconds in [None, 3.0]:
+                out_dir = os.path.join(tmp, 'out-%s' % segment_seconds)
+                os.makedirs(out_dir)
+                with mock.patch('metawave.utils.audio.load_audio', wraps=load_audio) as loaded:
+                    paths = run_corpus(tmp, out_dir, segment_seconds=segment_seconds)
+                whole = [os.path.basename(call.args[0]) for call in loaded.call_args_list
+                    if isinstance(call.args[0], str)]
+                self.assertEqual(os.path.getsize(paths['error_file']), 0)
+                with open(paths['out_file']) as f:
+                    meta.append({line.split('\t')[0]: [float(v) for v in line.split('\t')[2:]] for line in f})
+            # the short utterances are read whole, the session in segments
+            self.assertNotIn('session.wav', whole)
+            self.assertEqual(len(meta[1]), 3)
+            for utt_id, (spr, f0) in meta[0].items():
+                self.assertAlmostEqual(meta[1][utt_id][0], spr, delta=0.01 * spr)
+                self.assertAlmostEqual(meta[1][utt_id][1], f0, delta=0.002 * f0)
+
+class TestShards(unittest.TestCase):
+
+    def test_shards_cover_index(self):
+        lines = ['%s\tr%d\n' % ('x' * (i % 13), i) for i in range(101)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'line_index.tsv')
+            with open(path, 'w') as f:
+                f.write(''.join(lines))
+            self.assertEqual(count_lines(path), 101)
+            for n in [1, 2, 7, 300]:
+                found = []
+                with open(path, 'rb') as f:
+                    for i in range(n):
+                        start, stop = shard_bounds(path, i, n)
+                        shard = list(index_lines(f, start, stop))
+                        self.assertEqual(count_lines(path, start, stop), len(shard))
+                        found += shard
+                self.assertEqual(found, lines, msg='Shards do not cover the index for N=%d' % n)
+
+    def test_merge(self):
+        rows = ['utt%d\tr%d\t 5.0000 \t 100.0000 \n' % (i, i % 2) for i in range(6)]
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(3):
+                with open(os.path.join(tmp, 'meta-%d-of-3.tsv' % i), 'w') as f:
+                    f.write(''.join(rows[2 * i:2 * i + 2]))
+            # a row that a killed shard only wrote partly
+            with open(os.path.join(tmp, 'meta-1-of-3.tsv'), 'a') as f:
+                f.write('utt9\tr0\t 5.0')
+            paths = config_output_paths(tmp)
+            merge_shards(paths)
+            with open(paths['out_file']) as f:
+                self.assertEqual(f.read(), ''.join(rows))
+            stats = MetaStats.load(paths['stats'])
+            self.assertEqual(list(stats.readers), ['r0', 'r1'])
+            self.assertEqual(stats.get_num_samples(), 6)
+
+def run_corpus(root, out_dir, workers=1, **kwargs):
+    '''
+        Runs the corpus of make_corpus at root, writing to out_dir
+    '''
+    paths = config_custom_paths(os.path.join(root, 'wavs'), os.path.join(root, 'tokens'),
+        os.path.join(root, 'line_index.tsv'), out_dir)
+    run(16000, paths, None, ind={'txt_ind': 0, 'wav_ind': 1, 'reader_ind': 2}, token_xtsn='.token',
+        num_samples=None, workers=workers, **kwargs)
+    return paths
+
+class TestFeatureCache(unittest.TestCase):
+
+    def test_key_changes_with_files_and_params(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            wav, token = os.path.join(tmp, 'a.wav'), os.path.join(tmp, 'a.token')
+            for path in [wav, token]:
+                with open(path, 'w') as f:
+                    f.write('x')
+            params = analysis_params(16000)
+            key = cache_key(wav, token, params)
+            self.assertEqual(cache_key(wav, token, dict(params)), key)
+            self.assertNotEqual(cache_key(wav, token, analysis_params(22050)), key)
+            self.assertNotEqual(cache_key(wav, token, analysis_params(16000, 'harvest')), key)
+            st = os.stat(wav)
+            os.utime(wav, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            moved = cache_key(wav, token, params)
+            self.assertNotEqual(moved, key)
+            with open(token, 'w') as f:
+                f.write('xy')
+            self.assertNotEqual(cache_key(wav, token, params), moved)
+
+    def test_least_recently_used_are_evicted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = FeatureCache(tmp, max_entries=2)
+            with mock.patch('metawave.utils.cache.time.time', side_effect=range(1, 100)):
+                cache.put('a', {'f0': 1.0})
+                cache.put('b', {'f0': 2.0})
+                cache.put('b', {'f0': 3.0})
+                cache.commit()
+                self.assertEqual(cache.get('a'), {'f0': 1.0})
+                cache.commit()
+                cache.put('c', {'f0': 4.0})
+                cache.commit()
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(cache.get('a'), {'f0': 1.0})
+            self.assertEqual(cache.stats()['entries'], 2)
+            cache.close()
+            reopened = FeatureCache(tmp, max_entries=2)
+            self.assertEqual(reopened.stats()['entries'], 2)
+            reopened.close()
+
+    def test_run_hits_the_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_corpus(tmp, 2, 2)
+            first, second = os.path.join(tmp, 'first'), os.path.join(tmp, 'second')
+            os.makedirs(first)
+            os.makedirs(second)
+            cache = FeatureCache(os.path.join(tmp, 'cache'))
+            run_corpus(tmp, first, cache=cache)
+            with mock.patch('metawave.commands.extract', side_effect=AssertionError('analysed again')):
+                paths = run_corpus(tmp, second, cache=cache)
+            cache.close()
+            with open(os.path.join(first, 'meta.tsv')) as a, open(paths['out_file']) as b:
+                meta = a.read()
+                self.assertEqual(len(meta.splitlines()), 4)
+                self.assertEqual(b.read(), meta)
+            self.assertEqual(os.path.getsize(paths['error_file']), 0)
+
+class TestResume(unittest.TestCase):
+
+    def test_read_meta_ids(self):
+        # a run that was killed can leave a partially written row
+        # which has to be dropped before appending
+        with tempfile.TemporaryDirectory() as tmp:
+            meta_path = os.path.join(tmp, 'meta.tsv')
+            with open(meta_path, 'w') as f:
+                f.write('a.token\tr1\t 4.0000 \t 100.0000 \n')
+                f.write('b.token\tr1\t 5.0000 \t 110.0000 \n')
+                f.write('c.tok')
+            self.assertEqual(read_meta_ids(meta_path), {'a.token', 'b.token'})
+            with open(meta_path) as f:
+                self.assertEqual(len(f.read().splitlines()), 2)
+
+    def test_failed_utterances_are_listed_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_corpus(tmp, 2, 2)
+            out_dir = os.path.join(tmp, 'out')
+            os.makedirs(out_dir)
+            wav = os.path.join(tmp, 'wavs', 'reader_01_00001.wav')
+            os.rename(wav, wav + '.bak')
+            with open(wav, 'w') as f:
+                f.write('not audio')
+            paths = run_corpus(tmp, out_dir)
+            for i in range(2):
+                run_corpus(tmp, out_dir, resume=True)
+                with open(paths['error_file']) as f:
+                    errors = f.read().splitlines()
+                self.assertEqual([line.split('\t')[0] for line in errors], ['reader_01_00001.token'])
+            os.replace(wav + '.bak', wav)
+            run_corpus(tmp, out_dir, resume=True)
+            self.assertEqual(os.path.getsize(paths['error_file']), 0)
+            self.assertIn('reader_01_00001.token', read_meta_ids(paths['out_file']))
+
+class TestOutliers(unittest.TestCase):
+
+    def test_select_matches_stable_sort(self):
+        rs = np.random.RandomState(0)
+        # few distinct values so many errors are tied at the cut
+        err = rs.randint(0, 20, size=500) / 7.0
+        for num_keep in [0, 1, 250, 333, 499, 500]:
+            order = sorted(range(len(err)), key=lambda i: err[i])
+            expected = np.zeros(len(err), dtype=bool)
+            expected[order[num_keep:]] = True
+            self.assertTrue(np.array_equal(select_outliers(err, num_keep), expected))
+
+    def test_cut_over_chunks(self):
+        err = np.random.RandomState(1).lognormal(0, 2, size=10000)
+        err[::7] = 0.0
+        chunks = lambda: (err[i:i + 999] for i in range(0, len(err), 999))
+        cut = keep_threshold(chunks, 8000)
+        is_outlier = np.concatenate([cut.mark(c) for c in chunks()])
+        self.assertTrue(np.array_equal(is_outlier, select_outliers(err, 8000)))
+        self.assertEqual(np.count_nonzero(is_outlier), 2000)
+
+    def test_sketch_quantiles(self):
+        values = np.random.RandomState(2).exponential(3.0, size=100000)
+        sketch, other = QuantileSketch(0.01), QuantileSketch(0.01)
+        sketch.update(values[:50000])
+        other.update(values[50000:])
+        sketch.merge(other)
+        for q in [0.1, 0.5, 0.9, 0.99]:
+            self.assertAlmostEqual(sketch.quantile(q), np.quantile(values, q), delta=0.02 * np.quantile(values, q))
+
+    def test_reader_normalization(self):
+        rs = np.random.RandomState(3)
+        # a high pitched reader and a low pitched one, each with one odd utterance
+        codes = np.repeat([0, 1], 200)
+        X = np.column_stack([rs.normal(5, 0.5, 400), np.where(codes == 0, 100.0, 220.0) + rs.normal(0, 5, 400)])
+        X[10, 1] = 130.0
+        X[300, 1] = 190.0
+        for method in ['reader_z', 'mad', 'mahalanobis']:
+            err = outlier_scores(X, codes, 2, method)
+            self.assertEqual(set(np.argsort(err)[-2:]), {10, 300}, msg=method)
+        # the global score only sees how far each reader is from the middle
+        err = outlier_scores(X, codes, 2, 'global')
+        self.assertFalse({10, 300} <= set(np.argsort(err)[-2:]))
+
+    def test_group_medians(self):
+        rs = np.random.RandomState(4)
+        codes = rs.randint(0, 5, size=20001)
+        V = np.round(rs.normal(5, 2, size=(20001, 2)), 1)
+        V[:40, 0] = -1.0
+        chunks = lambda: ((codes[i:i + 3000], V[i:i + 3000]) for i in range(0, len(codes), 3000))
+        medians = group_medians(chunks, 5, 2, np.bincount(codes))
+        for g in range(5):
+            self.assertTrue(np.array_equal(medians[g], np.median(V[codes == g], axis=0)))
+
+    def test_streaming_matches_in_memory(self):
+        rs = np.random.RandomState(5)
+        n = 2 * CHUNK_SIZE + 1234
+        readers = rs.randint(0, 6, size=n)
+        # rounded values give many tied errors at the cut
+        spr = np.round(rs.normal(6, 1, size=n), 1)
+        f0 = np.round(rs.normal(150 + 10 * readers, 20), 0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            meta_path = os.path.join(tmp_dir, 'meta.tsv')
+            with open(meta_path, 'w') as f:
+                f.writelines('u%d\tr%d\t %0.4f \t %0.4f \t 1.0 \n' % row for row in zip(range(n), readers, spr, f0))
+            for method in ['global', 'reader_z', 'mad', 'mahalanobis']:
+                outputs = []
+                for i, reader_set in enumerate([ReaderSet(meta_path),
+                        StreamingReaderSet(meta_path, tempfile.mkdtemp(dir=tmp_dir), CHUNK_SIZE)]):
+                    out_dir = os.path.join(tmp_dir, '%s-%d' % (method, i))
+                    os.makedirs(out_dir)
+                    reader_set.set_outliers(0.8, method)
+                    reader_set.write_index(out_dir)
+                    reader_set.write_summary(out_dir)
+                    outputs.append([open(os.path.join(out_dir, fn)).read()
+                        for fn in ['outlier_index.txt', 'clean_index.txt', 'summary.log']])
+                self.assertEqual(outputs[0], outputs[1], msg=method)
+                self.assertEqual(outputs[0][0].count('\n'), n - int(0.8 * n))
+
+class TestProfile(unittest.TestCase):
+
+    def test_stages(self):
+        stages = {}
+        with stage('decode'):
+            # not recording
+            pass
+        with recording(stages):
+            with stage('dio'):
+                sum(range(10000))
+            with stage('dio'):
+                pass
+            with recording(None), stage('write'):
+                pass
+        self.assertEqual(list(stages), ['dio'])
+        self.assertGreater(stages['dio'][0], 0)
+
+    def test_report(self):
+        profile = RunProfile()
+        for i in range(10):
+            profile.add('utt-%d' % i, {'decode': [0.01, 0.01], 'dio': [0.1 * (i + 1), 0.1]}, 2.0, 100.0)
+        profile.add('cached', None)
+        report = profile.report()
+        self.assertEqual(report['utterances'], 11)
+        self.assertEqual(report['cached'], 1)
+        self.assertAlmostEqual(report['audio_seconds'], 20.0)
+        self.assertAlmostEqual(report['stages']['dio']['wall_ms']['max'], 1000.0)
+        self.assertEqual(report['slowest'][0]['id'], 'utt-9')
+        self.assertEqual(report['peak_worker_rss_mb'], 100.0)
+
+class TestPlots(unittest.TestCase):
+
+    def test_reader_compare_styles(self):
+        rng = np.random.RandomState(0)
+        readers = [('r%d' % i, rng.rand(50) * 10, rng.rand(50) * 300) for i in range(3)]
+        is_outlier = [rng.rand(50) > 0.9 for _ in readers]
+        for style in PLOT_STYLES:
+            with tempfile.TemporaryDirectory() as tmp:
+                save_reader_compare(tmp, readers, is_outlier, style)
+                self.assertEqual(sorted(os.listdir(tmp)), ['reader_compare.png', 'reader_compare_clean.png'],
+                    msg='Missing plots for the %s style' % style)
+
+class TestStartup(unittest.TestCase):
+
+    def test_light_commands_skip_heavy_imports(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            make_dataset(tmp)
+            for name, args, stdin, _, forbidden in subcommands(tmp):
+                _, modules = profile_command(args, stdin)
+                self.assertIn('metawave.metawave', modules)
+                self.assertEqual(heavy_imports(modules, forbidden), [],
+                    msg='%s imports the scientific stack' % name)
+
+    def test_f0_method_names(self):
+        self.assertEqual(F0_METHOD_NAMES, list(F0_METHODS))
+
+class TestBench(unittest.TestCase):
+
+    def test_synthetic_corpus(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            truth = make_corpus(os.path.join(tmp, 'a'), 2, 2, seed=3)
+            self.assertEqual(truth, make_corpus(os.path.join(tmp, 'b'), 2, 2, seed=3))
+            with open(os.path.join(tmp, 'a', 'line_index.tsv')) as f:
+                self.assertEqual(len(f.readlines()), 4)
+            estimates = {}
+            for utt_id in truth:
+                audio, sr = load_audio(os.path.join(tmp, 'a', 'wavs', utt_id.replace('.token', '.wav')), 16000)
+                estimates[utt_id] = dio_F0(frame_energy(audio, sr).trim(audio), sr)
+            self.assertLess(f0_accuracy(estimates, truth)['mean_rel_error'], 0.02)
+
+class TestRunStats(unittest.TestCase):
+
+    def test_running_stats(self):
+        values = np.random.RandomState(0).normal(150, 20, size=1000)
+        first, second = RunningStats(), RunningStats()
+        for x in values[:300]:
+            first.update(x)
+        for x in values[300:]:
+            second.update(x)
+        first.merge(second)
+        self.assertEqual(first.n, 1000)
+        self.assertAlmostEqual(first.mean, np.mean(values))
+        self.assertAlmostEqual(first.stddev(), np.std(values))
+
+    def test_save_load(self):
+        stats = MetaStats()
+        stats.update('r2', 5.0, 200.0)
+        stats.update('r1', 6.0, 100.0)
+        stats.update('r2', 7.0, 1000.0)
+        with tempfile.TemporaryDirectory() as tmp:
+            stats.save(os.path.join(tmp, 'stats.json'))
+            loaded = MetaStats.load(os.path.join(tmp, 'stats.json'))
+        self.assertEqual(list(loaded.readers), ['r2', 'r1'])
+        self.assertEqual(loaded.readers['r2'].get_spr_mean(), 6.0)
+        # out of range values fall in the last bin
+        self.assertEqual(loaded.readers['r2'].f0_hist.counts[-1], 1)
+
+class TestMetaStore(unittest.TestCase):
+
+    def test_roundtrip(self):
+        rows = 'a.token\tr1\t 4.1234 \t 100.5000 \nb.token\tr2\t 5.0000 \t 210.0001 \n' + \
+            'c.token\tr1\t 6.5000 \t 99.9999 \n'
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'meta.tsv'), 'w') as f:
+                f.write(rows)
+            self.assertEqual(tsv_to_store(os.path.join(tmp, 'meta.tsv'), os.path.join(tmp, 'store')), 3)
+            store = MetaStore(os.path.join(tmp, 'store'))
+            self.assertEqual(list(store.utt_ids), ['a.token', 'b.token', 'c.token'])
+            self.assertEqual(store.reader_ids, ['r1', 'r2'])
+            self.assertEqual(list(store.values['f0']), [100.5, 210.0001, 99.9999])
+            store_to_tsv(os.path.join(tmp, 'store'), os.path.join(tmp, 'back.tsv'))
+            with open(os.path.join(tmp, 'back.tsv')) as f:
+                self.assertEqual(f.read(), rows)
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = MetaStoreWriter(tmp)
+            writer.write('a', 'r1', {'spr': 1.0, 'f0': 100.0})
+            writer.close()
+            writer = MetaStoreWriter(tmp, append=True)
+            writer.write('b', 'r2', {'spr': 2.0, 'f0': 200.0})
+            writer.write('c', 'r1', {'spr': 3.0, 'f0': 300.0})
+            writer.close()
+            store = MetaStore(tmp)
+            self.assertEqual(len(store), 3)
+            self.assertEqual([store.reader_ids[c] for c in store.reader_codes], ['r1', 'r2', 'r1'])
+
+    def test_refuses_a_directory_that_is_not_a_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            meta_path = os.path.join(tmp, 'meta.tsv')
+            with open(meta_path, 'w') as f:
+                f.write('a.token\tr1\t 4.0000 \t 100.0000 \n')
+            with self.assertRaises(ValueError):
+                tsv_to_store(meta_path, tmp)
+            self.assertTrue(os.path.exists(meta_path))
+            # replacing a store leaves other files in its directory alone
+            store_path = os.path.join(tmp, 'store')
+            tsv_to_store(meta_path, store_path)
+            os.makedirs(os.path.join(store_path, 'notes'))
+            self.assertEqual(tsv_to_store(meta_path, store_path), 1)
+            self.assertTrue(os.path.isdir(os.path.join(store_path, 'notes')))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,11 @@
-# Util sub-modules
-from . import audio
-from . import datasets
-from . import energy
-from . import index
-from . import misc
\ No newline at end of file
+# Util sub-modules, imported on first use so that
+# `import metawave.utils` does not load the scientific stack
+import importlib
+
+_SUBMODULES = ['audio', 'audio_pack', 'cache', 'datasets', 'defaults', 'energy', 'features', 'index', 'misc',
+    'outliers', 'pipeline', 'plots', 'profile', 'stats', 'store', 'tokens']
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,213 @@
+'''
+    An audio pack holds the decoded audio of every utterance
+    of an index, resampled to the analysis rate, in a few
+    large shard files. A run then reads each utterance as a
+    view of a memory mapped shard instead of decoding and
+    resampling its audio file.
+
+    A pack is a directory of shards, shard-00000.audio,
+    shard-00001.audio, ..., and each shard has
+    * a header: MAGIC, the number of clips, the length of the
+      id blob, the number of samples, the sample rate (0 if
+      each file kept its own rate), the trim parameters top_db,
+      frame_length and hop_length and the resampler
+    * the samples of every clip as float32, one after the other
+    * a table of int64 rows, one per clip: its sample rate, the
+      first and last sample of the clip and the first and last
+      sample of the trimmed clip, both in the samples of the shard
+    * the end offset of each id in the id blob, as int64
+    * the id blob: the path of each audio file relative to the
+      wav directory, UTF-8, sorted so ids are found by bisection
+
+    The whole clip is kept, not only the trimmed one, as the
+    duration and energy features are read off the frames of
+    the untrimmed audio.
+'''
+import bisect
+import glob
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from .defaults import DEFAULT_SHARD_MB
+from .tokens import _IdList, token_id
+
+MAGIC = b'MWAUDPK1'
+HEADER = struct.Struct('<8sQQQQdQQ16s')
+TABLE_COLUMNS = 5
+SHARD_PATTERN = 'shard-%05d.audio'
+# the largest shard written, in bytes of samples
+DEFAULT_SHARD_BYTES = DEFAULT_SHARD_MB * 2**20
+
+def shard_paths(pack_path):
+    return sorted(glob.glob(os.path.join(pack_path, SHARD_PATTERN.replace('%05d', '[0-9]' * 5))))
+
+
+class AudioPackWriter:
+    '''
+        Writes the clips given to add to an audio pack at
+        pack_path, starting a new shard whenever the samples of
+        the current one would take more than shard_bytes. The
+        samples are written as they come, the table and ids of
+        a shard when it is closed. Shards of an earlier pack at
+        pack_path are removed.
+    '''
+    def __init__(self, pack_path, sr, res_type, trim_params, shard_bytes=DEFAULT_SHARD_BYTES):
+        os.makedirs(pack_path, exist_ok=True)
+        for path in shard_paths(pack_path):
+            os.remove(path)
+        self.pack_path = pack_path
+        self.count = 0
+        self._sr = sr or 0
+        self._res_type = res_type.encode('utf-8')
+        self._top_db, self._frame_length, self._hop_length = trim_params
+        self._shard_bytes = shard_bytes
+        self._num_shards = 0
+        self._f = None
+
+    def add(self, audio_id, audio, sr, trim_bounds):
+        '''
+            Adds the clip of the audio file audio_id with the
+            trimmed clip [start, end) of trim_bounds
+        '''
+        audio = np.asarray(audio, dtype=np.float32)
+        if self._f is not None and 4 * (self._num_samples + audio.shape[0]) > self._shard_bytes:
+            self._close_shard()
+        if self._f is None:
+            self._open_shard()
+        start = self._num_samples
+        audio.tofile(self._f)
+        self._num_samples += audio.shape[0]
+        self._ids.append(token_id(audio_id))
+        self._rows.append([sr, start, self._num_samples, start + trim_bounds[0], start + trim_bounds[1]])
+        self.count += 1
+
+    def close(self):
+        if self._f is not None:
+            self._close_shard()
+
+    def _open_shard(self):
+        self._path = os.path.join(self.pack_path, SHARD_PATTERN % self._num_shards)
+        self._f = open(self._path + '.tmp', 'wb')
+        self._f.write(bytes(HEADER.size))
+        self._num_samples = 0
+        self._ids = []
+        self._rows = []
+
+    def _close_shard(self):
+        order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+        encoded_ids = [self._ids[i].encode('utf-8') for i in order]
+        rows = np.array([self._rows[i] for i in order], dtype=np.int64).reshape(-1, TABLE_COLUMNS)
+        # the table starts on a multiple of 8 bytes
+        self._f.write(bytes(-self._f.tell() % 8))
+        rows.tofile(self._f)
+        np.cumsum([len(i) for i in encoded_ids], dtype=np.int64).tofile(self._f)
+        ids = b''.join(encoded_ids)
+        self._f.write(ids)
+        self._f.seek(0)
+        self._f.write(HEADER.pack(MAGIC, len(order), len(ids), self._num_samples, self._sr,
+            self._top_db, self._frame_length, self._hop_length, self._res_type))
+        self._f.close()
+        self._f = None
+        os.replace(self._path + '.tmp', self._path)
+        self._num_shards += 1
+
+
+class AudioPack:
+    '''
+        Read access to an audio pack, see the module description.
+        Only the header, table and ids of each shard are read
+        when a pack is opened, the samples when a clip is used.
+
+        sr is None if each file was packed at its own rate.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._shards = [_Shard(p) for p in shard_paths(path)]
+        if not self._shards:
+            raise ValueError('%s is not an audio pack' % path)
+        first = self._shards[0]
+        self.sr = first.sr or None
+        self.res_type = first.res_type
+        self.trim_params = first.trim_params
+        self._starts = np.cumsum([0] + [len(s) for s in self._shards])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def __contains__(self, audio_id):
+        return self.find(audio_id) >= 0
+
+    def find(self, audio_id):
+        '''
+            The position of the clip of audio_id, or -1
+        '''
+        audio_id = token_id(audio_id)
+        for start, shard in zip(self._starts, self._shards):
+            i = shard.find(audio_id)
+            if i >= 0:
+                return int(start) + i
+        return -1
+
+    def id_at(self, i):
+        shard, i = self._locate(i)
+        return shard.id_at(i)
+
+    def clip(self, i):
+        '''
+            Returns (audio, sr, trim_bounds) for the clip at
+            position i, where audio is a float32 view of the shard
+            and trim_bounds the [start, end) of the trimmed clip
+            in it
+        '''
+        shard, i = self._locate(i)
+        sr, start, end, trim_start, trim_end = (int(v) for v in shard.table[i])
+        return shard.samples[start:end], sr, (trim_start - start, trim_end - start)
+
+    def _locate(self, i):
+        s = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self._shards[s], i - int(self._starts[s])
+
+class _Shard:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, ids_len, num_samples, sr, top_db, frame_length, hop_length, res_type = \
+            HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            raise ValueError('%s is not a shard of an audio pack' % path)
+        self.sr = sr
+        self.res_type = res_type.rstrip(b'\0').decode('utf-8')
+        self.trim_params = (top_db, frame_length, hop_length)
+        self.samples = np.frombuffer(self._data, np.float32, num_samples, HEADER.size)
+        table_start = HEADER.size + 4 * num_samples
+        table_start += -table_start % 8
+        self.table = np.frombuffer(self._data, np.int64, count * TABLE_COLUMNS, table_start) \
+            .reshape(count, TABLE_COLUMNS)
+        self._id_ends = np.frombuffer(self._data, np.int64, count, table_start + 8 * count * TABLE_COLUMNS)
+        self._ids_start = table_start + 8 * count * (TABLE_COLUMNS + 1)
+        self._ids = _IdList(self)
+
+    def __len__(self):
+        return self._id_ends.shape[0]
+
+    def id_at(self, i):
+        start = int(self._id_ends[i - 1]) if i > 0 else 0
+        return self._data[self._ids_start + start:self._ids_start + int(self._id_ends[i])].decode('utf-8')
+
+    def find(self, audio_id):
+        i = bisect.bisect_left(self._ids, audio_id)
+        return i if i < len(self) and self.id_at(i) == audio_id else -1
+
+_packs = {}
+
+def open_audio_pack(path):
+    '''
+        The audio pack at path, opened once per process so the
+        workers of a run map each shard only once
+    '''
+    if path not in _packs:
+        _packs[path] = AudioPack(path)
+    return _packs[path]
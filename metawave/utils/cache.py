@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+def file_identity(path):
+    '''
+        Identifies a file by its absolute path, size and
+        modification time. A changed file gets a new identity
+        without the file having to be read.
+    '''
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+def cache_key(audio_path, token_path, params, token=None):
+    '''
+        Key for the features of a single <text, audio> pair
+        analysed with the given parameters. If the token was
+        read from a token pack it is identified by its text,
+        so the token file is not touched.
+    '''
+    token_ident = file_identity(token_path) if token is None else \
+        ['text', hashlib.sha1(token.encode('utf-8')).hexdigest()]
+    ident = [file_identity(audio_path), token_ident, params]
+    return hashlib.sha1(json.dumps(ident, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FeatureCache:
+    '''
+        A persistent cache of per utterance features, stored
+        in a single sqlite database in cache_dir. Values are
+        dictionaries of feature names to numbers, e.g.
+        {'duration', 'syllables', 'f0', 'spr'}.
+
+        When the cache grows beyond max_entries, the least
+        recently used entries are evicted on commit. The
+        cache can be shared between the threads of a single
+        process.
+    '''
+    def __init__(self, cache_dir, max_entries=DEFAULT_MAX_ENTRIES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self._path = os.path.join(cache_dir, 'features.sqlite')
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._hits = []
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS features '+
+            '(key TEXT PRIMARY KEY, vals TEXT NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS features_accessed ON features (accessed)')
+        self._conn.commit()
+        # counted once, then kept up to date by put and commit
+        self._num_entries = self._conn.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+    def get(self, key):
+        '''
+            Returns the cached features for key or None
+        '''
+        with self._lock:
+            row = self._conn.execute('SELECT vals FROM features WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._hits.append(key)
+            return json.loads(row[0])
+
+    def put(self, key, vals):
+        with self._lock:
+            cur = self._conn.execute('UPDATE features SET vals = ?, accessed = ? WHERE key = ?',
+                (json.dumps(vals), time.time(), key))
+            if cur.rowcount == 0:
+                self._conn.execute('INSERT INTO features VALUES (?, ?, ?)', (key, json.dumps(vals), time.time()))
+                self._num_entries += 1
+
+    def commit(self):
+        '''
+            Writes pending entries to disk, marks entries that were
+            read as recently used and evicts the least recently
+            used entries if the cache is over its size.
+        '''
+        with self._lock:
+            now = time.time()
+            self._conn.executemany('UPDATE features SET accessed = ? WHERE key = ?',
+                ((now, key) for key in self._hits))
+            self._hits = []
+            excess = self._num_entries - self._max_entries
+            if excess > 0:
+                cur = self._conn.execute('DELETE FROM features WHERE key IN '+
+                    '(SELECT key FROM features ORDER BY accessed ASC LIMIT ?)', (excess,))
+                self._num_entries -= cur.rowcount
+            self._conn.commit()
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+    def clear(self):
+        with self._lock:
+            self._hits = []
+            self._conn.execute('DELETE FROM features')
+            self._conn.commit()
+            self._num_entries = 0
+            self._conn.execute('VACUUM')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self._path,
+                'entries': self._num_entries,
+                'max_entries': self._max_entries,
+                'size_bytes': os.path.getsize(self._path)}
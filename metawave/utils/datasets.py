@@ -24,7 +24,7 @@ def config_paths(dataset, base_dir, out_dir):
 
     if out_dir == '':
         out_dir = base_dir
-    paths['out_file'] = os.path.join(out_dir, 'meta.tsv')
+    paths.update(config_output_paths(out_dir))
     return paths
 
 def config_custom_paths(wav_dir, text_dir, index_path, out_dir):
@@ -35,5 +35,28 @@ def config_custom_paths(wav_dir, text_dir, index_path, out_dir):
     paths['wavs'] = wav_dir
     paths['text'] = text_dir
     paths['index'] = index_path
+    paths.update(config_output_paths(out_dir))
+    return paths
+
+def config_output_paths(out_dir):
+    '''
+        The files a run writes to out_dir
+    '''
+    paths = {}
     paths['out_file'] = os.path.join(out_dir, 'meta.tsv')
+    paths['error_file'] = os.path.join(out_dir, 'meta_errors.tsv')
+    paths['store'] = os.path.join(out_dir, 'meta.store')
+    paths['stats'] = os.path.join(out_dir, 'meta_stats.json')
+    paths['profile'] = os.path.join(out_dir, 'meta_profile.json')
+    return paths
+
+def shard_paths(paths, shard, num_shards):
+    '''
+        The paths of a sharded run, where each output file
+        gets the shard in its name, e.g. meta-0-of-4.tsv
+    '''
+    paths = dict(paths)
+    for key in ['out_file', 'error_file', 'store', 'stats', 'profile']:
+        root, ext = os.path.splitext(paths[key])
+        paths[key] = '%s-%d-of-%d%s' % (root, shard, num_shards, ext)
     return paths
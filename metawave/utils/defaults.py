@@ -0,0 +1,47 @@
+# Defaults and choices shared by the command line and the
+# analysis modules. This module must stay free of imports,
+# so the command line can be built without loading the
+# scientific stack.
+
+# audio loading
+RESAMPLERS = ['librosa', 'poly']
+DEFAULT_RESAMPLER = 'librosa'
+
+# framewise energy and trimming, see utils.audio.FrameEnergy
+TRIM_TOP_DB = 60
+PAUSE_TOP_DB = 40
+FRAME_LENGTH = 2048
+HOP_LENGTH = 512
+
+# F0 estimation, the names of utils.audio.F0_METHODS
+F0_METHOD_NAMES = ['dio', 'dio_stonemask', 'harvest', 'autocorr']
+DEFAULT_F0_METHOD = 'dio_stonemask'
+DEFAULT_FRAME_PERIOD = 5.0
+
+# features, the names of utils.features.FEATURES. Every meta
+# has the META_FEATURES, the summary and outliers are built
+# on them, other features add columns after them.
+FEATURE_NAMES = ['duration', 'syllables', 'spr', 'speech_ratio', 'pause_spr', 'f0', 'f0_std',
+    'energy', 'spectral_centroid', 'aperiodicity']
+META_FEATURES = ['spr', 'f0']
+# the features check always shows
+CHECK_FEATURES = ['duration', 'syllables', 'spr', 'speech_ratio', 'pause_spr', 'f0']
+# the features of a long recording that is analysed in segments
+SEGMENTED_FEATURES = ['duration', 'syllables', 'spr', 'f0', 'f0_std']
+
+# outlier scoring, see utils.outliers
+OUTLIER_METHOD_NAMES = ['global', 'reader_z', 'mad', 'mahalanobis']
+DEFAULT_OUTLIER_METHOD = 'global'
+
+# summary plots
+PLOT_STYLES = ['auto', 'scatter', 'hexbin', 'hist2d']
+DEFAULT_PLOT_STYLE = 'auto'
+# above this many utterances 'auto' draws densities instead of points
+MAX_SCATTER_POINTS = 100000
+
+# search server
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# audio packs, see utils.audio_pack
+DEFAULT_SHARD_MB = 2048
@@ -1,12 +1,21 @@
-import matplotlib.pyplot as plt
+'''
+    Statistics of the framewise energy of a clip, see
+    audio.FrameEnergy
+'''
 import numpy as np
 
-from .audio import aperiodicity, prep_wav
+from .defaults import TRIM_TOP_DB
 
-if __name__ == '__main__':
-    ap = '/home/atli/Work/taco/datasets/mini/ismData/wavs/ism_1140_0024314995.wav'
-    audio = prep_wav(ap, 22000)
-    ap = aperiodicity(audio, 22000)
-    print(ap.shape)
-    plt.imshow(ap)
-    plt.show()
+def energy_db(energy):
+    '''
+        The mean square of each frame in decibels
+    '''
+    return 10.0 * np.log10(np.maximum(energy.power, 1e-10))
+
+def energy_stats(energy, top_db=TRIM_TOP_DB):
+    '''
+        The mean and standard deviation in decibels of the
+        frames that are not silent
+    '''
+    db = energy_db(energy)[energy.non_silent(top_db)]
+    return float(np.mean(db)), float(np.std(db))
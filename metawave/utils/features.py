@@ -0,0 +1,230 @@
+'''
+    The registry of per utterance features and the engine
+    that computes them.
+
+    A feature declares the intermediates it needs, e.g. the
+    trimmed audio or the F0 track, and intermediates declare
+    the intermediates they are computed from, down to the
+    inputs of an utterance: its decoded audio, sample rate
+    and token. The engine computes each intermediate at most
+    once per utterance, however many features need it, and
+    drops it as soon as no remaining feature needs it.
+
+    New features are added with the feature and intermediate
+    decorators. Their names must also be added to
+    defaults.FEATURE_NAMES for the command line.
+'''
+import numpy as np
+
+from .defaults import FEATURE_NAMES, META_FEATURES
+from .profile import stage
+
+# utils.audio is imported by the intermediates that use it, so
+# the registry can be read without loading the scientific stack
+
+INPUTS = ['audio', 'sr', 'token']
+INTERMEDIATES = {}
+FEATURES = {}
+
+class Step:
+    '''
+        An intermediate or a feature: func is called with the
+        value of each of needs, in order, and the analysis
+        parameters. A feature gives one value per column.
+    '''
+    def __init__(self, name, needs, func, columns=None):
+        self.name = name
+        self.needs = list(needs)
+        self.func = func
+        self.columns = columns
+
+def intermediate(name, needs):
+    def register(func):
+        INTERMEDIATES[name] = Step(name, needs, func)
+        return func
+    return register
+
+def feature(name, needs, columns=None):
+    def register(func):
+        FEATURES[name] = Step(name, needs, func, columns or [name])
+        return func
+    return register
+
+@intermediate('energy', needs=['audio', 'sr'])
+def _energy(audio, sr, params):
+    from .audio import frame_energy
+    with stage('energy_trim'):
+        return frame_energy(audio, sr)
+
+@intermediate('trimmed', needs=['audio', 'energy'])
+def _trimmed(audio, energy, params):
+    with stage('energy_trim'):
+        return energy.trim(audio)
+
+@intermediate('syllable_count', needs=['token'])
+def _syllable_count(token, params):
+    from .audio import naive_syllable_count
+    with stage('features'):
+        return naive_syllable_count(token)
+
+@intermediate('f0_track', needs=['trimmed', 'sr'])
+def _f0_track(trimmed, sr, params):
+    from .audio import f0_track
+    return f0_track(trimmed, sr, params['f0_method'], params['frame_period'])
+
+@intermediate('spectral_envelope', needs=['trimmed', 'sr', 'f0_track'])
+def _spectral_envelope(trimmed, sr, F0, params):
+    from .audio import spectral_envelope
+    return spectral_envelope(trimmed, sr, F0, params['frame_period'])
+
+@intermediate('aperiodicity', needs=['trimmed', 'sr', 'f0_track'])
+def _aperiodicity(trimmed, sr, F0, params):
+    from .audio import aperiodicity
+    return aperiodicity(trimmed, sr, F0, params['frame_period'])
+
+@feature('duration', needs=['energy'])
+def duration(energy, params):
+    return energy.duration()
+
+@feature('syllables', needs=['syllable_count'])
+def syllables(count, params):
+    return count
+
+@feature('spr', needs=['syllable_count', 'energy'])
+def spr(count, energy, params):
+    return count / energy.duration()
+
+@feature('speech_ratio', needs=['energy'])
+def speech_ratio(energy, params):
+    return energy.speech_ratio()
+
+@feature('pause_spr', needs=['syllable_count', 'energy'])
+def pause_spr(count, energy, params):
+    return count / energy.speech_duration()
+
+@feature('f0', needs=['f0_track'])
+def f0(F0, params):
+    from .audio import mean_F0
+    return mean_F0(F0, params['exclude_silence'])
+
+@feature('f0_std', needs=['f0_track'])
+def f0_std(F0, params):
+    voiced = F0[F0 > 0.0]
+    if voiced.shape[0] == 0:
+        raise ValueError('No voiced frames were found')
+    return float(np.std(voiced))
+
+@feature('energy', needs=['energy'], columns=['energy_db_mean', 'energy_db_std'])
+def energy(energy, params):
+    from .energy import energy_stats
+    return energy_stats(energy)
+
+@feature('spectral_centroid', needs=['spectral_envelope', 'f0_track', 'sr'])
+def spectral_centroid(sp, F0, sr, params):
+    '''
+        The mean centroid in Hz of the spectral envelope of
+        the voiced frames
+    '''
+    freqs = np.linspace(0, sr / 2, sp.shape[1])
+    centroids = sp @ freqs / np.maximum(sp.sum(axis=1), 1e-20)
+    return float(np.mean(voiced_frames(centroids, F0)))
+
+@feature('aperiodicity', needs=['aperiodicity', 'f0_track'])
+def mean_aperiodicity(ap, F0, params):
+    '''
+        The mean aperiodicity over all frequencies of the
+        voiced frames, from 0 for periodic to 1 for noise
+    '''
+    return float(np.mean(voiced_frames(ap.mean(axis=1), F0)))
+
+def voiced_frames(values, F0):
+    '''
+        The values of the voiced frames, or of all frames if
+        none of them are voiced
+    '''
+    voiced = F0 > 0.0
+    return values[voiced] if voiced.any() else values
+
+def select_features(names=None, base=META_FEATURES):
+    '''
+        The base features and the named ones, without
+        duplicates and in the order of FEATURE_NAMES
+    '''
+    names = list(names or [])
+    unknown = [name for name in names if name not in FEATURES]
+    if unknown:
+        raise ValueError('Unknown features %s, choose from %s' % (', '.join(unknown), ', '.join(FEATURE_NAMES)))
+    extra = [name for name in FEATURE_NAMES if name in names and name not in base]
+    return list(base) + extra
+
+def feature_columns(features):
+    '''
+        The columns the features add to the meta, in order
+    '''
+    return [col for name in features for col in FEATURES[name].columns]
+
+def plan(features):
+    '''
+        The intermediates the features need, each after the
+        ones it is computed from, and the number of times each
+        input and intermediate is used
+    '''
+    order = []
+    uses = {}
+    def visit(name):
+        if name in INPUTS or name in order:
+            return
+        for dep in INTERMEDIATES[name].needs:
+            visit(dep)
+        order.append(name)
+    for name in features:
+        for dep in FEATURES[name].needs:
+            uses[dep] = uses.get(dep, 0) + 1
+            visit(dep)
+    for name in order:
+        for dep in INTERMEDIATES[name].needs:
+            uses[dep] = uses.get(dep, 0) + 1
+    return order, uses
+
+def extract(features, inputs, params):
+    '''
+        Computes features, a list of names in FEATURES, from
+        inputs, a dict with the decoded 'audio', its 'sr' and
+        the 'token' of an utterance. inputs is used as the
+        store of intermediates and may already hold some of
+        them, e.g. the 'trimmed' audio of an audio pack, so
+        the audio is freed once it is no longer needed as long
+        as the caller holds no other reference to it.
+
+        Returns {column: value} for the columns of every feature.
+    '''
+    values = inputs
+    _, uses = plan(features)
+    for name in list(values):
+        if uses.get(name, 0) == 0:
+            del values[name]
+    result = {}
+    for name in features:
+        step = FEATURES[name]
+        args = [_value(dep, values, uses, params) for dep in step.needs]
+        with stage('features'):
+            out = step.func(*args, params)
+        del args
+        _release(step.needs, values, uses)
+        result.update(zip(step.columns, out if len(step.columns) > 1 else [out]))
+    return result
+
+def _value(name, values, uses, params):
+    if name not in values:
+        step = INTERMEDIATES[name]
+        args = [_value(dep, values, uses, params) for dep in step.needs]
+        values[name] = step.func(*args, params)
+        del args
+        _release(step.needs, values, uses)
+    return values[name]
+
+def _release(names, values, uses):
+    for name in names:
+        uses[name] -= 1
+        if uses[name] == 0:
+            del values[name]
@@ -1,6 +1,7 @@
 import re
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 def gen_line_reg(s):
     '''
@@ -20,7 +21,7 @@ def gen_line_reg(s):
     s += r'\..*'
     return re.compile(s)
 
-def gen_index_line(rm, fn):
+def gen_index_line(rm, fn, wav_fn=None):
     '''
         Given the matched groups and the text filename, 
         generate a single line to be written to the index 
@@ -29,9 +30,11 @@ def gen_index_line(rm, fn):
         <text_file> \t <audio_file> \t <reader_id>
     
         where the reader id might be missing, based on the 
-        regex match
+        regex match. If the audio filename is not given it
+        is derived from the text filename.
     '''
-    wav_fn = fn.replace(fn[fn.find('.'):], '.wav')
+    if wav_fn is None:
+        wav_fn = fn.replace(fn[fn.find('.'):], '.wav')
     if len(rm.groups()) == 2:
         # Reader id was captured
         return '%s\t%s\t%s' \
@@ -59,8 +62,187 @@ def paths_for_index(wav_dir, text_dir, out_dir):
     paths['wavs'] = wav_dir
     paths['text'] = text_dir
     paths['out_file'] = os.path.join(out_dir, 'line_index.tsv')
+    paths['missing_file'] = os.path.join(out_dir, 'line_index_missing.tsv')
     return paths
 
+def parse_shard(s):
+    '''
+        Parses a shard given as 'i/N' to (i, N), where the
+        shards of an index are numbered 0 to N-1.
+    '''
+    try:
+        i, n = [int(v) for v in s.split('/')]
+    except ValueError:
+        raise ValueError('A shard is given as i/N, not %s' % s)
+    if n < 1 or not 0 <= i < n:
+        raise ValueError('Shard %s is not one of 0/%d to %d/%d' % (s, n, n - 1, n))
+    return i, n
+
+def next_line_start(f, pos, chunk_size=2**16):
+    '''
+        The offset of the first line of the open binary file f
+        that starts at or after the byte offset pos.
+    '''
+    if pos <= 0:
+        return 0
+    f.seek(pos - 1)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return f.tell()
+        nl = chunk.find(b'\n')
+        if nl >= 0:
+            return f.tell() - len(chunk) + nl + 1
+
+def shard_bounds(index_path, shard, num_shards):
+    '''
+        The byte range [start, stop) of the lines of the index
+        in a shard. The file is cut in num_shards equally large
+        pieces and each cut is moved forward to the start of
+        the next line, so every line is in exactly one shard and
+        shards hold consecutive lines.
+    '''
+    size = os.path.getsize(index_path)
+    with open(index_path, 'rb') as f:
+        start = next_line_start(f, size * shard // num_shards)
+        stop = next_line_start(f, size * (shard + 1) // num_shards)
+    return start, stop
+
+def index_lines(index_file, start=0, stop=None):
+    '''
+        Yields the decoded lines of the open binary index file
+        in the byte range [start, stop)
+    '''
+    index_file.seek(start)
+    pos = start
+    for line in index_file:
+        if stop is not None and pos >= stop:
+            break
+        pos += len(line)
+        yield line.decode('utf-8')
+
+def count_lines(path, start=0, stop=None, chunk_size=2**20):
+    '''
+        The number of lines in the byte range [start, stop) of
+        a file, counted in large chunks
+    '''
+    if stop is None:
+        stop = os.path.getsize(path)
+    count = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+            remaining -= len(chunk)
+    # a last line without a newline
+    if last != b'\n':
+        count += 1
+    return count
+
+def walk_files(root, workers=1):
+    '''
+        Returns the paths, relative to root, of every file in
+        the directory tree below root, sorted. The subdirectories
+        of root are walked concurrently by a pool of workers
+        threads.
+    '''
+    def walk(rel_dir):
+        files = []
+        dirs = [rel_dir]
+        while dirs:
+            d = dirs.pop()
+            with os.scandir(os.path.join(root, d)) as entries:
+                for entry in entries:
+                    path = os.path.join(d, entry.name) if d else entry.name
+                    if entry.is_dir():
+                        dirs.append(path)
+                    elif entry.is_file():
+                        files.append(path)
+        return files
+
+    files = []
+    sub_dirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                sub_dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        for sub_files in pool.map(walk, sub_dirs):
+            files.extend(sub_files)
+    files.sort()
+    return files
+
+def file_stem(path):
+    '''
+        The path without the file extension, where everything
+        after the first dot of the filename is the extension.
+    '''
+    head, name = os.path.split(path)
+    dot = name.find('.')
+    return os.path.join(head, name[:dot] if dot >= 0 else name)
+
+def pair_files(text_files, wav_files, reg):
+    '''
+        Joins text tokens and .wav files in a single pass.
+        A token is paired with the .wav file at the same relative
+        path in the wav tree, or else with the only .wav file
+        of the same name anywhere in it, as long as no other
+        token has that .wav file, at its own path or by name.
+
+        Yields (text_file, wav_file, match, problem) for each
+        text file, where problem is None for a good pair and
+        otherwise says why it could not be paired, and then
+        (None, wav_file, None, problem) for each .wav file that
+        no token was paired with.
+    '''
+    by_path = {}
+    by_name = {}
+    for wav in wav_files:
+        if not wav.endswith('.wav'):
+            continue
+        stem = file_stem(wav)
+        by_path[stem] = wav
+        name = os.path.basename(stem)
+        # None marks names that are found more than once
+        by_name[name] = None if name in by_name else wav
+    text_files = list(text_files)
+    # the .wav files taken by a token at the same path can not
+    # be paired with another token by name
+    claimed = set(by_path[file_stem(fn)] for fn in text_files if file_stem(fn) in by_path)
+    paired = set()
+    for fn in text_files:
+        rm = reg.search(os.path.basename(fn))
+        if rm is None:
+            yield fn, None, None, 'name does not match the name regex'
+            continue
+        stem = file_stem(fn)
+        wav = by_path.get(stem)
+        if wav is None:
+            name = os.path.basename(stem)
+            if name not in by_name:
+                yield fn, None, rm, 'no audio'
+                continue
+            wav = by_name[name]
+            if wav is None:
+                yield fn, None, rm, 'more than one audio file named %s.wav' % name
+                continue
+            if wav in claimed or wav in paired:
+                yield fn, None, rm, 'ambiguous, %s belongs to another text' % wav
+                continue
+        paired.add(wav)
+        yield fn, wav, rm, None
+    for wav in by_path.values():
+        if wav not in paired:
+            yield None, wav, None, 'no text'
+
 class IndexHandler:
     '''
         Handle for different dataset interfaces index
@@ -0,0 +1,342 @@
+'''
+    Outlier scores of utterances and the cut between the
+    utterances that are kept and the outliers.
+
+    Every method scores the feature vectors X, one row per
+    utterance, with an error that is 0 for a typical utterance
+    and grows the further it is from the others:
+    * global: the squared relative distance from the mean of
+      the whole dataset, summed over the features
+    * reader_z: the squared z-score within the reader
+    * mad: the squared robust z-score within the reader, from
+      the median and the median absolute deviation
+    * mahalanobis: the squared Mahalanobis distance from the
+      mean of the reader, with the covariance of the reader
+
+    The cut is found without sorting the scores. A quantile
+    sketch finds the bucket of scores the cut falls into in a
+    single pass and only the scores in that bucket are looked
+    at to find the exact cut, see keep_threshold.
+'''
+import math
+
+import numpy as np
+
+from .defaults import OUTLIER_METHOD_NAMES
+
+CHUNK_SIZE = 2**16
+# the scale of the median absolute deviation of normal data
+MAD_SCALE = 1.4826
+EPS = 1e-12
+# the key of the bucket of a QuantileSketch below min_value
+LOW_KEY = np.iinfo(np.int64).min
+
+def blocks(chunks):
+    '''
+        The (codes, X) chunks given by chunks() cut into
+        blocks of at most CHUNK_SIZE rows
+    '''
+    for codes, X in chunks():
+        for i in range(0, codes.shape[0], CHUNK_SIZE):
+            yield codes[i:i + CHUNK_SIZE], np.asarray(X[i:i + CHUNK_SIZE], dtype=np.float64)
+
+def group_slices(codes):
+    '''
+        The group and the indices of its rows for each group
+        in codes, in the order of the groups
+    '''
+    if codes.shape[0] == 0:
+        return
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = np.r_[starts[1:], order.shape[0]]
+    for start, end in zip(starts, ends):
+        yield int(sorted_codes[start]), order[start:end]
+
+def group_moments(chunks, num_groups, num_columns):
+    '''
+        The number of rows, the mean and the (biased)
+        covariance of the rows of X in each group, and the mean
+        of all rows, in two passes over the (codes, X) chunks
+        given by chunks(). The sums are taken over blocks of
+        CHUNK_SIZE rows, so the moments are the same for any
+        chunks of a multiple of CHUNK_SIZE rows.
+    '''
+    counts = np.zeros(num_groups, dtype=np.int64)
+    sums = np.zeros((num_groups, num_columns))
+    total = np.zeros(num_columns)
+    for codes, X in blocks(chunks):
+        counts += np.bincount(codes, minlength=num_groups)
+        total += X.sum(axis=0)
+        for j in range(num_columns):
+            sums[:, j] += np.bincount(codes, X[:, j], num_groups)
+    n = np.maximum(counts, 1)
+    means = sums / n[:, None]
+    cov = np.zeros((num_groups, num_columns, num_columns))
+    for codes, X in blocks(chunks):
+        D = X - means[codes]
+        for i in range(num_columns):
+            for j in range(i, num_columns):
+                cov[:, i, j] += np.bincount(codes, D[:, i] * D[:, j], num_groups)
+    for i in range(num_columns):
+        for j in range(i, num_columns):
+            cov[:, i, j] /= n
+            cov[:, j, i] = cov[:, i, j]
+    return counts, means, cov, total / max(int(counts.sum()), 1)
+
+def group_order_stats(chunks, num_groups, num_columns, ranks):
+    '''
+        The values of the given ranks, counted from 0 in
+        ascending order, of each column within each group, in
+        two passes over the (codes, V) chunks given by chunks().
+        ranks is a list of arrays with a rank for each group,
+        and a (num_groups, num_columns) array of values is
+        returned for each of them. Groups without rows get 0.
+
+        A quantile sketch of each column of each group finds
+        the bucket of each rank, and only the values in those
+        buckets are kept to find the exact values.
+    '''
+    sketches = [[QuantileSketch() for _ in range(num_columns)] for _ in range(num_groups)]
+    for codes, V in chunks():
+        V = np.asarray(V, dtype=np.float64)
+        for g, rows in group_slices(codes):
+            for j in range(num_columns):
+                sketches[g][j].update(V[rows, j])
+    keys = np.full((len(ranks), num_groups, num_columns), LOW_KEY, dtype=np.int64)
+    below = np.zeros((len(ranks), num_groups, num_columns), dtype=np.int64)
+    for r, rank in enumerate(ranks):
+        for g in range(num_groups):
+            for j in range(num_columns):
+                if sketches[g][j].count > 0:
+                    keys[r, g, j], below[r, g, j] = sketches[g][j].locate(int(rank[g]))
+    bands = [[[] for _ in range(num_columns)] for _ in ranks]
+    key_sketch = QuantileSketch()
+    for codes, V in chunks():
+        V = np.asarray(V, dtype=np.float64)
+        for j in range(num_columns):
+            value_keys = key_sketch.keys_of(V[:, j])
+            for r in range(len(ranks)):
+                in_band = value_keys == keys[r, codes, j]
+                bands[r][j].append((codes[in_band], V[in_band, j]))
+    results = []
+    for r, rank in enumerate(ranks):
+        values = np.zeros((num_groups, num_columns))
+        for j in range(num_columns):
+            band_codes = np.concatenate([c for c, _ in bands[r][j]] + [np.zeros(0, dtype=np.int64)])
+            band = np.concatenate([v for _, v in bands[r][j]] + [np.zeros(0)])
+            order = np.lexsort((band, band_codes))
+            band_codes, band = band_codes[order], band[order]
+            starts = np.searchsorted(band_codes, np.arange(num_groups))
+            for g in range(num_groups):
+                if sketches[g][j].count > 0:
+                    values[g, j] = band[starts[g] + rank[g] - below[r, g, j]]
+        results.append(values)
+    return results
+
+def group_medians(chunks, num_groups, num_columns, counts):
+    '''
+        The median of each column in each group of the
+        (codes, V) chunks given by chunks(), the mean of the two
+        middle values for an even count as in np.median.
+        counts is the number of rows in each group.
+    '''
+    low, high = group_order_stats(chunks, num_groups, num_columns,
+        [np.maximum(counts - 1, 0) // 2, counts // 2])
+    return np.where((counts % 2 == 1)[:, None], low, (low + high) / 2)
+
+def global_error(X, means):
+    err = np.zeros(X.shape[0])
+    for j in range(X.shape[1]):
+        err += (np.abs(means[j] - X[:, j]) / means[j])**2
+    return err
+
+def reader_z_error(X, codes, means, cov):
+    std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    return (((X - means[codes]) / np.maximum(std[codes], EPS))**2).sum(axis=1)
+
+def mad_error(X, codes, medians, mads):
+    scale = np.maximum(MAD_SCALE * mads, EPS)
+    return (((X - medians[codes]) / scale[codes])**2).sum(axis=1)
+
+def mahalanobis_error(X, codes, means, cov):
+    # a little ridge keeps readers with too few or constant
+    # values invertible
+    d = X.shape[1]
+    ridge = EPS * np.maximum(np.trace(cov, axis1=1, axis2=2) / d, 1.0)
+    inv = np.linalg.inv(cov + ridge[:, None, None] * np.eye(d))
+    D = X - means[codes]
+    return np.einsum('ni,nij,nj->n', D, inv[codes], D)
+
+def outlier_scorer(method, chunks, num_groups, moments):
+    '''
+        A function of (codes, X) that gives the error of each
+        row with the given method, see the module description,
+        with the statistics of the (codes, X) chunks given by
+        chunks(). moments are their group_moments. mad takes
+        four more passes over the chunks for the exact medians.
+    '''
+    counts, means, cov, mean = moments
+    if method == 'global':
+        return lambda codes, X: global_error(X, mean)
+    if method == 'reader_z':
+        return lambda codes, X: reader_z_error(X, codes, means, cov)
+    if method == 'mahalanobis':
+        return lambda codes, X: mahalanobis_error(X, codes, means, cov)
+    if method == 'mad':
+        num_columns = means.shape[1]
+        medians = group_medians(chunks, num_groups, num_columns, counts)
+        deviations = lambda: ((codes, np.abs(np.asarray(X, dtype=np.float64) - medians[codes]))
+            for codes, X in chunks())
+        mads = group_medians(deviations, num_groups, num_columns, counts)
+        return lambda codes, X: mad_error(X, codes, medians, mads)
+    raise ValueError('Unknown outlier method %s, choose one of %s' % (method, ', '.join(OUTLIER_METHOD_NAMES)))
+
+def outlier_scores(X, codes, num_groups, method='global'):
+    '''
+        The error of each row of X with the given method, see
+        the module description. codes holds the reader code
+        of each row.
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    if X.shape[0] == 0:
+        return np.zeros(0)
+    chunks = lambda: iter([(codes, X)])
+    moments = group_moments(chunks, num_groups, X.shape[1])
+    return outlier_scorer(method, chunks, num_groups, moments)(codes, X)
+
+
+class QuantileSketch:
+    '''
+        Counts of non-negative values in logarithmic buckets,
+        bucket i holding the values in (gamma^(i-1), gamma^i],
+        so any quantile is known within a relative error of
+        relative_accuracy. Values below min_value share a
+        bucket of their own, LOW_KEY. Sketches of parts of the data can
+        be merged.
+    '''
+    def __init__(self, relative_accuracy=0.01, min_value=1e-12):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.min_value = min_value
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.num_low = 0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        low = values <= self.min_value
+        self.num_low += int(np.count_nonzero(low))
+        self.count += values.shape[0]
+        keys, counts = np.unique(self.bucket_of(values[~low]), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def merge(self, other):
+        self.num_low += other.num_low
+        self.count += other.count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def bucket_of(self, values):
+        return np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+
+    def keys_of(self, values):
+        '''
+            The bucket of each value
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        low = values <= self.min_value
+        keys = np.full(values.shape, LOW_KEY, dtype=np.int64)
+        keys[~low] = self.bucket_of(values[~low])
+        return keys
+
+    def bucket_bounds(self, key):
+        if key == LOW_KEY:
+            return -np.inf, self.min_value
+        return self.gamma**(key - 1), self.gamma**key
+
+    def locate(self, rank):
+        '''
+            The bucket that holds the value of the given rank,
+            counted from 0 in ascending order, and the number of
+            values in lower buckets.
+        '''
+        if rank < self.num_low:
+            return LOW_KEY, 0
+        below = self.num_low
+        for key in sorted(self.buckets):
+            if rank < below + self.buckets[key]:
+                return key, below
+            below += self.buckets[key]
+        raise IndexError('rank %d of a sketch of %d values' % (rank, self.count))
+
+    def quantile(self, q):
+        '''
+            An estimate of the q-quantile of the values
+        '''
+        key, _ = self.locate(min(int(q * self.count), self.count - 1))
+        lo, hi = self.bucket_bounds(key)
+        return 0.0 if key == LOW_KEY else 2 * lo * hi / (lo + hi)
+
+    def in_bucket(self, values, key):
+        '''
+            A mask of the values that fall into the bucket
+        '''
+        return self.keys_of(values) == key
+
+
+class OutlierCut:
+    '''
+        Marks the scores above the threshold as outliers, and
+        of the scores equal to it all but the first num_ties,
+        across the chunks given to mark in order
+    '''
+    def __init__(self, threshold, num_ties):
+        self.threshold = threshold
+        self._ties_left = num_ties
+
+    def mark(self, scores):
+        is_outlier = scores > self.threshold
+        ties = np.flatnonzero(scores == self.threshold)
+        is_outlier[ties[self._ties_left:]] = True
+        self._ties_left = max(self._ties_left - ties.shape[0], 0)
+        return is_outlier
+
+def keep_threshold(chunks, num_keep, sketch=None):
+    '''
+        The cut that keeps the num_keep lowest scores, with
+        equal scores kept in their order, as an OutlierCut.
+        chunks() must give the scores in the same order as
+        arrays each time it is called. It is called twice:
+        once to fill the quantile sketch, unless a filled one is
+        given, and once to find the exact threshold among the
+        scores in the bucket of the cut.
+    '''
+    if sketch is None:
+        sketch = QuantileSketch()
+        for scores in chunks():
+            sketch.update(scores)
+    if num_keep >= sketch.count:
+        return OutlierCut(np.inf, sketch.count)
+    if num_keep <= 0:
+        return OutlierCut(-np.inf, 0)
+    key, below = sketch.locate(num_keep)
+    band = np.concatenate([scores[sketch.in_bucket(scores, key)] for scores in chunks()] + [np.zeros(0)])
+    band_threshold = band[np.argpartition(band, num_keep - below)[num_keep - below]]
+    num_less = below + int(np.count_nonzero(band < band_threshold))
+    return OutlierCut(band_threshold, num_keep - num_less)
+
+def array_chunks(values, chunk_size=CHUNK_SIZE):
+    return lambda: (values[i:i + chunk_size] for i in range(0, values.shape[0], chunk_size))
+
+def select_outliers(err, num_keep):
+    '''
+        Marks all but the num_keep utterances with the lowest
+        error as outliers. Utterances with an equal error are
+        kept in array order, which is the same cut a stable sort
+        of the errors would give.
+    '''
+    cut = keep_threshold(array_chunks(err), num_keep)
+    return np.concatenate([cut.mark(scores) for scores in array_chunks(err)()] + [np.zeros(0, dtype=bool)])
@@ -0,0 +1,130 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_READ_AHEAD = 64
+DEFAULT_READ_THREADS = 4
+
+class Prefetcher:
+    '''
+        Reads jobs ahead of the stage that consumes them. Each
+        job is passed to read_fn in a pool of threads and the
+        jobs are yielded in their original order once read.
+
+        At most read_ahead jobs are between being handed to
+        read_fn and being released by the last stage, see
+        release, which caps the memory held by jobs that have
+        been read but not yet written.
+    '''
+    def __init__(self, jobs, read_fn, read_ahead=DEFAULT_READ_AHEAD, threads=DEFAULT_READ_THREADS):
+        self._jobs = iter(jobs)
+        self._read_fn = read_fn
+        self._read_ahead = max(read_ahead, 1)
+        self._slots = threading.Semaphore(self._read_ahead)
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max(threads, 1))
+        self._reads = deque()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def __iter__(self):
+        exhausted = False
+        while not self._stop.is_set():
+            # start reading as many jobs as there are free slots
+            while not exhausted and self._slots.acquire(blocking=False):
+                job = next(self._jobs, None)
+                if job is None:
+                    exhausted = True
+                    self._slots.release()
+                    break
+                with self._lock:
+                    if self._stop.is_set():
+                        break
+                    self._in_flight += 1
+                    self._reads.append(self._executor.submit(self._read_fn, job))
+            with self._lock:
+                read = self._reads.popleft() if self._reads else None
+            if read is not None:
+                yield read.result()
+            elif exhausted:
+                break
+            elif self._slots.acquire(timeout=0.1):
+                # every slot was taken by jobs further down
+                # the pipeline until now
+                self._slots.release()
+        self._executor.shutdown(wait=False)
+
+    def release(self):
+        '''
+            Called by the last stage for each job it is done with
+        '''
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def stop(self):
+        # reads that have not started are cancelled here, as
+        # shutdown only cancels them itself from Python 3.9
+        with self._lock:
+            self._stop.set()
+            for read in self._reads:
+                read.cancel()
+        self._executor.shutdown(wait=False)
+
+    def depths(self):
+        '''
+            The number of jobs being read and the number of
+            jobs that have been read but not released
+        '''
+        reading = len(self._reads)
+        with self._lock:
+            return reading, self._in_flight - reading
+
+
+class BackgroundWriter:
+    '''
+        Hands items to write_fn on a separate thread, through
+        a queue of at most max_queue items. An exception in
+        write_fn stops the writer and is raised again by put
+        or close.
+    '''
+    def __init__(self, write_fn, max_queue=DEFAULT_READ_AHEAD):
+        self._write_fn = write_fn
+        self._queue = queue.Queue(maxsize=max(max_queue, 1))
+        self._error = None
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        while self._error is None:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise self._error
+
+    def close(self):
+        '''
+            Waits until every queued item has been written
+        '''
+        if self._error is None:
+            self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write_fn(item)
+            except BaseException as e:
+                self._error = e
+                return
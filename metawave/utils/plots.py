@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .defaults import DEFAULT_PLOT_STYLE, MAX_SCATTER_POINTS
+
+# the bins along each axis of the density plots
+DENSITY_BINS = 100
+
+def new_figure():
+    '''
+        A figure on the headless Agg canvas. It is not
+        registered with pyplot, so it is freed as soon as it
+        is no longer referenced and never needs to be closed.
+    '''
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+def histogram_path(output_dir, reader_id):
+    return os.path.join(output_dir, '%s-info' % reader_id.replace('.',''))
+
+def save_histogram(path, reader_id, spr, f0, bins=50):
+    '''
+        Histograms of the speech rate and F0 of a reader
+    '''
+    fig = new_figure()
+    ax1 = fig.add_subplot(121)
+    ax1.hist(spr, bins=bins, facecolor='green', alpha=0.5, edgecolor='gray')
+    ax1.grid(True)
+    ax1.set_title('Speech rate (syll/sec)')
+    ax2 = fig.add_subplot(122)
+    ax2.hist(f0, bins=bins, facecolor='green', alpha=0.5, edgecolor='gray')
+    ax2.set_title('F0 (Hz)')
+    ax2.grid(True)
+    fig.suptitle('Info for %s' % reader_id)
+    fig.savefig(path)
+
+def save_binned_histogram(path, reader_id, spr_hist, f0_hist):
+    '''
+        Same as save_histogram but from the fixed bins of
+        StreamingHistograms
+    '''
+    fig = new_figure()
+    for i, (hist, title) in enumerate([(spr_hist, 'Speech rate (syll/sec)'), (f0_hist, 'F0 (Hz)')]):
+        ax = fig.add_subplot(121 + i)
+        edges = hist.edges()
+        used = np.flatnonzero(hist.counts)
+        if used.shape[0] > 0:
+            sl = slice(used[0], used[-1] + 1)
+            ax.hist(edges[:-1][sl], bins=edges[used[0]:used[-1] + 2], weights=hist.counts[sl],
+                facecolor='green', alpha=0.5, edgecolor='gray')
+        ax.grid(True)
+        ax.set_title(title)
+    fig.suptitle('Info for %s' % reader_id)
+    fig.savefig(path)
+
+def _render(job):
+    func, args = job
+    func(*args)
+
+def render_all(jobs, workers=1):
+    '''
+        Renders plots given as (function, args) jobs, in a pool
+        of worker processes if workers is larger than 1.
+    '''
+    if workers <= 1:
+        for job in jobs:
+            _render(job)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        for _ in pool.imap_unordered(_render, jobs):
+            pass
+
+def save_reader_compare(path, readers, is_outlier=None, style=DEFAULT_PLOT_STYLE):
+    '''
+        Plots speech rate against F0 for every utterance,
+        readers is a list of (reader_id, spr, f0). Writes
+        reader_compare and, if is_outlier is given as a list
+        of boolean masks, one for each reader,
+        reader_compare_clean without the outliers, on the same
+        axis limits.
+
+        The scatter style draws each utterance once: outliers
+        are a separate collection that is removed for the clean
+        plot. The hexbin and hist2d styles draw the density of
+        all utterances with the mean of each reader on top.
+    '''
+    if style == 'auto':
+        num_points = sum(spr.shape[0] for _, spr, _ in readers)
+        style = 'scatter' if num_points <= MAX_SCATTER_POINTS else 'hexbin'
+    fig = new_figure()
+    ax = fig.add_subplot(111)
+    ax.set_xlabel('Speech rate (syll/sec)')
+    ax.set_ylabel('F0 (Hz)')
+    if style == 'scatter':
+        outlier_artists = []
+        for i, (reader_id, spr, f0) in enumerate(readers):
+            color = 'C%d' % (i % 10)
+            clean = ~is_outlier[i] if is_outlier is not None else slice(None)
+            ax.scatter(spr[clean], f0[clean], s=0.4, color=color, label=reader_id)
+            if is_outlier is not None:
+                outlier_artists.append(ax.scatter(spr[is_outlier[i]], f0[is_outlier[i]], s=0.4, color=color))
+        lgnd = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        fig.savefig(os.path.join(path, 'reader_compare'), bbox_extra_artists=(lgnd,), bbox_inches='tight')
+        if is_outlier is not None:
+            xlim, ylim = ax.get_xlim(), ax.get_ylim()
+            for artist in outlier_artists:
+                artist.remove()
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+            fig.savefig(os.path.join(path, 'reader_compare_clean'), bbox_extra_artists=(lgnd,),
+                bbox_inches='tight')
+        return
+    spr = np.concatenate([r[1] for r in readers]) if readers else np.zeros(0)
+    f0 = np.concatenate([r[2] for r in readers]) if readers else np.zeros(0)
+    extent = (spr.min(), spr.max(), f0.min(), f0.max()) if spr.shape[0] > 0 else (0, 1, 0, 1)
+    names = [('reader_compare', None)]
+    if is_outlier is not None:
+        names.append(('reader_compare_clean', ~np.concatenate(is_outlier)))
+    for name, keep in names:
+        fig = new_figure()
+        ax = fig.add_subplot(111)
+        ax.set_xlabel('Speech rate (syll/sec)')
+        ax.set_ylabel('F0 (Hz)')
+        x, y = (spr, f0) if keep is None else (spr[keep], f0[keep])
+        if style == 'hexbin':
+            density = ax.hexbin(x, y, gridsize=DENSITY_BINS, bins='log', mincnt=1, cmap='Greys', extent=extent)
+        else:
+            density = ax.hist2d(x, y, bins=DENSITY_BINS, range=[extent[:2], extent[2:]], cmin=1, cmap='Greys')[3]
+        fig.colorbar(density, ax=ax, label='Utterances')
+        for i, (reader_id, r_spr, r_f0) in enumerate(readers):
+            if keep is not None:
+                r_spr, r_f0 = r_spr[~is_outlier[i]], r_f0[~is_outlier[i]]
+            if r_spr.shape[0] > 0:
+                ax.plot(r_spr.mean(), r_f0.mean(), 'o', color='C%d' % (i % 10), label=reader_id)
+        ax.set_xlim(extent[:2])
+        ax.set_ylim(extent[2:])
+        lgnd = ax.legend(loc='center left', bbox_to_anchor=(1.25, 0.5))
+        fig.savefig(os.path.join(path, name), bbox_extra_artists=(lgnd,), bbox_inches='tight')
+
+def save_binned_reader_compare(path, extent, reader_ids, density, means, clean_density=None, clean_means=None):
+    '''
+        Same as save_reader_compare with the hist2d style, from
+        the counts of a DENSITY_BINS x DENSITY_BINS histogram of
+        speech rate and F0 over extent and the [spr, f0] mean of
+        each reader. reader_compare_clean is written if the
+        counts and means without the outliers are given.
+    '''
+    x_edges = np.linspace(extent[0], extent[1], density.shape[0] + 1)
+    y_edges = np.linspace(extent[2], extent[3], density.shape[1] + 1)
+    names = [('reader_compare', density, means)]
+    if clean_density is not None:
+        names.append(('reader_compare_clean', clean_density, clean_means))
+    for name, counts, reader_means in names:
+        fig = new_figure()
+        ax = fig.add_subplot(111)
+        ax.set_xlabel('Speech rate (syll/sec)')
+        ax.set_ylabel('F0 (Hz)')
+        mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_less(counts.T, 1), cmap='Greys')
+        fig.colorbar(mesh, ax=ax, label='Utterances')
+        for i, reader_id in enumerate(reader_ids):
+            if not np.isnan(reader_means[i]).any():
+                ax.plot(reader_means[i][0], reader_means[i][1], 'o', color='C%d' % (i % 10), label=reader_id)
+        ax.set_xlim(extent[:2])
+        ax.set_ylim(extent[2:])
+        lgnd = ax.legend(loc='center left', bbox_to_anchor=(1.25, 0.5))
+        fig.savefig(os.path.join(path, name), bbox_extra_artists=(lgnd,), bbox_inches='tight')
@@ -0,0 +1,204 @@
+import contextlib
+import heapq
+import json
+import threading
+import time
+from array import array
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+STAGES = ['read', 'decode', 'resample', 'energy_trim', 'dio', 'stonemask', 'harvest', 'autocorr',
+    'cheaptrick', 'd4c', 'features', 'write']
+PERCENTILES = [50, 90, 99]
+NUM_SLOWEST = 20
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def recording(stages):
+    '''
+        Adds the wall and CPU time of every stage run by this
+        thread to the dict stages, {name: [wall, cpu]}, until
+        the block ends. Nothing is recorded if stages is None.
+    '''
+    previous = getattr(_local, 'stages', None)
+    _local.stages = stages
+    try:
+        yield stages
+    finally:
+        _local.stages = previous
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+        Times the block as the stage name if this thread is
+        recording, see recording. The CPU time is that of the
+        calling thread only.
+    '''
+    stages = getattr(_local, 'stages', None)
+    if stages is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        times = stages.setdefault(name, [0.0, 0.0])
+        times[0] += time.perf_counter() - wall
+        times[1] += time.thread_time() - cpu
+
+def peak_rss_mb():
+    '''
+        The peak resident memory of this process in MB
+    '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kB on Linux
+    return usage.ru_maxrss / 1024
+
+def percentiles(values):
+    '''
+        The mean, max and PERCENTILES (nearest rank) of values
+    '''
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {'mean': sum(values) / len(values), 'max': values[-1]}
+    for p in PERCENTILES:
+        result['p%d' % p] = values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return result
+
+class RunProfile:
+    '''
+        Collects the stage times of every utterance of a run,
+        as recorded on its job, see add, and reports the time
+        spent in each stage, the seconds of audio analysed per
+        second and the peak memory of the run.
+
+        Only the stage times of each utterance and the
+        NUM_SLOWEST slowest utterances are kept.
+    '''
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._lock = threading.Lock()
+        self._wall = {}
+        self._cpu = {}
+        self._totals = array('d')
+        self._realtime = array('d')
+        self._slowest = []
+        self.num_utterances = 0
+        self.num_cached = 0
+        self.audio_seconds = 0.0
+        self.worker_rss_mb = 0.0
+
+    def add(self, utt_id, stages, audio_seconds=0.0, worker_rss_mb=None):
+        '''
+            Adds the stages, {name: [wall, cpu]}, of an utterance
+            with audio_seconds of audio. Utterances without any
+            stages were served by the feature cache.
+        '''
+        with self._lock:
+            self.num_utterances += 1
+            if not stages:
+                self.num_cached += 1
+                return
+            total = 0.0
+            for name, (wall, cpu) in stages.items():
+                self._wall.setdefault(name, array('d')).append(wall)
+                self._cpu[name] = self._cpu.get(name, 0.0) + cpu
+                total += wall
+            self._totals.append(total)
+            self.audio_seconds += audio_seconds
+            if audio_seconds > 0 and total > 0:
+                self._realtime.append(audio_seconds / total)
+            if worker_rss_mb is not None:
+                self.worker_rss_mb = max(self.worker_rss_mb, worker_rss_mb)
+            entry = (total, utt_id, audio_seconds, {name: times[0] for name, times in stages.items()})
+            if len(self._slowest) < NUM_SLOWEST:
+                heapq.heappush(self._slowest, entry)
+            elif total > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def postfix(self):
+        '''
+            A short summary for the progress bar: seconds of
+            audio per second, the stage that takes the most time
+            and the peak memory
+        '''
+        with self._lock:
+            sums = {name: sum(walls) for name, walls in self._wall.items()}
+            audio_seconds = self.audio_seconds
+        postfix = {'rt': '%0.1fx' % (audio_seconds / max(self.elapsed(), 1e-9))}
+        if sums:
+            top = max(sums, key=sums.get)
+            postfix['top'] = '%s %d%%' % (top, 100 * sums[top] / max(sum(sums.values()), 1e-9))
+        rss = peak_rss_mb()
+        if rss is not None:
+            postfix['rss'] = '%dM' % max(rss, self.worker_rss_mb)
+        return postfix
+
+    def report(self):
+        '''
+            The profile of the run as a dict of plain values.
+            Stage times are summed over all processes, so with
+            several workers they add up to more than the wall
+            time of the run.
+        '''
+        wall = self.elapsed()
+        with self._lock:
+            stage_sum = sum(sum(walls) for walls in self._wall.values())
+            order = [s for s in STAGES if s in self._wall] + sorted(set(self._wall) - set(STAGES))
+            stages = {}
+            for name in order:
+                walls = self._wall[name]
+                stages[name] = {
+                    'utterances': len(walls),
+                    'wall_seconds': sum(walls),
+                    'cpu_seconds': self._cpu[name],
+                    'share': sum(walls) / stage_sum if stage_sum > 0 else 0.0,
+                    'wall_ms': {k: 1000 * v for k, v in percentiles(walls).items()}}
+            slowest = [{'id': utt_id, 'seconds': total, 'audio_seconds': audio_seconds,
+                    'realtime': audio_seconds / total if total > 0 else 0.0, 'stages': times}
+                for total, utt_id, audio_seconds, times in sorted(self._slowest, reverse=True)]
+            return {
+                'utterances': self.num_utterances,
+                'cached': self.num_cached,
+                'wall_seconds': wall,
+                'cpu_seconds': time.process_time() - self._cpu_start,
+                'audio_seconds': self.audio_seconds,
+                'realtime': self.audio_seconds / wall if wall > 0 else 0.0,
+                'peak_rss_mb': peak_rss_mb(),
+                'peak_worker_rss_mb': self.worker_rss_mb,
+                'stages': stages,
+                'utterance_ms': {k: 1000 * v for k, v in percentiles(self._totals).items()},
+                'utterance_realtime': percentiles(self._realtime),
+                'slowest': slowest}
+
+    def save(self, path):
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+def print_report(report):
+    '''
+        Prints the stages of a report as a table
+    '''
+    print('Stage              Wall (s)    CPU (s)   Share   p50 (ms)   p99 (ms)')
+    for name, s in report['stages'].items():
+        print('%-14s %12.3f %10.3f %6.1f%% %10.2f %10.2f' % (name, s['wall_seconds'], s['cpu_seconds'],
+            100 * s['share'], s['wall_ms'].get('p50', 0), s['wall_ms'].get('p99', 0)))
+    print('%d utterances, %0.1f s of audio in %0.1f s, %0.1fx realtime' % (report['utterances'],
+        report['audio_seconds'], report['wall_seconds'], report['realtime']))
+    if report['peak_rss_mb'] is not None:
+        print('Peak memory: %0.0f MB' % report['peak_rss_mb'] + (', largest worker: %0.0f MB'
+            % report['peak_worker_rss_mb'] if report['peak_worker_rss_mb'] > 0 else ''))
@@ -0,0 +1,194 @@
+import json
+import os
+
+import numpy as np
+
+# fixed histogram ranges, values outside fall in the edge bins
+SPR_RANGE = (0.0, 20.0)
+F0_RANGE = (0.0, 600.0)
+NUM_BINS = 200
+
+class RunningStats:
+    '''
+        Mean and variance of a stream of values with
+        Welford's online algorithm.
+    '''
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        '''
+            Combines the statistics of two streams (Chan et al.)
+        '''
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+
+    def variance(self):
+        if self.n == 0:
+            return 0.0
+        return self.m2 / self.n
+
+    def stddev(self):
+        return np.sqrt(self.variance())
+
+    def to_dict(self):
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['n'], d['mean'], d['m2'])
+
+class StreamingHistogram:
+    '''
+        A histogram with fixed, equally wide bins over [lo, hi).
+        Values outside the range are counted in the first or
+        last bin.
+    '''
+    def __init__(self, lo, hi, num_bins=NUM_BINS, counts=None):
+        self.lo = lo
+        self.hi = hi
+        self.counts = np.zeros(num_bins, dtype=np.int64) if counts is None \
+            else np.asarray(counts, dtype=np.int64)
+
+    def update(self, x):
+        self.counts[self.bin(x)] += 1
+
+    def bin(self, x):
+        num_bins = self.counts.shape[0]
+        i = int((x - self.lo) / (self.hi - self.lo) * num_bins)
+        return min(max(i, 0), num_bins - 1)
+
+    def bins(self, values):
+        '''
+            The bin of each of an array of values
+        '''
+        num_bins = self.counts.shape[0]
+        i = (np.asarray(values, dtype=np.float64) - self.lo) / (self.hi - self.lo) * num_bins
+        return np.clip(i, 0, num_bins - 1).astype(np.int64)
+
+    def edges(self):
+        return np.linspace(self.lo, self.hi, self.counts.shape[0] + 1)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def to_dict(self):
+        return {'lo': self.lo, 'hi': self.hi, 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['lo'], d['hi'], len(d['counts']), d['counts'])
+
+class ReaderStats:
+    '''
+        Running statistics and histograms of speech rate
+        and F0 for a single reader
+    '''
+    def __init__(self, reader_id):
+        self.reader_id = reader_id
+        self.spr = RunningStats()
+        self.f0 = RunningStats()
+        self.spr_hist = StreamingHistogram(*SPR_RANGE)
+        self.f0_hist = StreamingHistogram(*F0_RANGE)
+
+    def update(self, spr, f0):
+        self.spr.update(spr)
+        self.f0.update(f0)
+        self.spr_hist.update(spr)
+        self.f0_hist.update(f0)
+
+    def merge(self, other):
+        self.spr.merge(other.spr)
+        self.f0.merge(other.f0)
+        self.spr_hist.merge(other.spr_hist)
+        self.f0_hist.merge(other.f0_hist)
+
+    def get_id(self):
+        return self.reader_id
+
+    def get_num_samples(self):
+        return self.spr.n
+
+    def get_spr_mean(self):
+        return self.spr.mean
+
+    def get_spr_stddev(self):
+        return self.spr.stddev()
+
+    def get_f0_mean(self):
+        return self.f0.mean
+
+    def get_f0_stddev(self):
+        return self.f0.stddev()
+
+    def to_dict(self):
+        return {
+            'reader': self.reader_id,
+            'spr': self.spr.to_dict(),
+            'f0': self.f0.to_dict(),
+            'spr_hist': self.spr_hist.to_dict(),
+            'f0_hist': self.f0_hist.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(d['reader'])
+        stats.spr = RunningStats.from_dict(d['spr'])
+        stats.f0 = RunningStats.from_dict(d['f0'])
+        stats.spr_hist = StreamingHistogram.from_dict(d['spr_hist'])
+        stats.f0_hist = StreamingHistogram.from_dict(d['f0_hist'])
+        return stats
+
+
+class MetaStats:
+    '''
+        Summary statistics of a meta run that are accumulated
+        while the run writes its rows. Readers are kept in the
+        order they first appear, as in a ReaderSet.
+    '''
+    def __init__(self):
+        self.readers = {}
+
+    def update(self, reader_id, spr, f0):
+        if reader_id not in self.readers:
+            self.readers[reader_id] = ReaderStats(reader_id)
+        self.readers[reader_id].update(spr, f0)
+
+    def merge(self, other):
+        for reader_id, stats in other.readers.items():
+            if reader_id not in self.readers:
+                self.readers[reader_id] = ReaderStats(reader_id)
+            self.readers[reader_id].merge(stats)
+
+    def get_num_samples(self):
+        return sum(r.get_num_samples() for r in self.readers.values())
+
+    def save(self, path):
+        '''
+            Writes the statistics to path. The file is replaced
+            atomically so it can be read while a run is going.
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'readers': [r.to_dict() for r in self.readers.values()]}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with open(path) as f:
+            for d in json.load(f)['readers']:
+                stats.readers[d['reader']] = ReaderStats.from_dict(d)
+        return stats
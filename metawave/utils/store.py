@@ -0,0 +1,302 @@
+import itertools
+import json
+import os
+
+import numpy as np
+
+STORE_VERSION = 1
+META_COLUMNS = ['spr', 'f0']
+
+class StringTable:
+    '''
+        A list of strings stored as a single UTF-8 blob and
+        the end offset of each string in it. Both files are
+        memory mapped, so a table of millions of ids is opened
+        without reading it.
+    '''
+    def __init__(self, blob_path, offsets_path):
+        self._blob = open_memmap(blob_path, np.uint8)
+        self._ends = open_memmap(offsets_path, np.int64)
+
+    def __len__(self):
+        return self._ends.shape[0]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        start = self._ends[i - 1] if i > 0 else 0
+        return bytes(self._blob[start:self._ends[i]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, rows):
+        '''
+            The strings of an array of rows
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        ends = self._ends[rows]
+        starts = np.where(rows > 0, self._ends[np.maximum(rows - 1, 0)], 0)
+        blob = memoryview(self._blob)
+        return [str(blob[start:end], 'utf-8') for start, end in zip(starts.tolist(), ends.tolist())]
+
+def write_strings(strings, blob_file, offsets_file, start=0):
+    '''
+        Appends strings to the open blob and offsets files of a
+        StringTable whose blob is currently start bytes long.
+        Returns the new length of the blob.
+    '''
+    encoded = [s.encode('utf-8') for s in strings]
+    ends = start + np.cumsum([len(e) for e in encoded], dtype=np.int64)
+    blob_file.write(b''.join(encoded))
+    ends.tofile(offsets_file)
+    return int(ends[-1]) if len(encoded) > 0 else start
+
+def open_memmap(path, dtype):
+    '''
+        Memory maps a raw binary column. numpy can not map
+        empty files, so those give an empty array.
+    '''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+def store_files(path):
+    '''
+        The names of the files of a meta store in the directory
+        path, see MetaStore
+    '''
+    names = ['header.json', 'readers.txt', 'utt_ids.bin', 'utt_ids.off', 'reader.i4']
+    return [fn for fn in os.listdir(path) if fn in names or fn.endswith('.f8')]
+
+
+class MetaStore:
+    '''
+        Read access to a columnar meta store, the binary
+        counterpart of meta.tsv. A store is a directory with
+        * header.json: the version and the value columns
+        * <column>.f8: one raw float64 file per value column
+        * reader.i4: the reader of each row as an int32 code
+        * readers.txt: the reader id of each code, one per line
+        * utt_ids.bin, utt_ids.off: the utterance ids as a
+          StringTable
+
+        All columns are memory mapped.
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header['version'] != STORE_VERSION:
+            raise ValueError('Meta store version %d is not supported' % header['version'])
+        self.columns = header['columns']
+        with open(os.path.join(path, 'readers.txt'), encoding='utf-8') as f:
+            self.reader_ids = f.read().splitlines()
+        self.utt_ids = StringTable(os.path.join(path, 'utt_ids.bin'), os.path.join(path, 'utt_ids.off'))
+        self.reader_codes = open_memmap(os.path.join(path, 'reader.i4'), np.int32)
+        self.values = {}
+        for col in self.columns:
+            self.values[col] = open_memmap(os.path.join(path, '%s.f8' % col), np.float64)
+        # a store that was being appended to when a run stopped
+        # can have columns of different lengths
+        self._num_rows = min([len(self.utt_ids), len(self.reader_codes)] +
+            [len(v) for v in self.values.values()])
+
+    def __len__(self):
+        return self._num_rows
+
+    def rows(self):
+        '''
+            Yields (utt_id, reader_id, {column: value}) for each row
+        '''
+        for i in range(len(self)):
+            yield (self.utt_ids[i], self.reader_ids[self.reader_codes[i]],
+                {col: float(self.values[col][i]) for col in self.columns})
+
+
+class MetaStoreWriter:
+    '''
+        Appends rows to a columnar meta store. Rows are buffered
+        and written on flush, so a store that is flushed together
+        with meta.tsv always holds the same rows.
+
+        If append is False any previous store at path is replaced.
+        Only the files of a store are removed, and a directory
+        that holds other files but no store is refused.
+    '''
+    def __init__(self, path, columns=META_COLUMNS, append=False):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+        if os.listdir(path) and not os.path.exists(os.path.join(path, 'header.json')):
+            raise ValueError('%s is not empty and not a meta store, choose another directory' % path)
+        if append and os.path.exists(os.path.join(path, 'header.json')):
+            store = MetaStore(path)
+            if store.columns != columns:
+                raise ValueError('The meta store at %s has the columns %s, not %s'
+                    % (path, store.columns, columns))
+            self._truncate(len(store))
+            self._readers = {r: i for i, r in enumerate(store.reader_ids)}
+        else:
+            for fn in store_files(path):
+                os.remove(os.path.join(path, fn))
+            self._readers = {}
+        self.columns = columns
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump({'version': STORE_VERSION, 'columns': columns}, f)
+        for name in ['readers.txt', 'utt_ids.bin', 'utt_ids.off', 'reader.i4'] + \
+                ['%s.f8' % col for col in columns]:
+            open(self._file(name), 'ab').close()
+        self._blob_len = os.path.getsize(self._file('utt_ids.bin')) \
+            if os.path.exists(self._file('utt_ids.bin')) else 0
+        self._new_readers = []
+        self._utt_ids = []
+        self._codes = []
+        self._values = {col: [] for col in columns}
+
+    def write(self, utt_id, reader_id, values):
+        if reader_id not in self._readers:
+            self._readers[reader_id] = len(self._readers)
+            self._new_readers.append(reader_id)
+        self._utt_ids.append(utt_id)
+        self._codes.append(self._readers[reader_id])
+        for col in self.columns:
+            self._values[col].append(values[col])
+
+    def flush(self):
+        # the reader table and ids go first, a row only counts
+        # once all of its columns are written
+        with open(self._file('readers.txt'), 'a', encoding='utf-8') as f:
+            for reader_id in self._new_readers:
+                f.write('%s\n' % reader_id)
+        with open(self._file('utt_ids.bin'), 'ab') as blob, open(self._file('utt_ids.off'), 'ab') as off:
+            self._blob_len = write_strings(self._utt_ids, blob, off, self._blob_len)
+        with open(self._file('reader.i4'), 'ab') as f:
+            np.array(self._codes, dtype=np.int32).tofile(f)
+        for col in self.columns:
+            with open(self._file('%s.f8' % col), 'ab') as f:
+                np.array(self._values[col], dtype=np.float64).tofile(f)
+        self._new_readers = []
+        self._utt_ids = []
+        self._codes = []
+        self._values = {col: [] for col in self.columns}
+
+    def close(self):
+        self.flush()
+
+    def _file(self, name):
+        return os.path.join(self._path, name)
+
+    def _truncate(self, num_rows):
+        '''
+            Cuts every column to num_rows rows
+        '''
+        ends = open_memmap(self._file('utt_ids.off'), np.int64)
+        blob_len = int(ends[num_rows - 1]) if num_rows > 0 else 0
+        del ends
+        sizes = [('utt_ids.off', 8 * num_rows), ('utt_ids.bin', blob_len),
+            ('reader.i4', 4 * num_rows)]
+        sizes += [('%s.f8' % col, 8 * num_rows) for col in MetaStore(self._path).columns]
+        for name, size in sizes:
+            with open(self._file(name), 'r+b') as f:
+                f.truncate(size)
+
+def tsv_to_store(tsv_path, store_path, columns=META_COLUMNS):
+    '''
+        Converts a meta.tsv file with the given value columns
+        to a columnar meta store. Returns the number of rows.
+    '''
+    writer = MetaStoreWriter(store_path, columns)
+    count = 0
+    with open(tsv_path, 'r') as meta:
+        for line in meta:
+            [file_id, reader, *values] = line.split('\t')
+            if len(values) != len(columns):
+                raise ValueError('The rows of %s have %d values, not one for each of the columns %s'
+                    % (tsv_path, len(values), ', '.join(columns)))
+            writer.write(file_id, reader, dict(zip(columns, map(float, values))))
+            count += 1
+            if count % 100000 == 0:
+                writer.flush()
+    writer.close()
+    return count
+
+def meta_columns_to_store(tsv_path, store_path, num_lines=2**16):
+    '''
+        Writes the ids, readers and the META_COLUMNS of a
+        meta.tsv, which may have more feature columns, to a new
+        meta store, parsing num_lines lines at a time. Returns
+        the number of rows.
+    '''
+    os.makedirs(store_path, exist_ok=True)
+    with open(os.path.join(store_path, 'header.json'), 'w') as f:
+        json.dump({'version': STORE_VERSION, 'columns': META_COLUMNS}, f)
+    files = {name: open(os.path.join(store_path, name), 'wb')
+        for name in ['utt_ids.bin', 'utt_ids.off', 'reader.i4'] + ['%s.f8' % col for col in META_COLUMNS]}
+    readers = {}
+    blob_len = 0
+    count = 0
+    try:
+        with open(tsv_path, 'r') as meta:
+            while True:
+                lines = list(itertools.islice(meta, num_lines))
+                if not lines:
+                    break
+                columns = list(zip(*[line.split('\t', 2 + len(META_COLUMNS))[:2 + len(META_COLUMNS)]
+                    for line in lines]))
+                blob_len = write_strings(columns[0], files['utt_ids.bin'], files['utt_ids.off'], blob_len)
+                np.array([readers.setdefault(r, len(readers)) for r in columns[1]],
+                    dtype=np.int32).tofile(files['reader.i4'])
+                for col, values in zip(META_COLUMNS, columns[2:]):
+                    np.array(values, dtype=np.float64).tofile(files['%s.f8' % col])
+                count += len(lines)
+    finally:
+        for f in files.values():
+            f.close()
+    with open(os.path.join(store_path, 'readers.txt'), 'w', encoding='utf-8') as f:
+        for reader_id in readers:
+            f.write('%s\n' % reader_id)
+    return count
+
+def reader_order(codes, counts, path, chunk_rows=2**16):
+    '''
+        The rows of the codes ordered by their code, rows of
+        the same code in their order, as a stable argsort would
+        give, written to a memory mapped file at path. counts
+        is the number of rows of each code. The order is found
+        with a counting sort over chunk_rows rows at a time, so
+        only a chunk of the codes is read into memory.
+    '''
+    order = np.memmap(path, dtype=np.int64, mode='w+', shape=(max(codes.shape[0], 1),))
+    next_pos = np.cumsum(counts) - counts
+    for start in range(0, codes.shape[0], chunk_rows):
+        chunk = np.asarray(codes[start:start + chunk_rows])
+        rows = np.argsort(chunk, kind='stable')
+        sorted_codes = chunk[rows]
+        # the position of each row among the rows of its code
+        first = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        rank = np.arange(rows.shape[0]) - np.repeat(first, np.diff(np.r_[first, rows.shape[0]]))
+        order[next_pos[sorted_codes] + rank] = start + rows
+        next_pos += np.bincount(chunk, minlength=counts.shape[0])
+    order.flush()
+    return order[:codes.shape[0]]
+
+def store_to_tsv(store_path, tsv_path):
+    '''
+        Converts a columnar meta store to a meta.tsv file.
+        Returns the number of rows.
+    '''
+    store = MetaStore(store_path)
+    with open(tsv_path, 'w') as meta:
+        for utt_id, reader, vals in store.rows():
+            meta.write(meta_line(utt_id, reader, *[vals[col] for col in store.columns]))
+    return len(store)
+
+def meta_line(utt_id, reader, *values):
+    '''
+        A single row of meta.tsv, the values are those of the
+        columns of the run, spr and f0 first
+    '''
+    return utt_id+'\t'+reader+''.join('\t %0.4f ' % v for v in values)+'\n'
+
+def is_store(meta_path):
+    return os.path.isdir(meta_path)
@@ -0,0 +1,142 @@
+'''
+    A token pack holds every text token of a token directory
+    in a single file, so runs and searches over millions of
+    tokens open one file instead of one per utterance. The
+    file is memory mapped and has
+    * a header: MAGIC, the number of tokens and the length of
+      the id and text blobs
+    * the end offset of each id in the id blob and of each
+      text in the text blob, as int64
+    * the id blob: the path of each token relative to the
+      token directory, UTF-8, sorted so ids are found by
+      bisection
+    * the text blob: the text of each token, UTF-8, as it is
+      read from the file in text mode
+'''
+import bisect
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .index import walk_files
+
+MAGIC = b'MWTOKPK1'
+HEADER = struct.Struct('<8sQQQ')
+# the tokens read ahead of the writer when packing
+READ_BATCH = 4096
+
+def token_id(path):
+    '''
+        The id of a token in a pack from its path relative to
+        the token directory, e.g. the token file of an index
+    '''
+    return os.path.normpath(path).replace(os.sep, '/')
+
+def read_text(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+def pack_tokens(token_dir, out_path, workers=8):
+    '''
+        Writes every file in the token_dir tree to a token pack
+        at out_path. The files are read by a pool of workers
+        threads, in id order. Returns the number of tokens.
+    '''
+    ids = sorted(token_id(path) for path in walk_files(token_dir, workers))
+    encoded_ids = [i.encode('utf-8') for i in ids]
+    id_ends = np.cumsum([len(i) for i in encoded_ids], dtype=np.int64)
+    text_ends = np.zeros(len(ids), dtype=np.int64)
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f, ThreadPoolExecutor(max(workers, 1)) as pool:
+        f.write(HEADER.pack(MAGIC, len(ids), 0, 0))
+        id_ends.tofile(f)
+        # the text offsets are known once the texts are written
+        f.write(bytes(text_ends.nbytes))
+        f.write(b''.join(encoded_ids))
+        end = 0
+        for start in range(0, len(ids), READ_BATCH):
+            paths = [os.path.join(token_dir, i) for i in ids[start:start + READ_BATCH]]
+            for i, text in enumerate(pool.map(read_text, paths), start):
+                data = text.encode('utf-8')
+                f.write(data)
+                end += len(data)
+                text_ends[i] = end
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(ids), int(id_ends[-1]) if len(ids) else 0, end))
+        f.seek(HEADER.size + id_ends.nbytes)
+        text_ends.tofile(f)
+    os.replace(tmp_path, out_path)
+    return len(ids)
+
+
+class TokenPack:
+    '''
+        Read access to a token pack, see the module description.
+        Nothing but the header is read when a pack is opened.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, ids_len, _ = HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            raise ValueError('%s is not a token pack' % path)
+        self._id_ends = np.frombuffer(self._data, np.int64, count, HEADER.size)
+        self._text_ends = np.frombuffer(self._data, np.int64, count, HEADER.size + 8 * count)
+        self._ids_start = HEADER.size + 16 * count
+        self._texts_start = self._ids_start + ids_len
+        self._ids = _IdList(self)
+
+    def __len__(self):
+        return self._id_ends.shape[0]
+
+    def __contains__(self, tid):
+        return self.find(tid) >= 0
+
+    def id_at(self, i):
+        return self._slice(self._ids_start, self._id_ends, i)
+
+    def text_at(self, i):
+        return self._slice(self._texts_start, self._text_ends, i)
+
+    def find(self, tid):
+        '''
+            The position of the token with the id tid, or -1
+        '''
+        tid = token_id(tid)
+        i = bisect.bisect_left(self._ids, tid)
+        return i if i < len(self) and self.id_at(i) == tid else -1
+
+    def get(self, tid, default=None):
+        '''
+            The text of the token with the id tid
+        '''
+        i = self.find(tid)
+        return self.text_at(i) if i >= 0 else default
+
+    def items(self, start=0, stop=None):
+        '''
+            Yields (id, text) for the tokens in [start, stop)
+        '''
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield self.id_at(i), self.text_at(i)
+
+    def _slice(self, base, ends, i):
+        start = int(ends[i - 1]) if i > 0 else 0
+        return self._data[base + start:base + int(ends[i])].decode('utf-8')
+
+class _IdList:
+    '''
+        The ids of a pack as a sequence for bisect
+    '''
+    def __init__(self, pack):
+        self._pack = pack
+
+    def __len__(self):
+        return len(self._pack)
+
+    def __getitem__(self, i):
+        return self._pack.id_at(i)